@@ -4,10 +4,29 @@ import sys
 import atexit
 import shlex
 import time
+import threading
+
+# Commands given on the command line are run without starting the queue (see oneshot.py)
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] != '--headless':
+	import oneshot
+	sys.exit(oneshot.main(sys.argv[1:]))
 
 import bgdthread as bgd
 import msgqueue as msgq
 import taskfile
+import tasks
+import blendfile
+import bundle
+import phases
+import postproc
+import tiles
+import preempt
+import stats as taskstats
+import control
+import dashboard
+import tasklog
+import fairshare
+import watchfolder
 import lan
 
 
@@ -111,31 +130,108 @@ def help(args):
 			print(Color.RED + f"Unrecognized command '{args[0]}'")
 			print("Type 'help' for a list of available commands")
 
-@command('<filepath>', ['r'],
-'''Adds the specified blend file to the queue for rendering as an animation
-If <filepath> includes whitespace, it must be quoted''')
-def render(args):
-	if args is None or len(args) != 1:
-		invalid_args('render')
+# Queues a new task, or while connected to a server as a client, sends it to the server instead (see lan.py)
+def queue_task(type, args, info=None):
+	if lan.current_LAN_state == lan.LANState.CLIENT:
+		print(f'Sending "{args[0]}" and its dependencies to the server...')
+		if lan.client_send_task(taskfile.Task(type, args, info=info)):
+			print(Color.GREEN + 'Task queued on the server')
+		else:
+			print(Color.RED + 'Could not send the task to the server')
 		return
-	taskfile.create_task(taskfile.TaskType.RENDER_ANIMATION, args)
+	taskfile.create_task(type, args, info=info)
 	bgd_thread.notify_thread()
 
-@command('<filepath>', ['s'],
+# Shared by render and still: args is the filepath followed by task options (see tasks.parse_task_options())
+def queue_render(command, type, args):
+	if args is None or len(args) < 1:
+		invalid_args(command)
+		return
+	if not tasks.is_valid_blend(args[0]):
+		print(Color.RED + f"'{args[0]}' is not a valid blend file")
+		return
+	try:
+		info = tasks.parse_task_options(args[1:], type)
+	except ValueError as e:
+		print(Color.RED + str(e))
+		print("Type 'presets' for a list of presets and settings")
+		return
+	queue_task(type, args[:1], info)
+
+@command('<filepath> [preset] [setting=value ...]', ['r'],
+'''Adds the specified blend file to the queue for rendering as an animation
+If <filepath> includes whitespace, it must be quoted
+Render settings can be changed for this task only with a preset and/or settings (see 'presets')''')
+def render(args):
+	queue_render('render', taskfile.TaskType.RENDER_ANIMATION, args)
+
+@command('<filepath> [preset] [setting=value ...]', ['s'],
 '''Adds the specified blend file to the queue for rendering as a still image
-If <filepath> includes whitespace, it must be quoted''')
+If <filepath> includes whitespace, it must be quoted
+Render settings can be changed for this task only with a preset and/or settings (see 'presets')''')
 def still(args):
-	if args is None or len(args) != 1:
-		invalid_args('still')
+	queue_render('still', taskfile.TaskType.RENDER_STILL, args)
+
+@command('', [], 'Prints the presets, settings, post-processing steps and tiling that can be given to render and still')
+def presets(args):
+	if args is not None:
+		invalid_args('presets')
 		return
-	taskfile.create_task(taskfile.TaskType.RENDER_STILL, args)
-	bgd_thread.notify_thread()
+	print(Color.CYAN + "===== Presets =====" + Color.RESET)
+	for name, overrides in tasks.PRESETS.items():
+		print(f'{name}: ' + ', '.join(f'{k}={v}' for k, v in overrides.items()))
+	print(Color.CYAN + "===== Settings =====" + Color.RESET)
+	for name, type in tasks.OVERRIDES.items():
+		print(f'{name}=<{type.__name__}>')
+	print(Color.CYAN + "===== Post-processing =====" + Color.RESET)
+	print('post=<step,...>: runs steps on the outputs once the task completes. Steps: ' + ', '.join(postproc.STEPS))
+	print(Color.CYAN + "===== Tiles =====" + Color.RESET)
+	print('tiles=<columns>x<rows>: (still only) renders each tile as a separate task, then stitches them')
+	print(Color.CYAN + "===== Submitter =====" + Color.RESET)
+	print("submitter=<name>: the person or project the task is for. See 'share'")
+	print('')
 
 
 
-@command('<filepath>', ['b'], 'Adds the specified blend file to the queue for baking all physics dynamics')
+@command('<filepath>', ['b'],
+'''Adds the specified blend file to the queue for baking all physics dynamics
+Independent caches are baked in separate Blender processes at the same time''')
 def bake(args):
-	bgd_thread.notify_thread()
+	if args is None or len(args) != 1:
+		invalid_args('bake')
+		return
+	if not tasks.is_valid_blend(args[0]):
+		print(Color.RED + f"'{args[0]}' is not a valid blend file")
+		return
+	queue_task(taskfile.TaskType.BAKE, args)
+
+@command('<filepath>', ['i'],
+'''Prints the frame range, render engine, resolution and output path of the specified blend file
+The file is read directly, without launching Blender''')
+def info(args):
+	if args is None or len(args) != 1:
+		invalid_args('info')
+		return
+	blend_info = blendfile.read_info(args[0])
+	if blend_info is None:
+		print(Color.RED + f"Could not read '{args[0]}'")
+		return
+	print(Color.CYAN + "===== Blend File =====" + Color.RESET)
+	print(blend_info.desc() + '\n')
+
+@command('<filepath>', [],
+'''Lists the external files (textures, libraries, caches, etc.) the specified blend file depends on
+Results are cached until the blend file changes; missing files are reported''')
+def deps(args):
+	if args is None or len(args) != 1:
+		invalid_args('deps')
+		return
+	manifest = bundle.get_manifest(args[0])
+	if manifest is None:
+		print(Color.RED + f"Could not scan '{args[0]}'")
+		return
+	print(Color.CYAN + "===== Dependencies =====" + Color.RESET)
+	print(manifest.desc() + '\n')
 
 @command('', [], 'Prints the current state information of the script and all tasks')
 def status(args):
@@ -144,14 +240,22 @@ def status(args):
 		return
 	current = taskfile.get_current_task()
 	tasks = taskfile.read_tasks()
-	completed = taskfile.read_completed()
-	failed = taskfile.read_failed()
 	# TODO: completed and failed tasks
 	if current is not None:
 		# Correct the time, since it has changed since the task started running
 		current.time += time.perf_counter() - bgd_thread.start_time
 		print(Color.YELLOW + "===== Current Task =====")
 		print(current.desc())
+		if current.type == taskfile.TaskType.BAKE:
+			done, total = getattr(bgd_thread.subp, 'progress', (0, 0))
+			print(f'\t- Caches baked: {done}/{total}')
+		else:
+			print('\t- Phases so far: ' + phases.desc(phases.summarize(phases.read_events(current))[0]))
+	suspended = preempt.read_suspended()
+	if len(suspended) > 0:
+		print(Color.YELLOW + "===== Tasks Suspended =====")
+		for i in range(0, len(suspended)):
+			print(str(i + 1) + ". " + suspended[i].desc())
 	print('')
 	if len(tasks) == 0:
 		print(Color.CYAN + "===== Tasks Queued =====\nThere are no tasks currently queued" + Color.RESET)
@@ -160,18 +264,139 @@ def status(args):
 		for i in range(0, len(tasks)):
 			print(str(i + 1) + ". " + tasks[i].desc())
 	print('')
-	if len(completed) > 0:
-		print(Color.GREEN + "===== Tasks Completed =====")
-		for i in range(0, len(completed)):
-			print(str(i + 1) + ". " + completed[i].desc())
+	# History is read one task at a time, so long histories do not have to fit in memory
+	totals = {}
+	for i, task in enumerate(taskfile.iter_completed()):
+		if i == 0:
+			print(Color.GREEN + "===== Tasks Completed =====")
+		print(str(i + 1) + ". " + task.desc())
+		phases.combine([task], totals)
 	print('')
-	if len(failed) > 0:
-		print(Color.MAGENTA + "===== Tasks Failed =====")
-		for i in range(0, len(failed)):
-			print(str(i + 1) + ". " + failed[i].desc())
+	for i, task in enumerate(taskfile.iter_failed()):
+		if i == 0:
+			print(Color.MAGENTA + "===== Tasks Failed =====")
+		print(str(i + 1) + ". " + task.desc())
+	if postproc.pending() > 0:
+		print('')
+		print(Color.GREEN + f"Post-processing: {postproc.pending()} job(s) waiting or running")
+	for file, done, total in tiles.in_progress():
+		print(Color.GREEN + f'Tiled still "{file}": {done}/{total} tiles done')
+	if len(totals) > 0:
+		print('')
+		print(Color.BLUE + "===== Time by Phase (completed tasks) =====")
+		print(phases.desc(totals))
 	print('\n' + Color.RESET)
 
 
+@command('', ['w'],
+'''Shows a continuously updating view of the current task, the queue and recent results
+Type 'n' or 'p' and Enter to page through the queue, or just Enter to stop watching''')
+def watch(args):
+	if args is not None:
+		invalid_args('watch')
+		return
+	view = dashboard.Dashboard(bgd_thread.start_time)
+	view.start()
+	while True:
+		try:
+			line = input().strip()
+		except EOFError:
+			break
+		if line == 'n':
+			view.turn_page(1)
+		elif line == 'p':
+			view.turn_page(-1)
+		else:
+			break
+	view.stop()
+	view.join()
+	print(Color.RESET)
+
+
+@command('[id/current] [lines/all]', [],
+'''Prints the last [lines] lines (40 by default, or all) of the output of a task's Blender processes
+The task is given by its id, or the start of it. If no task is given, the current task is used
+If the task is running, new output is printed as it is written until Enter is pressed''')
+def log(args):
+	if args is not None and (len(args) > 2 or (len(args) == 2 and args[1] != 'all' and not args[1].isdigit())):
+		invalid_args('log')
+		return
+	lines = args[1] if args is not None and len(args) == 2 else '40'
+	num = sys.maxsize if lines == 'all' else int(lines)
+	if args is None or args[0] == 'current':
+		current = taskfile.get_current_task()
+		if current is None:
+			print('No task is running')
+			return
+		id = current.id()
+	else:
+		id = tasklog.find(args[0])
+		if id is None:
+			print(f"No log matches the task id '{args[0]}'")
+			return
+	live = tasklog.live(id)
+	if len(live) == 0:
+		filename = tasklog.log_filename(id)
+		if not os.path.exists(filename):
+			print(f'Task {id} has no output yet')
+			return
+		# Only the lines that are printed are kept in memory
+		for line in tasklog.iter_lines(filename) if lines == 'all' else tasklog.read_tail(filename, num):
+			print(line, end='')
+		return
+	stop = threading.Event()
+	def follow(capture):
+		prefix = f'[{capture.label}] ' if len(live) > 1 else ''
+		for line in capture.follow(num, stop):
+			print(prefix + line.decode('utf-8', errors='replace'), end='')
+	print(Color.YELLOW + 'Press Enter to stop following the output' + Color.RESET)
+	followers = [threading.Thread(target=follow, args=[c], daemon=True) for c in live]
+	for t in followers:
+		t.start()
+	try:
+		input()
+	except EOFError:
+		pass
+	stop.set()
+	for t in followers:
+		t.join()
+
+
+@command('[filepath]', [],
+'''Prints statistics over all completed and failed tasks: throughput, time per task, failure rates and time per file
+If [filepath] is given, only prints the statistics of that blend file''')
+def stats(args):
+	if args is not None and len(args) != 1:
+		invalid_args('stats')
+		return
+	print(Color.CYAN + "===== Statistics =====" + Color.RESET)
+	print(taskstats.desc(taskstats.load(), args[0] if args is not None else None) + '\n')
+
+@command('[submitter share [quota]]', [],
+'''Prints or sets how the queue is shared between submitters (see the submitter option)
+Each submitter gets time in proportion to its share (1 by default). A quota limits how many of its tasks
+may be running or suspended at the same time while other submitters are waiting (0 removes the quota)
+Tasks without a submitter belong to the submitter '-' ''')
+def share(args):
+	if args is not None:
+		try:
+			if len(args) not in (2, 3):
+				raise ValueError()
+			fairshare.set_share('' if args[0] == '-' else args[0], float(args[1]), int(args[2]) if len(args) == 3 else None)
+		except ValueError:
+			invalid_args('share')
+			return
+	print(Color.CYAN + "===== Shares =====" + Color.RESET)
+	rows = fairshare.summary(taskfile.read_tasks())
+	if len(rows) == 0:
+		print('There are no submitters yet')
+	for name, weight, quota, deficit, queued in rows:
+		print(f'{name or "-"}: share {weight:g}' + (f', quota {quota}' if quota is not None else '') +
+			f', {queued} queued, deficit {deficit:.0f}s')
+	if taskfile.scheduling_policy != 'fair':
+		print(f"Shares are not used, since the scheduling policy is '{taskfile.scheduling_policy}'")
+	print('')
+
 @command('[completed/failed/queued/c/f/q]', [],
 '''Clears the specified list(s) of tasks. This cannot be undone
 Multiple can be specified at a time (ex: 'clear c f')
@@ -190,9 +415,41 @@ def clear(args):
 		taskfile.clear_tasks()
 
 
-#@command('<IPv4> <port>', [],
-#'''Connects as a client to a server at IPv4 over port
-#Run 'server' on the server to retrieve these values''')
+@command('[add <path> [type] [front/back] / remove <path>]', [],
+'''Manages watch folders, from which new blend files are queued automatically
+[type] is 'ra' (animation, default), 'rs' (still) or 'b' (bake)
+[front/back] is where new files are queued (default: back)
+More specific rules can be added by editing the watch folder file (see watchfolder.py)
+If no arguments are given, all watch folders are printed''')
+def folder(args):
+	if args is None:
+		if len(watchfolder.folders) == 0:
+			print(Color.CYAN + "There are no watch folders" + Color.RESET)
+		for f in watchfolder.folders:
+			print(Color.CYAN + f.desc() + Color.RESET)
+		return
+	if args[0] == 'add' and 2 <= len(args) <= 4:
+		type = args[2] if len(args) > 2 else taskfile.TaskType.RENDER_ANIMATION
+		position = args[3] if len(args) > 3 else watchfolder.Position.BACK
+		if taskfile.TaskType.get_name(type) is None or position not in (watchfolder.Position.FRONT, watchfolder.Position.BACK):
+			invalid_args('folder')
+			return
+		if not os.path.isdir(args[1]):
+			print(Color.RED + f"'{args[1]}' is not a directory")
+			return
+		watchfolder.add_folder(watchfolder.WatchFolder(args[1], type, position))
+	elif args[0] == 'remove' and len(args) == 2:
+		if not watchfolder.remove_folder(args[1]):
+			print(Color.RED + f"'{args[1]}' is not a watch folder")
+	else:
+		invalid_args('folder')
+
+
+@command('<IPv4> <port>', [],
+'''Connects as a client to a server at IPv4 over port
+Run 'server' on the server to retrieve these values
+While connected, render, still and bake send the blend file and its dependencies to the server and queue the
+task there instead of here''')
 def client(args):
 	if args is None or len(args) != 2:
 		invalid_args('client')
@@ -204,10 +461,10 @@ def client(args):
 		return
 	lan.make_client(ip, port)
 
-#@command('[port]', [],
-#'''Establishes this script instance as a server that other instances can connect to
-#If no port is specified, the script will let the OS select a port
-#If this instance is already a server, the current ip and port are retrieved''')
+@command('[port]', [],
+'''Establishes this script instance as a server that other instances can connect to
+If no port is specified, the script will let the OS select a port
+If this instance is already a server, the current ip and port are retrieved''')
 def server(args):
 	if args is not None:
 		if len(args) > 1:
@@ -222,9 +479,9 @@ def server(args):
 		port = None
 	lan.make_server(port)
 
-#@command('<IPv4> <port>', [],
-#'''Connects as a worker to a server at IPv4 over port
-#Run 'server' on the server to retrieve these values''')
+@command('<IPv4> <port>', [],
+'''Connects as a worker to a server at IPv4 over port
+Run 'server' on the server to retrieve these values''')
 def worker(args):
 	if args is None or len(args) != 2:
 		invalid_args('worker')
@@ -236,7 +493,7 @@ def worker(args):
 		return
 	lan.make_worker(ip, port)
 
-#@command('', [], 'Disconnects the current LAN state (client/server/worker), if any')
+@command('', [], 'Disconnects the current LAN state (client/server/worker), if any')
 def disconnect(args):
 	if args is not None:
 		invalid_args('disconnect')
@@ -251,6 +508,8 @@ def quit(args=None):
 		return
 	global done
 	done = True
+	control.stop_server()
+	watchfolder.stop()
 	msgq.add_message(msgq.MessageType.QUIT)
 atexit.register(quit)
 
@@ -274,6 +533,7 @@ def skip(args):
 		except ValueError:
 			invalid_args('skip')
 			return
+	msgq.add_message(msgq.MessageType.SKIP, index)
 
 
 def print_command_info(name, cmd : Command):
@@ -300,6 +560,9 @@ if __name__ == '__main__':
 
 	if not headless:
 		bgd_thread.start()
+	# Lets ctl.py and other programs modify the queue, even in headless mode
+	control.start_server()
+	watchfolder.start()
 
 	# done is defined above and set to True in quit()
 	while not done:
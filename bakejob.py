@@ -0,0 +1,183 @@
+import os
+import json
+import ctypes
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import taskfile
+import tasks
+import tasklog
+
+
+'''
+bakejob
+Runs a bake task as several Blender processes (see bbake.py):
+1. List the caches in the blend file
+2. Bake every cache that can be stored on disk in its own process, up to max_jobs at a time
+	Levels are baked in order; a level only starts once all caches of lower levels have finished
+	If any cache fails, all caches of higher levels are skipped, since they may depend on it
+3. Bake the remaining caches (rigid bodies, fluid domains) in one process, mark the others as baked and save
+
+A BakeJob is used by BgdThread in place of a subprocess.Popen object, so it has wait(), poll() and kill()
+Progress is printed as caches finish. Per-cache failures are kept in failures and are
+stored in the FailedTask (see BgdThread.failed()). The output of every process is kept in the task's log (see tasklog.py)
+'''
+
+
+bbake_path = Path(__file__).parent.joinpath('bbake.py').absolute()
+
+# The maximum number of Blender processes baking at the same time
+max_jobs = max(1, (os.cpu_count() or 2) // 2)
+
+# Exit code used if the job was killed or could not list caches
+EXIT_FAILED = 1
+
+
+class BakeJob:
+	def __init__(self, task : taskfile.Task):
+		self.task = task
+		self.filename = task.args[0]
+		self.returncode = None
+		# A list of {'cache': name, 'exit_code': code} for every cache that failed or was skipped
+		self.failures = []
+		# (caches done, total caches)
+		self.progress = (0, 0)
+		self.killed = False
+		self.mutex = threading.Lock()
+		self.procs = set()
+		# BgdThread expects a process id; a job has many processes
+		self.pid = None
+		self.thread = threading.Thread(target=self.run, name='BakeJob', daemon=True)
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def wait(self):
+		self.thread.join()
+		return self.returncode
+
+	def poll(self):
+		return self.returncode
+
+	def kill(self):
+		with self.mutex:
+			self.killed = True
+			for proc in self.procs:
+				proc.kill()
+
+	# The process ids of the Blender processes currently running
+	def pids(self):
+		with self.mutex:
+			return [proc.pid for proc in self.procs]
+
+	# Starts a Blender process running bbake.py. Returns None if the job was killed or Blender is missing
+	def launch(self, extra_args):
+		with self.mutex:
+			if self.killed:
+				return None
+			try:
+				proc = subprocess.Popen(tasks.blender_command(self.filename, bbake_path, extra_args),
+					stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+			except OSError:
+				print("Could not find 'blender'. Make sure the executable is in your PATH.")
+				return None
+			# Each process gets its own section in the task's log
+			tasklog.capture(self.task, proc, 'bbake ' + ' '.join(str(a) for a in extra_args[:2]))
+			self.procs.add(proc)
+			return proc
+
+	def finish(self, proc):
+		code = ctypes.c_int32(proc.wait()).value
+		tasklog.finish(proc)
+		with self.mutex:
+			self.procs.discard(proc)
+		return code
+
+	# code is None if the cache was skipped
+	def fail(self, name, code):
+		self.failures.append({'cache': name, 'exit_code': code})
+		if code is None:
+			print(f'Bake of "{name}" skipped')
+		else:
+			print(f'Bake of "{name}" failed with exit code {code}')
+
+	def list_caches(self, tmpdir):
+		output = os.path.join(tmpdir, 'caches.json')
+		proc = self.launch(['list', output])
+		if proc is None or self.finish(proc) != 0:
+			return None
+		with open(output, 'r') as f:
+			return json.load(f)
+
+	# Bakes one parallel cache in its own process. Returns whether it succeeded
+	def bake_one(self, cache):
+		proc = self.launch(['bake', cache['id']])
+		if proc is None:
+			return False
+		code = self.finish(proc)
+		with self.mutex:
+			if code != 0:
+				self.fail(cache['name'], code)
+			self.progress = (self.progress[0] + 1, self.progress[1])
+		print(f'Bake: {self.progress[0]}/{self.progress[1]} caches done')
+		return code == 0
+
+	# Bakes the parallel caches, one level at a time
+	# Returns (the ids of the caches that were baked, the highest level that may still be baked)
+	def bake_parallel(self, caches):
+		levels = sorted(set(c['level'] for c in caches if c['parallel']))
+		baked = []
+		max_level = None
+		with ThreadPoolExecutor(max_workers=max_jobs) as pool:
+			for level in levels:
+				level_caches = [c for c in caches if c['parallel'] and c['level'] == level]
+				if max_level is not None or self.killed:
+					# Higher levels may depend on whatever failed
+					for cache in level_caches:
+						self.fail(cache['name'], None)
+					continue
+				results = list(pool.map(self.bake_one, level_caches))
+				baked += [c['id'] for c, ok in zip(level_caches, results) if ok]
+				if not all(results):
+					max_level = level
+		return baked, max_level
+
+	def finalize(self, tmpdir, baked, max_level):
+		output = os.path.join(tmpdir, 'finalize.json')
+		proc = self.launch(['finalize', output, str(-1 if max_level is None else max_level)] + baked)
+		if proc is None:
+			return False
+		code = self.finish(proc)
+		try:
+			with open(output, 'r') as f:
+				result = json.load(f)
+		except (OSError, ValueError):
+			self.fail('Finalize', code)
+			return False
+		for id, error in result['failed']:
+			self.fail(id, code)
+		return code == 0
+
+	def run(self):
+		with tempfile.TemporaryDirectory(prefix='lrq-bake-') as tmpdir:
+			caches = self.list_caches(tmpdir)
+			if caches is None:
+				self.fail('List caches', EXIT_FAILED)
+				self.returncode = EXIT_FAILED
+				return
+			print(f'Bake: found {len(caches)} caches in "{self.filename}"')
+			self.progress = (0, len(caches))
+			baked, max_level = self.bake_parallel(caches)
+			if self.killed:
+				self.returncode = EXIT_FAILED
+				return
+			ok = self.finalize(tmpdir, baked, max_level)
+			self.progress = (len(caches), len(caches))
+			if self.killed or not ok or len(self.failures) > 0:
+				self.returncode = EXIT_FAILED
+			else:
+				self.returncode = 0
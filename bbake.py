@@ -0,0 +1,176 @@
+'''
+bbake
+The python script that is run directly in Blender itself to perform bake tasks (see bakejob.py)
+It is run in one of three modes, given as the first argument after "--":
+
+list <output>: writes a JSON list of the file's caches to output. Each cache is an object with:
+	id: identifies the cache in the other modes
+	name: a readable name
+	level: caches are baked in order of level. A cache may depend on any cache of a lower level
+	parallel: whether the cache can be baked in its own Blender process. Only caches stored on disk can be,
+		since each process's changes to the blend file itself are discarded
+bake <id>: bakes one parallel cache to disk. Non-parallel caches of lower levels (e.g. rigid body worlds, which
+	can only be kept in memory) are baked in memory first, so the cache sees the same scene it would in a serial bake
+finalize <output> <max level> <id> ...: bakes all non-parallel caches in level order, marks the given (already
+	baked) parallel caches as baked, and saves the file. Writes {"failed": [[id, error], ...]} to output
+	If max level is not -1, non-parallel caches above it are skipped, since a cache they may depend on failed
+
+Exits with code 1 if anything failed. See brender.py for why fake-bpy-module may be useful for autocomplete
+'''
+
+import sys
+import json
+import traceback
+
+import bpy
+
+
+# Get the command line arguments
+# See bakejob.py for how command line arguments are passed into this script
+argv = sys.argv
+argv = argv[argv.index("--") + 1:]  # get all args after "--"
+
+arg_mode = argv[0]
+
+
+# A bakeable cache. bake() and mark_baked() raise on failure
+class Cache:
+	def __init__(self, id, name, level, parallel, point_cache=None, obj=None, scene=None):
+		self.id = id
+		self.name = name
+		self.level = level
+		self.parallel = parallel
+		self.point_cache = point_cache
+		self.obj = obj
+		self.scene = scene if scene is not None else bpy.context.scene
+
+	def to_dict(self):
+		return {'id': self.id, 'name': self.name, 'level': self.level, 'parallel': self.parallel}
+
+	def context(self):
+		override = {'scene': self.scene}
+		if self.point_cache is not None:
+			override['point_cache'] = self.point_cache
+		if self.obj is not None:
+			override['object'] = self.obj
+			override['active_object'] = self.obj
+		return override
+
+	# Runs an operator with this cache's context
+	def call(self, op, **kwargs):
+		if hasattr(bpy.context, 'temp_override'):
+			with bpy.context.temp_override(**self.context()):
+				result = op(**kwargs)
+		else:
+			result = op(self.context(), **kwargs)
+		if 'FINISHED' not in result:
+			raise RuntimeError(f'{op.idname()} returned {result}')
+
+	def bake(self):
+		if self.point_cache is not None and self.parallel:
+			# Each process's changes to the file are discarded, so results must go to disk
+			self.point_cache.use_disk_cache = True
+		self.call(bpy.ops.ptcache.bake, bake=True)
+
+	def mark_baked(self):
+		self.point_cache.use_disk_cache = True
+		self.call(bpy.ops.ptcache.bake_from_cache)
+
+class FluidCache(Cache):
+	def bake(self):
+		self.call(bpy.ops.fluid.bake_all)
+
+class DynamicPaintCache(Cache):
+	def __init__(self, id, name, level, obj, surface_index):
+		super().__init__(id, name, level, True, obj=obj)
+		self.surface_index = surface_index
+
+	# Image sequence surfaces write their images directly; nothing is stored in the blend file
+	def bake(self):
+		for mod in self.obj.modifiers:
+			if mod.type == 'DYNAMIC_PAINT' and mod.canvas_settings is not None:
+				mod.canvas_settings.canvas_surfaces.active_index = self.surface_index
+		self.call(bpy.ops.dpaint.bake)
+
+	def mark_baked(self):
+		pass
+
+
+def find_caches():
+	caches = []
+	for scene in bpy.data.scenes:
+		if scene.rigidbody_world is not None and scene.rigidbody_world.enabled:
+			# Rigid body caches cannot be stored on disk. Colliders of most other simulations may be rigid bodies
+			caches.append(Cache(f'rigidbody:{scene.name}', f'Rigid Body World ({scene.name})', 0, False,
+				scene.rigidbody_world.point_cache, scene=scene))
+	for obj in bpy.data.objects:
+		for mod in obj.modifiers:
+			name = f'{obj.name}: {mod.name}'
+			if mod.type == 'CLOTH':
+				caches.append(Cache(f'cloth:{obj.name}:{mod.name}', name, 1, True, mod.point_cache, obj))
+			elif mod.type == 'SOFT_BODY':
+				caches.append(Cache(f'softbody:{obj.name}:{mod.name}', name, 1, True, mod.point_cache, obj))
+			elif mod.type == 'PARTICLE_SYSTEM':
+				settings = mod.particle_system.settings
+				if settings.type == 'EMITTER' or settings.physics_type != 'NO':
+					caches.append(Cache(f'particles:{obj.name}:{mod.name}', name, 1, True,
+						mod.particle_system.point_cache, obj))
+			elif mod.type == 'DYNAMIC_PAINT' and mod.canvas_settings is not None:
+				# Brushes may be driven by any of the simulations above
+				for i, surface in enumerate(mod.canvas_settings.canvas_surfaces):
+					if surface.surface_format == 'IMAGE':
+						caches.append(DynamicPaintCache(f'dpaint:{obj.name}:{mod.name}:{surface.name}',
+							f'{name}: {surface.name}', 2, obj, i))
+					else:
+						caches.append(Cache(f'dpaint:{obj.name}:{mod.name}:{surface.name}', f'{name}: {surface.name}',
+							2, True, surface.point_cache, obj))
+			elif mod.type == 'FLUID' and mod.fluid_type == 'DOMAIN':
+				# Flow sources may be particles. The baked state is stored in the blend file, so this runs in finalize
+				caches.append(FluidCache(f'fluid:{obj.name}:{mod.name}', name, 2, False, obj=obj))
+	return caches
+
+
+caches = find_caches()
+by_id = {c.id: c for c in caches}
+failed = []
+
+def try_bake(cache, func):
+	try:
+		func()
+		print(f'Baked {cache.name}')
+		return True
+	except Exception as e:
+		traceback.print_exc()
+		failed.append([cache.id, str(e)])
+		return False
+
+if arg_mode == 'list':
+	with open(argv[1], 'w') as f:
+		json.dump([c.to_dict() for c in caches], f)
+
+elif arg_mode == 'bake':
+	cache = by_id[argv[1]]
+	for dep in sorted(caches, key=lambda c: c.level):
+		if dep.level < cache.level and not dep.parallel:
+			try_bake(dep, dep.bake)
+	# Lower level parallel caches were baked to disk by other processes; reading them needs the disk cache
+	for dep in caches:
+		if dep.level < cache.level and dep.parallel and dep.point_cache is not None:
+			dep.point_cache.use_disk_cache = True
+	try_bake(cache, cache.bake)
+
+elif arg_mode == 'finalize':
+	max_level = int(argv[2])
+	baked = set(argv[3:])
+	for cache in sorted(caches, key=lambda c: c.level):
+		if not cache.parallel:
+			if max_level < 0 or cache.level <= max_level:
+				try_bake(cache, cache.bake)
+		elif cache.id in baked:
+			try_bake(cache, cache.mark_baked)
+	bpy.ops.wm.save_mainfile()
+	with open(argv[1], 'w') as f:
+		json.dump({'failed': failed}, f)
+
+if len(failed) > 0:
+	sys.exit(1)
@@ -0,0 +1,102 @@
+'''
+bdeps
+The python script that is run directly in Blender itself to list the external files a blend file depends on
+Writes a JSON object to the file given as the first argument after "--":
+	{"files": [absolute paths that exist], "missing": [absolute paths that could not be found]}
+
+See brender.py for why fake-bpy-module may be useful for autocomplete. It is NOT required.
+'''
+
+import sys
+import os
+import re
+import json
+
+import bpy
+
+
+# Get the command line arguments
+# See bundle.scan_dependencies() for how command line arguments are passed into this script
+argv = sys.argv
+argv = argv[argv.index("--") + 1:]  # get all args after "--"
+
+# Arg 0: the file to which the JSON result is written
+arg_output = argv[0]
+
+
+files = set()
+missing = set()
+
+def add_file(path):
+	path = os.path.normpath(bpy.path.abspath(path))
+	if os.path.isfile(path):
+		files.add(path)
+	else:
+		missing.add(path)
+
+# Adds every file in a directory (recursively). Used for disk caches, which have no fixed file list
+def add_dir(path):
+	path = os.path.normpath(bpy.path.abspath(path))
+	if not os.path.isdir(path):
+		return
+	for root, dirs, names in os.walk(path):
+		for name in names:
+			files.add(os.path.join(root, name))
+
+# Image sequences only store the first frame, so add all files that differ only by the frame number
+def add_sequence(path):
+	path = os.path.normpath(bpy.path.abspath(path))
+	directory, name = os.path.split(path)
+	match = re.match(r'^(.*?)(\d+)(\.[^.]*)?$', name)
+	if match is None or not os.path.isdir(directory):
+		add_file(path)
+		return
+	prefix, suffix = match.group(1), match.group(3) or ''
+	pattern = re.compile(re.escape(prefix) + r'\d+' + re.escape(suffix) + '$')
+	for other in os.listdir(directory):
+		if pattern.match(other):
+			files.add(os.path.join(directory, other))
+
+
+# Everything Blender itself knows about: images, sounds, movie clips, fonts, libraries, volumes, cache files, etc.
+for path in bpy.utils.blend_paths(absolute=True, packed=False, local=False):
+	add_file(path)
+
+for image in bpy.data.images:
+	if image.packed_file is not None or image.filepath == '':
+		continue
+	if image.source == 'SEQUENCE':
+		add_sequence(image.filepath)
+	elif image.source == 'TILED':
+		for tile in image.tiles:
+			add_file(image.filepath.replace('<UDIM>', str(tile.number)))
+		missing.discard(os.path.normpath(bpy.path.abspath(image.filepath)))
+
+# Point caches only live on disk if use_disk_cache is enabled; they are stored next to the blend file
+blend_dir = os.path.dirname(bpy.data.filepath)
+blend_name = os.path.splitext(os.path.basename(bpy.data.filepath))[0]
+uses_disk_cache = False
+for obj in bpy.data.objects:
+	for mod in obj.modifiers:
+		if mod.type == 'FLUID' and mod.fluid_type == 'DOMAIN':
+			add_dir(mod.domain_settings.cache_directory)
+		cache = None
+		if mod.type in ('CLOTH', 'SOFT_BODY'):
+			cache = mod.point_cache
+		elif mod.type == 'PARTICLE_SYSTEM':
+			cache = mod.particle_system.point_cache
+		if cache is not None and cache.use_disk_cache:
+			uses_disk_cache = True
+			if cache.use_external:
+				add_dir(cache.filepath)
+for scene in bpy.data.scenes:
+	if scene.rigidbody_world is not None and scene.rigidbody_world.point_cache.use_disk_cache:
+		uses_disk_cache = True
+if uses_disk_cache:
+	add_dir(os.path.join(blend_dir, 'blendcache_' + blend_name))
+
+# The blend file itself is shipped separately
+files.discard(os.path.normpath(bpy.data.filepath))
+
+with open(arg_output, 'w') as f:
+	json.dump({'files': sorted(files), 'missing': sorted(missing - files)}, f)
@@ -0,0 +1,232 @@
+import sys
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+import taskfile
+import tasks
+import bgdthread as bgd
+import rendercache
+import oneshot
+
+
+'''
+bench
+Benchmarks the queue with synthetic task loads. Nothing is rendered: fakeblender.py stands in for Blender
+
+Queue benchmarks: for each size N, a queue of N tasks and histories of N completed and N failed tasks are
+generated, then create_task, next_task, add_completed, status and startup are timed, as well as one-shot
+render and status commands (see oneshot.py), which fail the benchmark if they take longer than --oneshot-target
+End-to-end benchmark: tasks are run through a real BgdThread with fakeblender.py, measuring the time between
+one task's process exiting and the next one being launched (scheduling latency) and overall throughput
+
+All files are created in a temporary directory, so the real queue is never touched
+Results can be saved with --save and compared against a previous run with --compare; any operation that
+became slower than --tolerance allows makes the benchmark exit with code 1
+
+Example:
+	python RenderQueue/bench.py --sizes 10000 100000 1000000 --e2e 200 --save baseline.json
+'''
+
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+fakeblender_path = os.path.join(package_dir, 'fakeblender.py')
+
+# msgqueue sends messages to __main__.bgd_thread, which is this module's when running the end-to-end benchmark
+bgd_thread = None
+
+
+# The smallest file is_valid_blend() accepts
+def write_fake_blend(path):
+	with open(path, 'wb') as f:
+		f.write(b'BLENDER-v293ENDB' + bytes(20))
+
+def make_task(i, blend):
+	return taskfile.Task(taskfile.TaskType.RENDER_ANIMATION, [blend], float(i % 3600), {'id': f'{i:012x}'})
+
+def populate(n, blend):
+	taskfile.write_tasks(make_task(i, blend) for i in range(n))
+	taskfile.write_completed(taskfile.CompletedTask(make_task(i, blend)) for i in range(n))
+	taskfile.write_failed(taskfile.FailedTask(make_task(i, blend), 1) for i in range(n))
+
+# The same work as the 'status' command, without printing
+def status_text():
+	lines = []
+	current = taskfile.get_current_task()
+	if current is not None:
+		lines.append(current.desc())
+	for task in taskfile.read_tasks():
+		lines.append(task.desc())
+	for task in taskfile.iter_completed():
+		lines.append(task.desc())
+	for task in taskfile.iter_failed():
+		lines.append(task.desc())
+	return '\n'.join(lines)
+
+# Returns a list of the durations (in seconds) of ops calls of func
+def time_ops(func, ops):
+	durations = []
+	for _ in range(ops):
+		start = time.perf_counter()
+		func()
+		durations.append(time.perf_counter() - start)
+	return durations
+
+def summarize(durations):
+	mean = statistics.mean(durations)
+	return {'mean_s': mean, 'max_s': max(durations), 'ops_per_s': 1 / mean if mean > 0 else float('inf')}
+
+# Time from launching a fresh interpreter to having loaded the queue state
+def time_startup(ops):
+	code = f'import sys; sys.path.insert(0, {package_dir!r}); import bgdthread, taskfile; ' + \
+		'taskfile.get_current_task(); taskfile.num_tasks()'
+	return time_ops(lambda: subprocess.run([sys.executable, '-c', code], check=True), ops)
+
+# Time taken by a one-shot command (see oneshot.py), including starting Python
+def time_oneshot(args, ops):
+	return time_ops(lambda: subprocess.run([sys.executable, package_dir] + args, check=True,
+		stdout=subprocess.DEVNULL), ops)
+
+
+def bench_queue(n, ops, blend):
+	populate(n, blend)
+	results = {}
+	results['create_task'] = summarize(time_ops(
+		lambda: taskfile.create_task(taskfile.TaskType.RENDER_ANIMATION, [blend]), ops))
+	def next_task():
+		taskfile.clear_current_task()
+		taskfile.make_task_current(taskfile.next_task())
+	results['next_task'] = summarize(time_ops(next_task, ops))
+	results['add_completed'] = summarize(time_ops(
+		lambda: taskfile.add_completed(taskfile.CompletedTask(make_task(0, blend))), ops))
+	results['status'] = summarize(time_ops(status_text, max(1, ops // 4)))
+	results['startup'] = summarize(time_startup(max(1, ops // 4)))
+	results['oneshot_render'] = summarize(time_oneshot(['render', blend, 'preview'], max(1, ops // 4)))
+	results['oneshot_status'] = summarize(time_oneshot(['status', '--json', '--limit', '10'], max(1, ops // 4)))
+	taskfile.clear_current_task()
+	return results
+
+
+def bench_end_to_end(n, sleep, fail_rate, blend):
+	global bgd_thread
+	log = os.path.abspath('fakeblender.log')
+	os.environ['LRQ_FAKE_SLEEP'] = str(sleep)
+	os.environ['LRQ_FAKE_FAIL_RATE'] = str(fail_rate)
+	os.environ['LRQ_FAKE_LOG'] = log
+	tasks.blender_path = [sys.executable, fakeblender_path]
+	# Keys would be computed by scanning each file with fakeblender.py, which is not what is being measured
+	rendercache.enabled = False
+	taskfile.clear_tasks()
+	taskfile.clear_completed()
+	taskfile.clear_failed()
+	taskfile.create_tasks([taskfile.Task(taskfile.TaskType.RENDER_ANIMATION, [blend]) for _ in range(n)])
+
+	start = time.perf_counter()
+	bgd_thread = bgd.BgdThread()
+	bgd_thread.start()
+	while taskfile.num_tasks() > 0 or taskfile.get_current_task() is not None:
+		time.sleep(0.01)
+	elapsed = time.perf_counter() - start
+	import msgqueue as msgq
+	msgq.add_message(msgq.MessageType.QUIT)
+	bgd_thread.join()
+
+	with open(log, 'r') as f:
+		runs = sorted(tuple(float(x) for x in line.split()) for line in f)
+	# The gap between one fake render ending and the next one starting
+	latencies = [runs[i + 1][0] - runs[i][1] for i in range(len(runs) - 1)]
+	return {
+		'tasks': n,
+		'failed': len(taskfile.read_failed()),
+		'elapsed_s': elapsed,
+		'throughput_per_s': n / elapsed,
+		'latency_mean_s': statistics.mean(latencies) if len(latencies) > 0 else 0,
+		'latency_max_s': max(latencies) if len(latencies) > 0 else 0,
+	}
+
+
+# Returns a list of (name, mean) for every one-shot command slower than target
+def slow_oneshots(results, target):
+	return [(f'{size}.{name}', r['mean_s']) for size, ops in results.get('queue', {}).items()
+		for name, r in ops.items() if name.startswith('oneshot_') and r['mean_s'] > target]
+
+# Returns a list of (name, old, new) for every mean time that grew by more than tolerance
+def regressions(old, new, tolerance):
+	found = []
+	def walk(prefix, a, b):
+		for key, value in b.items():
+			if key not in a:
+				continue
+			if isinstance(value, dict):
+				walk(prefix + key + '.', a[key], value)
+			elif key in ('mean_s', 'latency_mean_s') and value > a[key] * (1 + tolerance):
+				found.append((prefix + key, a[key], value))
+	walk('', old, new)
+	return found
+
+def print_results(results):
+	for size, ops in results.get('queue', {}).items():
+		print(f'===== {size} tasks =====')
+		for name, r in ops.items():
+			print(f'{name:>14}: {r["mean_s"] * 1000:10.3f} ms mean, {r["max_s"] * 1000:10.3f} ms max, {r["ops_per_s"]:10.1f} ops/s')
+	if 'e2e' in results:
+		r = results['e2e']
+		print(f'===== End to end: {r["tasks"]} tasks =====')
+		print(f'    throughput: {r["throughput_per_s"]:.2f} tasks/s ({r["failed"]} failed)')
+		print(f'       latency: {r["latency_mean_s"] * 1000:.1f} ms mean, {r["latency_max_s"] * 1000:.1f} ms max')
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='bench', description='Benchmarks the render queue with synthetic loads')
+	parser.add_argument('--sizes', type=int, nargs='*', default=[1000, 10000], help='queue/history sizes to test')
+	parser.add_argument('--ops', type=int, default=20, help='operations timed per measurement')
+	parser.add_argument('--e2e', type=int, default=50, help='tasks in the end-to-end benchmark (0 to skip)')
+	parser.add_argument('--sleep', type=float, default=0.0, help='seconds each fake render takes')
+	parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of fake renders that fail')
+	parser.add_argument('--save', help='write the results to this JSON file')
+	parser.add_argument('--compare', help='compare against results previously written with --save')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown when comparing (0.25 = 25%%)')
+	parser.add_argument('--oneshot-target', type=float, default=oneshot.target_s,
+		help='seconds a one-shot command may take (default: %(default)s)')
+	args = parser.parse_args(argv)
+
+	results = {'queue': {}}
+	cwd = os.getcwd()
+	workdir = tempfile.mkdtemp(prefix='lrq-bench-')
+	try:
+		os.chdir(workdir)
+		os.makedirs('tasks')
+		blend = os.path.abspath('bench.blend')
+		write_fake_blend(blend)
+		for n in args.sizes:
+			results['queue'][str(n)] = bench_queue(n, args.ops, blend)
+		if args.e2e > 0:
+			results['e2e'] = bench_end_to_end(args.e2e, args.sleep, args.fail_rate, blend)
+	finally:
+		os.chdir(cwd)
+		shutil.rmtree(workdir, ignore_errors=True)
+
+	print_results(results)
+	if args.save is not None:
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent='\t')
+	slow = slow_oneshots(results, args.oneshot_target)
+	for name, mean in slow:
+		print(f'TOO SLOW: {name} {mean * 1000:.3f} ms (target: {args.oneshot_target * 1000:.0f} ms)')
+	if args.compare is not None:
+		with open(args.compare, 'r') as f:
+			found = regressions(json.load(f), results, args.tolerance)
+		for name, old, new in found:
+			print(f'REGRESSION: {name} {old * 1000:.3f} ms -> {new * 1000:.3f} ms')
+		if len(found) > 0:
+			return 1
+	return 1 if len(slow) > 0 else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
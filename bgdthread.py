@@ -3,10 +3,22 @@ import threading
 import subprocess
 import ctypes
 import time
+import os
 
 import msgqueue as msgq
+import events
 import taskfile
 import tasks
+import fsnotify
+import phases
+import postproc
+import rendercache
+import watchdog
+import preempt
+import verify
+import tiles
+import staging
+import tasklog
 
 '''
 bgdthread
@@ -16,109 +28,314 @@ Also handles the creation of subprocesses that run renders and bakes
 The "Background Thread" is actually made up of 2 threads:
 1. The thread that handles and responds to messages from other threads
 2. The thread that waits for the subprocess to finish and then sends a MessageType.COMPLETE message
+A fsnotify.Watcher also wakes the thread whenever another process changes the task list on disk
+
+Whenever the thread wakes, it checks whether a queued task should preempt the current one (see preempt.py)
+A suspended task keeps its waiting thread, so messages name the process that finished
 '''
 
 
+# A task whose process was stopped to let a more urgent task run (see preempt.py)
+class SuspendedTask:
+	def __init__(self, task, subp, waiting_thread, run_time=0):
+		self.task = task
+		self.subp = subp
+		self.waiting_thread = waiting_thread
+		# The seconds subp ran before it was suspended (see watchdog.py)
+		self.run_time = run_time
+
+
 class BgdThread(threading.Thread):
 	def __init__(self):
 		threading.Thread.__init__(self)
 		self.setName('BgdThread')
 		self.cv = threading.Condition()
+		# Set by notify_thread() so that notifications sent while the thread is busy are not lost
+		self.notified = False
 		self.done = False
 		# When subp is None, a new task is allowed to begin
 		self.subp = None
-		self.last_exit_code = 0
 		self.waiting_thread = None
+		self.watchdog = None
+		# Set by the watchdog if it killed the current task
+		self.stall_reason = None
 		self.start_time = -1
+		# A stack of SuspendedTasks. The most recently suspended task is resumed first
+		self.suspended = []
+		self.queue_watcher = fsnotify.Watcher(os.path.dirname(taskfile.tasklist_filename), self.on_files_changed)
 
 	# The function used by the waiting thread
-	def wait_func(self):
-		self.last_exit_code = ctypes.c_int32(self.subp.wait()).value
-		msgq.add_message(msgq.MessageType.COMPLETE if self.last_exit_code == 0 else msgq.MessageType.FAILED)
+	def wait_func(self, subp):
+		exit_code = ctypes.c_int32(subp.wait()).value
+		# The log is stored before the task is recorded as completed or failed
+		tasklog.finish(subp)
+		msgq.add_message(msgq.MessageType.COMPLETE if exit_code == 0 else msgq.MessageType.FAILED, subp)
 		self.notify_thread()
 
 	# The main background thread function. Must be named 'run'
 	def run(self):
+		self.queue_watcher.start()
+		# Tasks that were suspended when the queue last stopped without quitting properly
+		leftover = preempt.read_suspended()
+		if len(leftover) > 0:
+			taskfile.create_tasks(leftover, 0)
+			preempt.write_suspended([])
 		# done is set to true in killThread
 		while not self.done:
 			# If subp is None, we're allowed to start a new task
 			if self.subp is None:
-				task = taskfile.next_task()
-				if task is not None:
-					self.launch_task(task)
+				if not self.resume_suspended():
+					task = taskfile.next_task()
+					if task is not None and tiles.is_tiled(task):
+						# Its tiles are put at the front of the queue (see tiles.py)
+						tiles.split(task)
+						task = taskfile.next_task()
+					if task is not None:
+						self.launch_task(task)
+			else:
+				self.check_preemption()
 			nextMsg = msgq.next_message()
 			if nextMsg != None:
-				if nextMsg == msgq.MessageType.QUIT:
+				type, arg = nextMsg
+				if type == msgq.MessageType.QUIT:
 					self.quit()
-				elif nextMsg == msgq.MessageType.SKIP:
-					self.skip()
-				elif nextMsg == msgq.MessageType.COMPLETE:
-					self.complete()
-				elif nextMsg == msgq.MessageType.FAILED:
-					self.failed()
+				elif type == msgq.MessageType.SKIP:
+					self.skip(arg)
+				elif type == msgq.MessageType.COMPLETE:
+					self.complete(arg)
+				elif type == msgq.MessageType.FAILED:
+					self.failed(arg)
 			else:
 				# There was no message
+				# Tasks waiting to be retried (see watchdog.py) become ready without a notification
+				retry_time = taskfile.next_retry_time() if self.subp is None else None
 				self.cv.acquire()
-				self.cv.wait()
+				if not self.notified:
+					self.cv.wait(None if retry_time is None else max(0, retry_time - time.time()))
+				self.notified = False
 				self.cv.release()
 
 
 	def launch_task(self, task):
+		rendercache.prepare(task)
+		task.info['log'] = tasklog.log_filename(task.id())
 		taskfile.make_task_current(task)
 		self.subp = tasks.run_task(task)
 		self.start_time = time.perf_counter()
+		self.stall_reason = None
 		if self.subp is not None:
-			self.waiting_thread = threading.Thread(target=BgdThread.wait_func, args=[self])
+			events.publish('started', task=task)
+			self.start_watchdog(task)
+			self.waiting_thread = threading.Thread(target=BgdThread.wait_func, args=[self, self.subp])
 			self.waiting_thread.start()
+			# The next task's files are copied to local scratch while this one renders
+			staging.prefetch(taskfile.peek_task())
+
+	def start_watchdog(self, task, run_time=0):
+		self.watchdog = watchdog.Watchdog(task, self.subp, self.on_stall, run_time)
+		self.watchdog.start()
+
+	# If task is given, the watchdog's measurements are recorded in it
+	def stop_watchdog(self, task=None):
+		if self.watchdog is not None:
+			self.watchdog.stop()
+			if task is not None:
+				self.watchdog.record(task)
+			self.watchdog = None
 		
 				
 	# Call this to tell the thread to check for newly added messages or tasks
 	def notify_thread(self):
 		self.cv.acquire()
+		self.notified = True
 		self.cv.notify_all()
 		self.cv.release()
 
+	# Called by queue_watcher when files in the tasks directory change, possibly from another process
+	def on_files_changed(self, changes):
+		names = [os.path.basename(path) for path, event in changes]
+		if os.path.basename(taskfile.tasklist_filename) in names:
+			self.notify_thread()
+			events.publish('queue_changed')
+
+	# Called by the watchdog (on its own thread) if the task running in subp stalls
+	def on_stall(self, subp, reason):
+		if subp is not self.subp:
+			return
+		self.stall_reason = reason
+		print(f'Task stalled: {reason}')
+		subp.kill()
+
 	def end_subprocess(self):
 		if self.subp is not None:
 			# We have to kill, not terminate; Blender will not stop a render with normal termination
 			self.subp.kill()
-			# TODO: Based on some parameter, either mark this as incomplete or return to task list
+		self.stop_watchdog()
 		if self.waiting_thread is not None and self.waiting_thread.is_alive():
 			self.waiting_thread.join()
+		self.waiting_thread = None
+		# The waiting thread's message is ignored, since subp is no longer the current process
+		self.subp = None
+
+
+	# Suspends or requeues the current task if a queued task has a higher priority
+	def check_preemption(self):
+		task = taskfile.get_current_task()
+		highest = taskfile.highest_priority()
+		if task is None or highest is None or highest <= preempt.priority(task):
+			return
+		self.stop_timer(task)
+		if preempt.can_suspend(self.subp):
+			print(f'Suspending "{task.args[0]}" for a task with priority {highest}')
+			run_time = self.watchdog.elapsed() if self.watchdog is not None else 0
+			self.stop_watchdog(task)
+			preempt.suspend(self.subp)
+			self.suspended.append(SuspendedTask(task, self.subp, self.waiting_thread, run_time))
+			preempt.write_suspended([s.task for s in self.suspended])
+			self.subp = None
 			self.waiting_thread = None
+			events.publish('suspended', task=task)
+		else:
+			print(f'Requeueing "{task.args[0]}" for a task with priority {highest}')
+			self.end_subprocess()
+			preempt.skip_written_frames(task)
+			# The task's timing events are kept, so the next run adds to them
+			taskfile.create_tasks([task], 0)
+			events.publish('requeued', task=task, reason='preempted')
+		taskfile.clear_current_task()
+
+	# Resumes the most recently suspended task, unless a queued task has a higher priority
+	# Returns whether a task was resumed
+	def resume_suspended(self):
+		if len(self.suspended) == 0:
+			return False
+		s = self.suspended[-1]
+		highest = taskfile.highest_priority()
+		if highest is not None and highest > preempt.priority(s.task):
+			return False
+		self.suspended.pop()
+		preempt.write_suspended([s.task for s in self.suspended])
+		print(f'Resuming "{s.task.args[0]}"')
+		taskfile.make_task_current(s.task)
+		self.subp = s.subp
+		self.waiting_thread = s.waiting_thread
+		self.start_time = time.perf_counter()
+		self.stall_reason = None
+		preempt.resume(self.subp)
+		self.start_watchdog(s.task, s.run_time)
+		events.publish('started', task=s.task, resumed=True)
+		return True
+
+	# Returns the task that was running in subp, and stops tracking it
+	# Returns None if subp was already ended (e.g. by skip())
+	# If subp was the current process, the caller must clear the current task once it has recorded the result
+	def take_finished(self, subp):
+		if subp is self.subp:
+			task = taskfile.get_current_task()
+			self.stop_timer(task)
+			self.stop_watchdog(task)
+			self.subp = None
+			self.waiting_thread = None
+			return task
+		for s in self.suspended:
+			# A suspended process can still be killed by someone else
+			if s.subp is subp:
+				self.suspended.remove(s)
+				preempt.write_suspended([s.task for s in self.suspended])
+				return s.task
+		return None
 
 
 	def quit(self):
 		self.done = True
+		self.queue_watcher.stop()
 		# End the subprocess if necessary
 		task = taskfile.get_current_task()
 		if task is not None:
 			self.stop_timer(task)
-			# Rewrite the current task file, since the time changed
-			taskfile.make_task_current(task)
 		self.end_subprocess()
+		if task is not None:
+			preempt.skip_written_frames(task)
+			# Rewrite the current task file, since the time and frames changed
+			taskfile.make_task_current(task)
+		# Suspended tasks go back to the front of the queue, most recently suspended last
+		for s in self.suspended:
+			preempt.resume(s.subp)
+			s.subp.kill()
+			s.waiting_thread.join()
+			preempt.skip_written_frames(s.task)
+		if len(self.suspended) > 0:
+			taskfile.create_tasks([s.task for s in self.suspended], 0)
+			self.suspended = []
+			preempt.write_suspended([])
+		postproc.stop()
 
-	def skip(self):
+	# Ends the current task. If index is None, it is discarded; otherwise it is re-inserted into the queue at index
+	def skip(self, index=None):
 		task = taskfile.get_current_task()
 		if task is not None:
 			self.stop_timer(task)
 		self.end_subprocess()
 		taskfile.clear_current_task()
+		if task is None:
+			return
+		if index is None:
+			phases.attach(task)
+			events.publish('discarded', task=task)
+		else:
+			# The task's timing events are kept, so the next run adds to them
+			taskfile.create_tasks([task], index)
+			events.publish('requeued', task=task, reason='skipped')
 
-	def complete(self):
-		self.subp = None
-		task = taskfile.get_current_task()
-		self.stop_timer(task)
-		taskfile.add_completed(taskfile.CompletedTask(task))
-		taskfile.clear_current_task()
+	def complete(self, subp):
+		current = subp is self.subp
+		task = self.take_finished(subp)
+		if task is None:
+			return
+		expected = verify.expected(task)
+		outputs = phases.attach(task)
+		rerender = verify.verify(task, expected) if expected is not None else None
+		if 'bad_frames' not in task.info:
+			rendercache.store(task, outputs)
+			if 'tile' in task.info:
+				tiles.tile_done(task, outputs)
+			elif 'stitch' in task.info:
+				tiles.stitched(task)
+		completed = taskfile.CompletedTask(task)
+		taskfile.add_completed(completed)
+		events.publish('completed', task=completed)
+		if rerender is not None:
+			verify.requeue(rerender)
+		if current:
+			taskfile.clear_current_task()
+		# Post-processing runs in its own workers; the next task is launched as soon as this returns
+		# If frames are rendered again, the task that renders them post-processes the whole sequence
+		if len(task.info.get('post', [])) > 0 and rerender is None:
+			postproc.submit(task, task.info.get('post_outputs', outputs))
 
-	def failed(self):
-		self.subp = None
+	def failed(self, subp):
+		current = subp is self.subp
+		stall_reason = self.stall_reason if current else None
+		task = self.take_finished(subp)
+		if task is None:
+			return
 		print('Failed')
-		task = taskfile.get_current_task()
-		self.stop_timer(task)
-		taskfile.add_failed(taskfile.FailedTask(task, self.last_exit_code))
-		taskfile.clear_current_task()
+		# Bake jobs report which caches failed
+		failures = getattr(subp, 'failures', [])
+		if len(failures) > 0:
+			task.info['failed_caches'] = failures
+		# Retried tasks keep their timing events, so the next run adds to them
+		if stall_reason is not None and watchdog.retry(task, stall_reason):
+			events.publish('requeued', task=task, reason=stall_reason)
+		else:
+			phases.attach(task)
+			failed = taskfile.FailedTask(task, ctypes.c_int32(subp.returncode).value)
+			taskfile.add_failed(failed)
+			events.publish('failed', task=failed)
+			if 'tile' in task.info:
+				tiles.tile_failed(task)
+		if current:
+			taskfile.clear_current_task()
 
 
 	def stop_timer(self, task):
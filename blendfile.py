@@ -0,0 +1,293 @@
+import os
+import re
+import mmap
+import gzip
+import struct
+from functools import lru_cache
+from pathlib import Path
+
+
+'''
+blendfile
+Reads metadata (frame range, render engine, resolution, output path) directly from .blend files
+without launching Blender. This makes validation, chunking and ETA estimates cheap at submission time
+
+A .blend file is a header followed by blocks ("BHeads"), ending with an ENDB block
+The DNA1 block describes the layout of every struct (SDNA), which is used to find fields of the Scene block
+Uncompressed files are read through mmap; gzip and zstd compressed files are decompressed in memory
+zstd requires either the "zstandard" package or Python 3.14+. Without either, compressed files are unsupported
+
+Results are cached by (path, mtime, size)
+'''
+
+
+# Bytes at the start of compressed blend files
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+BLEND_MAGIC = b'BLENDER'
+
+# The number of results kept by read_info()'s cache
+CACHE_SIZE = 256
+
+
+class BlendFileError(Exception):
+	pass
+
+
+# Metadata of the active scene of a blend file
+class BlendInfo:
+	def __init__(self):
+		self.version = 0
+		self.scene = ''
+		self.frame_start = 1
+		self.frame_end = 1
+		self.frame_step = 1
+		self.fps = 24.0
+		self.engine = ''
+		self.resolution_x = 0
+		self.resolution_y = 0
+		self.resolution_percentage = 100
+		self.output_path = ''
+
+	def num_frames(self):
+		if self.frame_end < self.frame_start or self.frame_step <= 0:
+			return 0
+		return (self.frame_end - self.frame_start) // self.frame_step + 1
+
+	# The resolution actually rendered, after applying the percentage
+	def resolution(self):
+		return (self.resolution_x * self.resolution_percentage // 100,
+			self.resolution_y * self.resolution_percentage // 100)
+
+	def desc(self):
+		x, y = self.resolution()
+		return f'Blender {self.version // 100}.{self.version % 100}, scene "{self.scene}"' + \
+			f'\n\t- Frames: {self.frame_start}-{self.frame_end} (step {self.frame_step}, {self.num_frames()} total, {self.fps:g} fps)' + \
+			f'\n\t- Engine: {self.engine}' + \
+			f'\n\t- Resolution: {x}x{y} ({self.resolution_percentage}%)' + \
+			f'\n\t- Output: {self.output_path}'
+
+
+# Utility: returns the decompressed contents of a zstd file, or raises BlendFileError if zstd is unavailable
+def zstd_decompress(f):
+	try:
+		import zstandard
+		with zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True) as reader:
+			return reader.read()
+	except ImportError:
+		pass
+	try:
+		from compression import zstd
+		return zstd.decompress(f.read())
+	except ImportError:
+		raise BlendFileError('zstd compressed blend files require the "zstandard" package')
+
+
+# Wraps the raw bytes of a blend file and walks its blocks
+class BlendReader:
+	def __init__(self, data):
+		self.data = data
+		self.parse_header()
+		self.sdna_names = None
+		self.sdna_types = None
+		self.sdna_lengths = None
+		# struct name -> list of (type name, field name)
+		self.sdna_structs = None
+
+	def parse_header(self):
+		data = self.data
+		if data[:7] != BLEND_MAGIC:
+			raise BlendFileError('Not a blend file')
+		if data[7:9].isdigit():
+			# Large BHead format (Blender 5.0+): "BLENDER17-01v0500"
+			header_size = int(data[7:9])
+			self.pointer_size = 8
+			self.large_bhead = True
+			self.endian = '<' if data[12:13] == b'v' else '>'
+			self.version = int(data[13:header_size])
+		else:
+			# Legacy format: "BLENDER_v293"
+			header_size = 12
+			self.pointer_size = 4 if data[7:8] == b'_' else 8
+			self.large_bhead = False
+			self.endian = '<' if data[8:9] == b'v' else '>'
+			self.version = int(data[9:12])
+		self.header_size = header_size
+		e, p = self.endian, ('I' if self.pointer_size == 4 else 'Q')
+		if self.large_bhead:
+			# code, SDNAnr, old pointer, length, count
+			self.bhead = struct.Struct(e + '4siQqq')
+		else:
+			# code, length, old pointer, SDNAnr, count
+			self.bhead = struct.Struct(e + '4si' + p + 'ii')
+
+	# Yields (code, old pointer, SDNA index, data offset, data length) for every block
+	def blocks(self):
+		offset = self.header_size
+		data, bhead = self.data, self.bhead
+		end = len(data)
+		while offset + bhead.size <= end:
+			fields = bhead.unpack_from(data, offset)
+			if self.large_bhead:
+				code, sdna, old, length, _ = fields
+			else:
+				code, length, old, sdna, _ = fields
+			offset += bhead.size
+			if code == b'ENDB':
+				return
+			yield code, old, sdna, offset, length
+			offset += length
+
+	def parse_sdna(self, offset):
+		data, e = self.data, self.endian
+		# Sections are 4-byte aligned relative to the start of the SDNA, not the file
+		def align(o):
+			return offset + ((o - offset + 3) & ~3)
+		def read_strings(o, count):
+			strings = []
+			for _ in range(count):
+				end = data.find(b'\0', o)
+				if end < 0:
+					raise BlendFileError('Malformed SDNA')
+				strings.append(bytes(data[o:end]).decode('latin-1'))
+				o = end + 1
+			return strings, o
+		if data[offset:offset + 8] != b'SDNANAME':
+			raise BlendFileError('Malformed SDNA')
+		count, = struct.unpack_from(e + 'i', data, offset + 8)
+		self.sdna_names, o = read_strings(offset + 12, count)
+		o = align(o)
+		count, = struct.unpack_from(e + 'i', data, o + 4)
+		self.sdna_types, o = read_strings(o + 8, count)
+		o = align(o)
+		self.sdna_lengths = struct.unpack_from(e + f'{count}h', data, o + 4)
+		o = align(o + 4 + 2 * count)
+		count, = struct.unpack_from(e + 'i', data, o + 4)
+		o += 8
+		self.sdna_structs = {}
+		for _ in range(count):
+			type_index, nfields = struct.unpack_from(e + 'hh', data, o)
+			fields = struct.unpack_from(e + f'{2 * nfields}h', data, o + 4)
+			o += 4 + 4 * nfields
+			name = self.sdna_types[type_index]
+			self.sdna_structs[name] = [(self.sdna_types[fields[i]], self.sdna_names[fields[i + 1]])
+				for i in range(0, len(fields), 2)]
+
+	def load_sdna(self):
+		for code, old, sdna, offset, length in self.blocks():
+			if code == b'DNA1':
+				self.parse_sdna(offset)
+				return
+		raise BlendFileError('No DNA1 block')
+
+	# Returns the size in bytes of a field given its type and (decorated) name, e.g. "*next", "name[64]"
+	def field_size(self, type_name, field_name):
+		count = 1
+		for dim in re.findall(r'\[(\d+)\]', field_name):
+			count *= int(dim)
+		if field_name.startswith('*') or field_name.startswith('('):
+			return self.pointer_size * count
+		return self.sdna_lengths[self.sdna_types.index(type_name)] * count
+
+	# Returns (offset, type name, field name, size) of a field within a struct, following nested structs
+	# path is a list of undecorated field names, e.g. ['r', 'sfra']
+	def field(self, struct_name, path):
+		offset = 0
+		for i, wanted in enumerate(path):
+			for type_name, field_name in self.sdna_structs[struct_name]:
+				bare = re.sub(r'\[\d+\]', '', field_name).lstrip('*')
+				if bare == wanted:
+					if i == len(path) - 1:
+						return offset, type_name, field_name, self.field_size(type_name, field_name)
+					struct_name = type_name
+					break
+				offset += self.field_size(type_name, field_name)
+			else:
+				raise BlendFileError(f'No field {".".join(path)}')
+
+	def read_int(self, block_offset, struct_name, path):
+		offset, type_name, field_name, size = self.field(struct_name, path)
+		fmt = {'char': 'b', 'uchar': 'B', 'short': 'h', 'ushort': 'H', 'int': 'i', 'float': 'f'}[type_name]
+		return struct.unpack_from(self.endian + fmt, self.data, block_offset + offset)[0]
+
+	def read_string(self, block_offset, struct_name, path):
+		offset, type_name, field_name, size = self.field(struct_name, path)
+		raw = bytes(self.data[block_offset + offset:block_offset + offset + size])
+		return raw.split(b'\0', 1)[0].decode('utf-8', errors='replace')
+
+	def read_pointer(self, block_offset, struct_name, path):
+		offset, type_name, field_name, size = self.field(struct_name, path)
+		return struct.unpack_from(self.endian + ('I' if self.pointer_size == 4 else 'Q'), self.data, block_offset + offset)[0]
+
+	def info(self) -> BlendInfo:
+		self.load_sdna()
+		curscene = None
+		scenes = []
+		for code, old, sdna, offset, length in self.blocks():
+			if code == b'GLOB':
+				curscene = self.read_pointer(offset, 'FileGlobal', ['curscene'])
+			elif code == b'SC\0\0':
+				scenes.append((old, offset))
+		if len(scenes) == 0:
+			raise BlendFileError('No scenes')
+		offset = next((o for old, o in scenes if old == curscene), scenes[0][1])
+		info = BlendInfo()
+		info.version = self.version
+		info.scene = self.read_string(offset, 'Scene', ['id', 'name'])[2:]
+		info.frame_start = self.read_int(offset, 'Scene', ['r', 'sfra'])
+		info.frame_end = self.read_int(offset, 'Scene', ['r', 'efra'])
+		info.frame_step = self.read_int(offset, 'Scene', ['r', 'frame_step'])
+		try:
+			info.fps = self.read_int(offset, 'Scene', ['r', 'frs_sec']) / self.read_int(offset, 'Scene', ['r', 'frs_sec_base'])
+		except (BlendFileError, ZeroDivisionError):
+			# Kept at the default. Only used for encoding videos after rendering (see postproc.py)
+			pass
+		info.engine = self.read_string(offset, 'Scene', ['r', 'engine'])
+		info.resolution_x = self.read_int(offset, 'Scene', ['r', 'xsch'])
+		info.resolution_y = self.read_int(offset, 'Scene', ['r', 'ysch'])
+		info.resolution_percentage = self.read_int(offset, 'Scene', ['r', 'size'])
+		info.output_path = self.read_string(offset, 'Scene', ['r', 'pic'])
+		return info
+
+
+# Returns whether the file starts with a (possibly compressed) blend file header. Reads only a few bytes
+def has_blend_header(path):
+	try:
+		with open(path, 'rb') as f:
+			magic = f.read(4)
+			f.seek(0)
+			if magic[:2] == GZIP_MAGIC:
+				with gzip.GzipFile(fileobj=f) as g:
+					return g.read(7) == BLEND_MAGIC
+			if magic == ZSTD_MAGIC:
+				# Decompressing part of a frame needs the optional zstd module, so trust the magic
+				return True
+			return f.read(7) == BLEND_MAGIC
+	except (OSError, EOFError):
+		return False
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def cached_info(path, mtime_ns, size):
+	with open(path, 'rb') as f:
+		magic = f.read(4)
+		f.seek(0)
+		if magic[:2] == GZIP_MAGIC:
+			return BlendReader(gzip.decompress(f.read())).info()
+		if magic == ZSTD_MAGIC:
+			return BlendReader(zstd_decompress(f)).info()
+		if size == 0:
+			raise BlendFileError('Empty file')
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+			return BlendReader(m).info()
+
+
+# Returns the BlendInfo of the given blend file, or None if it could not be read
+def read_info(path):
+	path = Path(path).absolute()
+	try:
+		st = os.stat(path)
+		return cached_info(str(path), st.st_mtime_ns, st.st_size)
+	except (OSError, EOFError, BlendFileError, struct.error, KeyError, ValueError, IndexError) as e:
+		print(f'Could not read blend file "{path}": {e}')
+		return None
@@ -0,0 +1,85 @@
+'''
+bpost
+The python script that is run directly in Blender itself to post-process rendered images (see postproc.py)
+Blender is started without a blend file. The only argument after "--" is a JSON file with a "mode" and:
+
+encode: "output", "fps" and "frames" (paths of images in one directory, in order)
+	Adds the frames to the sequencer of an empty scene and renders it as an H.264 video to output
+thumbnails: "size" and "images" (a list of [image path, thumbnail path])
+	Scales each image so its longest side is size pixels and saves it as a JPEG
+
+Exits with code 1 if anything failed. See brender.py for why fake-bpy-module may be useful for autocomplete
+'''
+
+import sys
+import os
+import json
+import traceback
+
+import bpy
+
+
+# Get the command line arguments
+# See postproc.py for how command line arguments are passed into this script
+argv = sys.argv
+argv = argv[argv.index("--") + 1:]  # get all args after "--"
+
+with open(argv[0], 'r') as f:
+	args = json.load(f)
+
+
+def encode(output, fps, frames):
+	scene = bpy.context.scene
+	# Use the size of the frames rather than the default scene's
+	first = bpy.data.images.load(frames[0])
+	scene.render.resolution_x, scene.render.resolution_y = first.size
+	scene.render.resolution_percentage = 100
+	bpy.data.images.remove(first)
+	# Fractional frame rates (e.g. 29.97) are stored as fps / fps_base
+	scene.render.fps = round(fps)
+	scene.render.fps_base = round(fps) / fps
+
+	editor = scene.sequence_editor_create()
+	# Renamed in Blender 4.4
+	strips = editor.strips if hasattr(editor, 'strips') else editor.sequences
+	strip = strips.new_image('Frames', frames[0], 1, 1)
+	for frame in frames[1:]:
+		strip.elements.append(os.path.basename(frame))
+	scene.frame_start = 1
+	scene.frame_end = len(frames)
+
+	scene.render.image_settings.file_format = 'FFMPEG'
+	scene.render.ffmpeg.format = 'MPEG4'
+	scene.render.ffmpeg.codec = 'H264'
+	scene.render.ffmpeg.constant_rate_factor = 'HIGH'
+	scene.render.use_sequencer = True
+	scene.render.filepath = output
+	# Blender adds the frame range to file names unless the name has an extension
+	scene.render.use_file_extension = False
+	bpy.ops.render.render(animation=True)
+
+def thumbnails(size, images):
+	for path, output in images:
+		image = bpy.data.images.load(path)
+		width, height = image.size
+		scale = size / max(width, height, 1)
+		if scale < 1:
+			image.scale(max(1, round(width * scale)), max(1, round(height * scale)))
+		os.makedirs(os.path.dirname(output), exist_ok=True)
+		image.filepath_raw = output
+		image.file_format = 'JPEG'
+		image.save()
+		bpy.data.images.remove(image)
+
+
+# Blender exits with code 0 even if a script raises, so failures are turned into an exit code here
+try:
+	if args['mode'] == 'encode':
+		encode(args['output'], args['fps'], args['frames'])
+	elif args['mode'] == 'thumbnails':
+		thumbnails(args['size'], args['images'])
+	else:
+		raise ValueError(f"Unknown mode: {args['mode']}")
+except Exception:
+	traceback.print_exc()
+	sys.exit(1)
@@ -0,0 +1,118 @@
+'''
+bremap
+The python script that is run directly in Blender itself on a blend file received in a bundle (see lan.py),
+to point it at the received copies of its dependencies instead of their paths on the sending machine
+Reads a JSON object from the file given as the first argument after "--":
+	{"blend": the blend file's original path, "files": {original path: received path, ...}}
+Paths of directories (image sequences, disk caches) are mapped through the directories of the received files
+Paths that are not in the bundle are left as they are. The file is saved in place
+
+See brender.py for why fake-bpy-module may be useful for autocomplete. It is NOT required.
+'''
+
+import sys
+import os
+import json
+import ntpath
+import posixpath
+
+import bpy
+
+
+# Get the command line arguments
+# See bundle.remap_received() for how command line arguments are passed into this script
+argv = sys.argv
+argv = argv[argv.index("--") + 1:]  # get all args after "--"
+
+# Arg 0: the file from which the JSON arguments are read
+with open(argv[0], 'r') as f:
+	args = json.load(f)
+
+# The sending machine may use the other kind of paths
+original_path = ntpath if args['blend'][1:3] == ':\\' or args['blend'].startswith('\\\\') else posixpath
+original_dir = original_path.dirname(args['blend'])
+
+files = {original_path.normpath(k): v for k, v in args['files'].items()}
+# Original directory -> received directory, for every directory that still has the same relative layout
+dirs = {}
+for original, received in files.items():
+	while True:
+		head, name = original_path.split(original)
+		received_head, received_name = os.path.split(received)
+		if name == '' or name != received_name or head == original:
+			break
+		original, received = head, received_head
+		dirs[original] = received
+
+
+# Returns the received path for the given path, as stored in the blend file, or None if it was not received
+# The received path of a file may not exist if it has a placeholder, e.g. <UDIM>, but its directory does
+def remap(path):
+	if path.startswith('//'):
+		path = original_path.join(original_dir, path[2:])
+	path = original_path.normpath(path)
+	if path in files:
+		return files[path]
+	rest = []
+	while path not in dirs:
+		head, name = original_path.split(path)
+		if head == path:
+			return None
+		rest.insert(0, name)
+		path = head
+	received = os.path.join(dirs[path], *rest)
+	return received if os.path.isdir(os.path.dirname(received)) else None
+
+changed = 0
+
+# directory is whether the path is of a directory that Blender expects to end with a separator
+def remap_attr(owner, attr, directory=False):
+	global changed
+	path = getattr(owner, attr)
+	if path == '':
+		return
+	received = remap(path)
+	if received is None:
+		return
+	if directory:
+		received = os.path.join(received, '')
+	if received != path:
+		setattr(owner, attr, received)
+		changed += 1
+
+
+# The same files as bdeps.py lists
+for collection in (bpy.data.images, bpy.data.sounds, bpy.data.movieclips, bpy.data.volumes, bpy.data.cache_files):
+	for block in collection:
+		if getattr(block, 'packed_file', None) is None:
+			remap_attr(block, 'filepath')
+for font in bpy.data.fonts:
+	if font.packed_file is None and font.filepath != '<builtin>':
+		remap_attr(font, 'filepath')
+for library in bpy.data.libraries:
+	remap_attr(library, 'filepath')
+
+for scene in bpy.data.scenes:
+	if scene.sequence_editor is None:
+		continue
+	for strip in scene.sequence_editor.sequences_all:
+		if strip.type == 'IMAGE':
+			remap_attr(strip, 'directory', True)
+		elif strip.type == 'MOVIE':
+			remap_attr(strip, 'filepath')
+
+for obj in bpy.data.objects:
+	for mod in obj.modifiers:
+		if mod.type == 'FLUID' and mod.fluid_type == 'DOMAIN':
+			remap_attr(mod.domain_settings, 'cache_directory')
+		cache = None
+		if mod.type in ('CLOTH', 'SOFT_BODY'):
+			cache = mod.point_cache
+		elif mod.type == 'PARTICLE_SYSTEM':
+			cache = mod.particle_system.point_cache
+		if cache is not None and cache.use_disk_cache and cache.use_external:
+			remap_attr(cache, 'filepath')
+
+print(f'Remapped {changed} path(s)')
+if changed > 0:
+	bpy.ops.wm.save_mainfile()
@@ -11,6 +11,10 @@ This is NOT required to use the render queue.
 '''
 
 import sys
+import os
+import time
+import json
+import argparse
 
 import bpy
 
@@ -20,9 +24,83 @@ import bpy
 argv = sys.argv
 argv = argv[argv.index("--") + 1:]  # get all args after "--"
 
-# Parse command line arguments. This must match tasks.render_animation() and tasks.render_still()
+# Parse command line arguments. This must match tasks.brender_args()
 # Arg 0: whether to render an animation (if false, then this is a still image)
-arg_animation = bool(int(argv[0]))
+# --launch-time: the wall clock time at which the queue launched Blender
+# --phases: the file to which timing events are appended, one JSON object per line (see phases.py)
+parser = argparse.ArgumentParser(prog='brender')
+parser.add_argument('animation', type=int)
+parser.add_argument('--launch-time', type=float, default=None)
+parser.add_argument('--phases', default=None)
+# --overrides: a JSON object of render settings to change before rendering (see tasks.OVERRIDES)
+parser.add_argument('--overrides', default='{}')
+# --frames: a comma separated list of frames to render instead of the whole animation (see verify.py)
+parser.add_argument('--frames', default=None)
+# --tile: "x,y,columns,rows" to render only that tile of a still, saved to --tile-output (see tiles.py)
+parser.add_argument('--tile', default=None)
+parser.add_argument('--tile-output', default=None)
+# --stitch: a JSON file listing tile images to combine into the still instead of rendering it (see tiles.py)
+parser.add_argument('--stitch', default=None)
+# --original-file: the queued blend file, if Blender loaded a staged copy of it (see staging.py)
+parser.add_argument('--original-file', default=None)
+args = parser.parse_args(argv)
+arg_animation = bool(args.animation)
+arg_overrides = json.loads(args.overrides)
+arg_frames = [int(f) for f in args.frames.split(',')] if args.frames is not None else None
+arg_tile = [int(i) for i in args.tile.split(',')] if args.tile is not None else None
+
+
+
+# Timing events. Each event is written (and flushed) immediately so the queue can follow progress
+phases_file = open(args.phases, 'a') if args.phases is not None else None
+
+def emit(event, **data):
+	if phases_file is None:
+		return
+	data['event'] = event
+	data['t'] = time.time()
+	phases_file.write(json.dumps(data) + '\n')
+	phases_file.flush()
+
+# tasks.STARTUP_EXPR records when Blender finished starting up, before it loaded the blend file
+startup_time = os.environ.get('LRQ_STARTUP_TIME', None)
+if phases_file is not None and startup_time is not None:
+	phases_file.write(json.dumps({'event': 'startup', 't': float(startup_time), 'launch': args.launch_time}) + '\n')
+emit('loaded')
+
+# Render stats strings (e.g. "Fra:1 Mem:10M | Building BVH") tell us which stage a frame is in
+# Only the first occurrence of each stage per frame is emitted
+stat_stages = [('BVH', 'bvh'), ('Sample', 'sample'), ('Rendering', 'sample'), ('Rendered', 'sample')]
+seen_stages = set()
+
+def on_render_init(*args):
+	emit('init')
+
+def on_render_pre(scene, *args):
+	seen_stages.clear()
+	emit('frame_pre', frame=scene.frame_current)
+
+def on_render_stats(stats, *args):
+	for marker, stage in stat_stages:
+		if marker in stats and stage not in seen_stages:
+			seen_stages.add(stage)
+			emit(stage, frame=bpy.context.scene.frame_current)
+
+def on_render_post(scene, *args):
+	emit('frame_post', frame=scene.frame_current)
+
+def on_render_write(scene, *args):
+	emit('write', frame=scene.frame_current, path=bpy.path.abspath(scene.render.frame_path(frame=scene.frame_current)))
+
+def on_render_complete(*args):
+	emit('complete')
+
+bpy.app.handlers.render_init.append(on_render_init)
+bpy.app.handlers.render_pre.append(on_render_pre)
+bpy.app.handlers.render_stats.append(on_render_stats)
+bpy.app.handlers.render_post.append(on_render_post)
+bpy.app.handlers.render_write.append(on_render_write)
+bpy.app.handlers.render_complete.append(on_render_complete)
 
 
 
@@ -59,10 +137,141 @@ arg_animation = bool(int(argv[0]))
 #enable_gpus("CUDA")
 
 
+# Apply per-task overrides. Setting names differ between Blender versions and engines,
+# so an override that cannot be applied is reported instead of failing the render
+def apply_override(scene, key, value):
+	render = scene.render
+	if key == 'samples':
+		if render.engine == 'CYCLES':
+			scene.cycles.samples = value
+		else:
+			scene.eevee.taa_render_samples = value
+	elif key == 'adaptive_threshold':
+		scene.cycles.use_adaptive_sampling = True
+		scene.cycles.adaptive_threshold = value
+	elif key == 'resolution_percentage':
+		render.resolution_percentage = value
+	elif key == 'denoiser':
+		scene.cycles.use_denoising = value != 'OFF'
+		if value != 'OFF':
+			scene.cycles.denoiser = value
+	elif key == 'tile_size':
+		if hasattr(scene.cycles, 'tile_size'):
+			scene.cycles.tile_size = value
+		else:
+			render.tile_x = value
+			render.tile_y = value
+	elif key == 'threads':
+		render.threads_mode = 'FIXED'
+		render.threads = value
+	elif key == 'frame_start':
+		scene.frame_start = value
+	elif key == 'frame_end':
+		scene.frame_end = value
+	elif key == 'frame_step':
+		scene.frame_step = value
+	elif key == 'file_format':
+		render.image_settings.file_format = value
+	else:
+		raise KeyError(key)
+
+for key, value in arg_overrides.items():
+	try:
+		apply_override(bpy.context.scene, key, value)
+	except (AttributeError, TypeError, KeyError, ValueError) as e:
+		print(f'Could not apply override {key}={value}: {e}')
+
+# Outputs relative to the blend file are written next to the queued file, not the staged copy,
+# or for a task from a LAN server, where the server would write them (see lan.py)
+if args.original_file is not None and bpy.context.scene.render.filepath.startswith('//'):
+	bpy.context.scene.render.filepath = bpy.path.abspath(bpy.context.scene.render.filepath,
+		start=os.path.dirname(args.original_file))
+
 # TODO: Check output format, directory, etc.
 
-# Disable file overwriting so that resuming renders does not redundantly re-render frames
-bpy.context.scene.render.use_overwrite = False
+# Disable file overwriting so that existing frames are not redundantly re-rendered
+# With overrides (e.g. a preset), existing frames may have been rendered with other settings, such as a preview
+# render of the same file to the same output path, so every frame is rendered again. A task that was killed
+# part way (see preempt.py) is only given the frames it has not written yet (--frames), so they are kept
+bpy.context.scene.render.use_overwrite = len(arg_overrides) > 0
+
+scene = bpy.context.scene
+
+def frame_path(frame):
+	return bpy.path.abspath(scene.render.frame_path(frame=frame))
+
+# Combines tile images into one image of the full resolution, written to path with the scene's file format
+# Tiles are placed where their render border was (see the tile setup below)
+def stitch(tiles, path):
+	import numpy
+	render = scene.render
+	width = render.resolution_x * render.resolution_percentage // 100
+	height = render.resolution_y * render.resolution_percentage // 100
+	canvas = numpy.zeros((height, width, 4), dtype=numpy.float32)
+	is_float = False
+	colorspace = None
+	for tile in tiles:
+		x, y, columns, rows = tile['tile']
+		image = bpy.data.images.load(tile['path'])
+		w, h = image.size
+		pixels = numpy.empty(w * h * 4, dtype=numpy.float32)
+		image.pixels.foreach_get(pixels)
+		is_float = is_float or image.is_float
+		colorspace = image.colorspace_settings.name
+		# Pixels are stored bottom row first, as borders are measured
+		x0, y0 = int(x * width / columns), int(y * height / rows)
+		cw, ch = min(w, width - x0), min(h, height - y0)
+		canvas[y0:y0 + ch, x0:x0 + cw] = pixels.reshape(h, w, 4)[:ch, :cw]
+		bpy.data.images.remove(image)
+	result = bpy.data.images.new('Stitched', width, height, alpha=True, float_buffer=is_float)
+	if colorspace is not None:
+		result.colorspace_settings.name = colorspace
+	result.pixels.foreach_set(canvas.ravel())
+	result.filepath_raw = path
+	result.file_format = render.image_settings.file_format
+	result.save()
+
+if arg_tile is not None:
+	# Only the tile's region is rendered, and the image is cropped to it
+	x, y, columns, rows = arg_tile
+	scene.render.use_border = True
+	scene.render.use_crop_to_border = True
+	scene.render.border_min_x = x / columns
+	scene.render.border_max_x = (x + 1) / columns
+	scene.render.border_min_y = y / rows
+	scene.render.border_max_y = (y + 1) / rows
+	tile_output = args.tile_output + scene.render.file_extension
+
+# The images that should exist once the render completes, so they can be checked (see verify.py)
+# Movie files are written as a whole and cannot be checked frame by frame
+if arg_tile is not None:
+	emit('expected', frames=[[scene.frame_current, tile_output]])
+elif arg_frames is not None:
+	expected = arg_frames
+elif arg_animation:
+	expected = list(range(scene.frame_start, scene.frame_end + 1, max(scene.frame_step, 1)))
+else:
+	expected = [scene.frame_current]
+if arg_tile is None and not scene.render.is_movie_format:
+	emit('expected', frames=[[frame, frame_path(frame)] for frame in expected])
 
 # Begin the render
-bpy.ops.render.render(animation=arg_animation, write_still=True)
\ No newline at end of file
+if args.stitch is not None:
+	with open(args.stitch, 'r') as f:
+		stitch(json.load(f), frame_path(scene.frame_current))
+	emit('write', frame=scene.frame_current, path=frame_path(scene.frame_current))
+elif arg_tile is not None:
+	bpy.ops.render.render()
+	bpy.data.images['Render Result'].save_render(tile_output, scene=scene)
+	emit('write', frame=scene.frame_current, path=tile_output)
+elif arg_frames is not None:
+	# Each frame is rendered as a still, which (unlike animations) replaces an existing image
+	for frame in arg_frames:
+		scene.frame_set(frame)
+		bpy.ops.render.render(write_still=True)
+		emit('write', frame=frame, path=frame_path(frame))
+else:
+	bpy.ops.render.render(animation=arg_animation, write_still=True)
+	# Stills do not call render_write, so record the written image here
+	if not arg_animation:
+		emit('write', frame=scene.frame_current, path=frame_path(scene.frame_current))
\ No newline at end of file
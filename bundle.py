@@ -0,0 +1,226 @@
+import os
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+
+import taskfile
+import tasks
+
+
+'''
+bundle
+Preflight stage for tasks: finds every external file a blend file depends on and describes them in a manifest
+The manifest (blend file + dependencies, with sizes and hashes) is what the LAN layer ships as a single job bundle
+
+Scanning requires launching Blender (see bdeps.py), so manifests are cached on disk per blend file
+A cached manifest is reused as long as the blend file's mtime and size are unchanged
+Dependencies are re-hashed only if their own mtime or size changed
+'''
+
+
+bdeps_path = Path(__file__).parent.joinpath('bdeps.py').absolute()
+bremap_path = Path(__file__).parent.joinpath('bremap.py').absolute()
+
+# The directory in which cached manifests are stored. The cwd is used
+manifest_dir = 'tasks/bundles'
+
+# Dependencies outside the blend file's directory are placed under this directory within a bundle
+external_dir = '_external'
+
+HASH_CHUNK = 1 << 20
+
+
+# Utility: returns the hex sha256 of the given file
+def hash_file(path) -> str:
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while True:
+			chunk = f.read(HASH_CHUNK)
+			if not chunk:
+				break
+			h.update(chunk)
+	return h.hexdigest()
+
+
+# A single file in a bundle
+# path is the absolute path on this machine, name is the relative path within the bundle
+class BundleFile:
+	def __init__(self, path : str, name : str, size : int, mtime : float, sha256 : str):
+		self.path = path
+		self.name = name
+		self.size = size
+		self.mtime = mtime
+		self.sha256 = sha256
+
+	def to_dict(self):
+		return {'path': self.path, 'name': self.name, 'size': self.size, 'mtime': self.mtime, 'sha256': self.sha256}
+
+	def from_dict(d):
+		return BundleFile(d['path'], d['name'], d['size'], d['mtime'], d['sha256'])
+
+	# Creates a BundleFile by reading the file from disk
+	def create(path, name):
+		st = os.stat(path)
+		return BundleFile(str(path), name, st.st_size, st.st_mtime, hash_file(path))
+
+	# Whether the file on disk still matches this entry without re-hashing
+	def is_current(self):
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return False
+		return st.st_size == self.size and st.st_mtime == self.mtime
+
+
+# The files array always begins with the blend file itself
+class Manifest:
+	def __init__(self, files : list, missing : list):
+		self.files = files
+		self.missing = missing
+
+	def blend(self) -> BundleFile:
+		return self.files[0]
+
+	def total_size(self):
+		return sum(f.size for f in self.files)
+
+	def __str__(self):
+		return json.dumps({
+			'files': [f.to_dict() for f in self.files],
+			'missing': self.missing})
+
+	def parse(string):
+		d = json.loads(string)
+		return Manifest([BundleFile.from_dict(f) for f in d['files']], d['missing'])
+
+	def desc(self):
+		s = f'{len(self.files)} file(s), {self.total_size()} bytes'
+		for f in self.files:
+			s += f'\n\t- {f.name} ({f.size} bytes)'
+		for m in self.missing:
+			s += f'\n\t- MISSING: {m}'
+		return s
+
+
+# Returns the name a dependency has within a bundle. Files next to (or below) the blend file keep their
+# relative location, so Blender's relative paths (//textures/...) still resolve on the receiving end
+# Other files keep their absolute path below external_dir, so files in the same directory (image sequences,
+# disk caches) still are. The receiving end points the blend file at them (see remap_received())
+def bundle_name(blend : Path, dep : Path) -> str:
+	try:
+		return dep.relative_to(blend.parent).as_posix()
+	except ValueError:
+		drive = dep.drive.replace(':', '').replace('\\', '/').strip('/')
+		return '/'.join([external_dir] + ([drive] if drive != '' else []) + list(dep.parts[1:]))
+
+def manifest_filename(blend : Path) -> Path:
+	key = hashlib.sha1(str(blend).encode()).hexdigest()
+	return Path(manifest_dir).joinpath(key + '.json')
+
+
+# Runs bdeps.py in Blender and returns (files, missing) as lists of absolute paths, or None on failure
+def scan_dependencies(blend : Path):
+	fd, output = tempfile.mkstemp(suffix='.json')
+	os.close(fd)
+	try:
+		code = tasks.run_blender(blend, bdeps_path, [output])
+		if code != 0:
+			print(f'Dependency scan of "{blend}" failed with exit code {code}')
+			return None
+		with open(output, 'r') as f:
+			result = json.load(f)
+		return result['files'], result['missing']
+	except (OSError, ValueError, KeyError) as e:
+		print(f'Exception while scanning dependencies of "{blend}": {e}')
+		return None
+	finally:
+		os.remove(output)
+
+
+# Returns the cached manifest for the given blend file, or None if there is none or it is out of date
+# Dependencies that changed since the manifest was made are re-hashed (and the cache updated),
+# or if rehash is False, None is returned instead
+def cached_manifest(blend, rehash=True):
+	blend = Path(blend).absolute()
+	path = manifest_filename(blend)
+	try:
+		with open(path, 'r') as f:
+			manifest = Manifest.parse(f.read())
+	except (OSError, ValueError, KeyError):
+		return None
+	if manifest.blend().path != str(blend) or not manifest.blend().is_current():
+		return None
+	stale = [i for i, f in enumerate(manifest.files) if not f.is_current()]
+	if len(stale) > 0:
+		if not rehash:
+			return None
+		for i in stale:
+			f = manifest.files[i]
+			if not os.path.isfile(f.path):
+				manifest.missing.append(f.path)
+				manifest.files[i] = None
+			else:
+				manifest.files[i] = BundleFile.create(f.path, f.name)
+		manifest.files = [f for f in manifest.files if f is not None]
+		write_manifest(manifest)
+	return manifest
+
+def write_manifest(manifest : Manifest):
+	path = manifest_filename(Path(manifest.blend().path))
+	os.makedirs(path.parent, exist_ok=True)
+	taskfile.lock_disk()
+	try:
+		with open(path, 'w') as f:
+			f.write(str(manifest))
+	finally:
+		taskfile.unlock_disk()
+
+
+# Returns the manifest for the given blend file, scanning it with Blender if no up-to-date manifest is cached
+# Returns None if the file could not be scanned
+def get_manifest(blend):
+	blend = Path(blend).absolute()
+	manifest = cached_manifest(blend)
+	if manifest is not None:
+		return manifest
+	if not tasks.is_valid_blend(blend):
+		print(f'Invalid blend file: {blend}')
+		return None
+	scanned = scan_dependencies(blend)
+	if scanned is None:
+		return None
+	deps, missing = scanned
+	files = [BundleFile.create(blend, blend.name)]
+	for dep in deps:
+		files.append(BundleFile.create(dep, bundle_name(blend, Path(dep))))
+	manifest = Manifest(files, missing)
+	write_manifest(manifest)
+	return manifest
+
+
+# Called on the receiving end of a bundle, once its files are in place: rewrites the received blend file to use
+# the received dependencies instead of their paths on the sending machine (see bremap.py)
+# originals are the original paths of the manifest's files, in order. Returns whether it succeeded
+def remap_received(manifest : Manifest, originals : list):
+	if len(manifest.files) < 2:
+		return True
+	fd, args_filename = tempfile.mkstemp(suffix='.json')
+	try:
+		with os.fdopen(fd, 'w') as f:
+			json.dump({'blend': originals[0], 'files': {o: b.path for o, b in zip(originals, manifest.files)}}, f)
+		code = tasks.run_blender(manifest.blend().path, bremap_path, [args_filename])
+	finally:
+		os.remove(args_filename)
+	if code != 0:
+		print(f'Could not remap the dependencies of "{manifest.blend().path}" (exit code {code})')
+		return False
+	return True
+
+
+# Runs the preflight stage for a task. Returns the manifest, or None if the task's file could not be scanned
+def preflight(task : taskfile.Task):
+	manifest = get_manifest(task.args[0])
+	if manifest is not None and len(manifest.missing) > 0:
+		print(f'Warning: "{task.args[0]}" references {len(manifest.missing)} missing file(s)')
+	return manifest
@@ -0,0 +1,320 @@
+import os
+import json
+import math
+import time
+import hashlib
+import threading
+
+import taskfile
+import preempt
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+
+'''
+capacity
+What a machine can render, so a server can give each worker work in proportion to it (see lan.py)
+
+A Capacity holds a machine's cores, its total and free memory, a benchmark score (the single-core speed
+measured by benchmark(), the same on every machine) and its current load (0 idle to 1 fully busy)
+Its throughput is score * cores, the rate at which it gets through work when it is given some. The load is
+only informative: it is mostly the farm's own work (the server rendering while it hands out parts, a worker
+finishing its last part), so counting it would give most of an animation to whichever machine asks first
+
+Workers send their Capacity in the lan.Header of every connection; the server keeps the latest one of every
+worker in workers. When a worker asks for a task, assign() picks one for it from the queue:
+	- tasks are considered in the order next_task() would run them, and the worker's part is charged to the
+	  task's submitter (see fairshare.py)
+	- a task whose recorded peak memory (see stats.memory_predictor()) does not fit in the worker's free memory
+	  is skipped. A task needing more than heavy_fraction of the worker's memory is also left for a larger
+	  worker, if one is known
+	- an animation is split: the worker gets the first frames of it, as many as its share of the throughput of
+	  all known machines (the server included) would render, and the rest stay in the queue as the same task
+	  (see chunk_frames()). Each part renders its frames with task.info['frame_list']
+	- if the task cannot be sent after all, the server runs it and the charge is refunded (see refund())
+So fast machines get larger parts, and slow ones are not left rendering most of a long animation
+
+Tiles and stitches (see tiles.py) are not given to workers, since their images must be on the server to be
+stitched, and the server has no way to get a worker's outputs back
+
+A task sent to a worker is leased to it: it is kept in leases_filename, with task.info['lease'] set to the
+lease's id, until the worker reports that it completed or failed (see lan.py). The server then records it in
+its own completed or failed list (so its history and statistics include it) under its original file
+A worker renews the leases of the tasks it still has while it runs them. A lease that is not renewed for
+lease_timeout seconds (e.g. the worker crashed) ends, and its task is queued on the server again, as is a task
+the worker gives back (e.g. it was skipped there)
+'''
+
+
+# Workers that have not connected for this many seconds are no longer counted
+worker_timeout = 10 * 60
+
+# The fraction of a worker's memory above which a task is left for a worker with more memory
+heavy_fraction = 0.5
+
+# The fewest frames given to a worker at once
+min_chunk_frames = 2
+
+# The file in which tasks leased to workers are stored. The cwd is used
+leases_filename = 'tasks/leases.json'
+
+# Seconds without being renewed after which a lease ends and its task is queued on the server again
+lease_timeout = 10 * 60
+
+# The number of rounds of the benchmark. It takes about 0.1s on a recent CPU
+BENCHMARK_ROUNDS = 64
+
+
+class Capacity:
+	def __init__(self, cores=1, memory=None, free_memory=None, score=1.0, load=0.0):
+		self.cores = cores
+		# In bytes, or None if unknown
+		self.memory = memory
+		self.free_memory = free_memory
+		self.score = score
+		self.load = load
+
+	def throughput(self):
+		return self.score * self.cores
+
+	def to_dict(self):
+		return {'cores': self.cores, 'memory': self.memory, 'free_memory': self.free_memory,
+			'score': self.score, 'load': self.load}
+
+	def from_dict(d):
+		return Capacity(int(d.get('cores', 1)), d.get('memory', None), d.get('free_memory', None),
+			float(d.get('score', 1.0)), float(d.get('load', 0.0)))
+
+	def __str__(self):
+		return json.dumps(self.to_dict(), separators=(',', ':'))
+
+	# If parsing fails, returns None
+	def parse(string):
+		try:
+			return Capacity.from_dict(json.loads(string))
+		except (ValueError, TypeError, AttributeError):
+			return None
+
+	def desc(self):
+		gib = lambda b: f'{b / 1024 ** 3:.1f} GiB' if b is not None else 'unknown'
+		return f'{self.cores} cores, {gib(self.memory)} memory ({gib(self.free_memory)} free), ' + \
+			f'score {self.score:.1f}, load {100 * self.load:.0f}%'
+
+
+benchmark_score = None
+benchmark_mutex = threading.Lock()
+
+# Returns the single-core speed of this machine, in MiB hashed per second. Measured once per process
+def benchmark():
+	global benchmark_score
+	with benchmark_mutex:
+		if benchmark_score is None:
+			data = bytes(1 << 20)
+			start = time.perf_counter()
+			for _ in range(BENCHMARK_ROUNDS):
+				hashlib.sha256(data).digest()
+			benchmark_score = BENCHMARK_ROUNDS / max(time.perf_counter() - start, 1e-6)
+		return benchmark_score
+
+def total_memory():
+	if psutil is not None:
+		return psutil.virtual_memory().total
+	try:
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+	except (AttributeError, ValueError, OSError):
+		return None
+
+# Returns the fraction of this machine's CPUs in use, or 0 if unknown
+def current_load(cores):
+	try:
+		return min(os.getloadavg()[0] / cores, 1)
+	except (AttributeError, OSError):
+		pass
+	# Windows has no load average
+	if psutil is not None:
+		return psutil.cpu_percent(interval=0.1) / 100
+	return 0.0
+
+# Returns the Capacity of this machine
+def measure():
+	cores = os.cpu_count() or 1
+	return Capacity(cores, total_memory(), preempt.available_memory(), benchmark(), current_load(cores))
+
+
+# Worker name -> (its latest Capacity, the time it was received)
+workers = {}
+workers_mutex = threading.Lock()
+
+def update(name, capacity : Capacity):
+	with workers_mutex:
+		workers[name] = (capacity, time.time())
+
+# Returns {name: Capacity} of the workers that connected in the last worker_timeout seconds
+def known_workers():
+	now = time.time()
+	with workers_mutex:
+		return {name: c for name, (c, seen) in workers.items() if now - seen <= worker_timeout}
+
+
+# Returns the frames the task renders, or None if they are unknown or it is not an animation
+def task_frames(task : taskfile.Task):
+	import rendercache
+	if task.type != taskfile.TaskType.RENDER_ANIMATION:
+		return None
+	if 'frame_list' in task.info:
+		return list(task.info['frame_list'])
+	frames = rendercache.frame_range(task)
+	if frames is None:
+		return None
+	start, end, step = frames
+	return list(range(start, end + 1, max(step, 1)))
+
+# Returns the frames of the given frames that the worker should render: its share of the total throughput,
+# out of all machines' capacities (including its own)
+def chunk_frames(frames : list, worker : Capacity, capacities : list):
+	total = sum(c.throughput() for c in capacities)
+	share = worker.throughput() / total if total > 0 else 1 / max(len(capacities), 1)
+	count = max(min_chunk_frames, math.ceil(len(frames) * share))
+	return frames[:count]
+
+# Returns whether the task should be left for a worker with more memory than the given one
+def too_heavy(needed, worker : Capacity, largest):
+	if needed is None or worker.memory is None:
+		return False
+	if worker.free_memory is not None and needed > worker.free_memory:
+		return True
+	return needed > heavy_fraction * worker.memory and largest is not None and largest > worker.memory
+
+# Takes a task for the worker with the given name and capacity from the queue
+# If only part of an animation is given to it, the rest stays queued in its place
+# Returns (the task for the worker (without an id), the seconds charged to its submitter),
+# or None if no task suits it
+def assign(name, worker : Capacity):
+	import stats
+	import fairshare
+	update(name, worker)
+	others = [c for n, c in known_workers().items() if n != name]
+	largest = max((c.memory for c in others if c.memory is not None), default=None)
+	aggregates = stats.load()
+	predict_memory = stats.memory_predictor(aggregates)
+	predict = stats.predictor(aggregates)
+	# The server renders too
+	capacities = [measure(), worker] + others
+	with taskfile.locked_disk():
+		queued = taskfile.read_tasks()
+		for task in taskfile.iter_ready(queued, predict=predict):
+			# Tiles and stitches belong to the server's own tiled stills (see tiles.py)
+			if any(k in task.info for k in ('tile', 'stitch', 'tiles')):
+				continue
+			if too_heavy(predict_memory(task), worker, largest):
+				continue
+			# The worker queues it under a new id, with its own log
+			info = {k: v for k, v in task.info.items() if k not in ('id', 'log')}
+			frames = task_frames(task)
+			chunk = chunk_frames(frames, worker, capacities) if frames is not None else None
+			if chunk is not None and len(chunk) < len(frames):
+				task.info['frame_list'] = frames[len(chunk):]
+				info['frame_list'] = chunk
+				info['chunk_of'] = task.id()
+			else:
+				queued.remove(task)
+			taskfile.write_tasks(queued)
+			# The worker's time counts towards its submitter's share (see fairshare.py)
+			charged = fairshare.cost(task, predict) * (len(chunk) / len(frames) if chunk else 1)
+			fair_state = fairshare.read_state()
+			fairshare.charge(fair_state, task, charged)
+			fairshare.write_state(fair_state)
+			return taskfile.Task(task.type, list(task.args), 0, info), charged
+	return None
+
+# Gives back the seconds charged by assign() for a task that was not sent to the worker after all
+def refund(task : taskfile.Task, charged):
+	import fairshare
+	with taskfile.locked_disk():
+		fair_state = fairshare.read_state()
+		fairshare.charge(fair_state, task, -charged)
+		fairshare.write_state(fair_state)
+
+
+def read_leases() -> dict:
+	try:
+		with open(leases_filename, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def write_leases(leases : dict):
+	taskfile.lock_disk()
+	try:
+		taskfile.write_atomic(leases_filename, json.dumps(leases))
+	finally:
+		taskfile.unlock_disk()
+
+# Records that the task (as sent, with task.info['lease'] set) was given to the worker with the given name
+def lease(task : taskfile.Task, name):
+	with taskfile.locked_disk():
+		leases = read_leases()
+		leases[task.info['lease']] = {'task': str(task), 'worker': name, 'expires': time.time() + lease_timeout}
+		write_leases(leases)
+
+# Extends the given leases of the worker with the given name. Returns the ids of those that have ended
+def renew(ids : list, name):
+	with taskfile.locked_disk():
+		leases = read_leases()
+		for id in ids:
+			if id in leases and leases[id]['worker'] == name:
+				leases[id]['expires'] = time.time() + lease_timeout
+		write_leases(leases)
+	return [id for id in ids if id not in leases]
+
+# Queues a task that is no longer leased at the front of the queue, as an independent task
+def requeue_leased(task : taskfile.Task):
+	task.info.pop('lease', None)
+	task.info.pop('chunk_of', None)
+	taskfile.create_tasks([task], 0)
+
+# Ends a lease of the worker with the given name, as reported by it (see lan.py). report has:
+#	result: 'completed', 'failed' or 'returned' (the worker did not run it, so it is queued here again)
+#	time, finished and exit_code: as recorded by the worker
+#	info: the task's info on the worker, e.g. the phases and frames written (see phases.py)
+# Returns whether the lease was known
+def end_lease(id, name, report : dict):
+	with taskfile.locked_disk():
+		leases = read_leases()
+		leased = leases.get(id, None)
+		if leased is None or leased['worker'] != name:
+			return False
+		del leases[id]
+		write_leases(leases)
+		task = taskfile.Task.parse(leased['task'])
+		if report['result'] == 'returned':
+			requeue_leased(task)
+			return True
+		# The task keeps the file it has here; the worker's own id, log and file do not apply
+		task.info.update({k: v for k, v in report.get('info', {}).items()
+			if k not in ('id', 'log', 'lease', 'original_file')})
+		task.info.pop('lease', None)
+		task.info['worker'] = name
+		task.time = float(report.get('time', 0))
+		finished = float(report['finished']) if report.get('finished', None) is not None else None
+		if report['result'] == 'completed':
+			taskfile.add_completed(taskfile.CompletedTask(task, finished))
+		else:
+			taskfile.add_failed(taskfile.FailedTask(task, int(report.get('exit_code', 1)), finished))
+		return True
+
+# Ends the leases that were not renewed in time, queueing their tasks here again. Returns how many ended
+def expire_leases():
+	with taskfile.locked_disk():
+		leases = read_leases()
+		now = time.time()
+		expired = [id for id, l in leases.items() if l['expires'] < now]
+		for id in expired:
+			leased = leases.pop(id)
+			print(f'Worker {leased["worker"]} did not renew its lease; queueing its task here again')
+			requeue_leased(taskfile.Task.parse(leased['task']))
+		if len(expired) > 0:
+			write_leases(leases)
+		return len(expired)
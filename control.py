@@ -0,0 +1,230 @@
+import os
+import socket
+import threading
+import json
+
+import __main__ as M
+import msgqueue as msgq
+import taskfile
+import tasks
+import stats
+
+
+'''
+control
+A local control endpoint that lets other programs (see ctl.py) drive the queue while the scheduler runs
+The endpoint is a Unix domain socket. Each request and each response is one line of JSON
+
+Requests are objects with an "op" key. Responses always have "ok" and, if "ok" is false, "error"
+- submit: {"tasks": [{"type": "ra", "args": ["a.blend"], "options": ["preview"]}, ...], "index": -1}
+	Queues all tasks (in order) at index with a single rewrite of the taskfile. Responds with "ids"
+	"options" is optional and is parsed like the options of the render command (see tasks.parse_task_options())
+	"args" and "options" must be lists of strings. Any other keys of a task (e.g. "info") are ignored
+	Invalid tasks are skipped and reported in "errors" as [position in request, message]
+- move: {"id": id, "to": index} or {"index": index, "to": index}
+- cancel: {"ids": [...]} and/or {"current": true}
+	Removes queued tasks and/or skips the current task. Responds with "cancelled" (list of ids)
+- query: {"what": ["current", "queued", "completed", "failed"], "limit": n}
+	Responds with one key per requested list. "current" is a task or null
+- stats: {}
+	Responds with "stats", the aggregate statistics over all finished tasks (see stats.py)
+- ping: {}
+
+Unix domain sockets are not available on all platforms; the endpoint is disabled where they are not
+'''
+
+
+# The socket file. The cwd is used
+socket_filename = 'tasks/control.sock'
+
+# The maximum number of queued connections
+BACKLOG = 16
+
+server_socket = None
+server_thread = None
+
+
+class ControlError(Exception):
+	pass
+
+
+def is_supported():
+	return hasattr(socket, 'AF_UNIX')
+
+
+# Client side: opens a connection to a running endpoint. Raises OSError if there is none
+def connect() -> socket.socket:
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socket_filename)
+	except OSError:
+		sock.close()
+		raise
+	return sock
+
+# Client side: sends one request over a connection made with connect() and returns the response
+def request(sock : socket.socket, op, **params) -> dict:
+	params['op'] = op
+	sock.sendall((json.dumps(params) + '\n').encode())
+	line = b''
+	while not line.endswith(b'\n'):
+		data = sock.recv(65536)
+		if len(data) == 0:
+			raise ControlError('Connection closed')
+		line += data
+	return json.loads(line)
+
+
+def op_submit(req):
+	new_tasks = []
+	errors = []
+	for i, t in enumerate(req.get('tasks', [])):
+		# Only the type, arguments and options are taken from the client; everything else in info is set by the queue
+		try:
+			type, args, options = t['type'], t['args'], t.get('options', [])
+			if not all(isinstance(v, list) and all(isinstance(a, str) for a in v) for v in (args, options)):
+				raise TypeError()
+			task = taskfile.Task(type, args, info=tasks.parse_task_options(options, type))
+		except (KeyError, TypeError):
+			errors.append([i, 'Malformed task'])
+			continue
+		except ValueError as e:
+			errors.append([i, str(e)])
+			continue
+		if taskfile.TaskType.get_name(task.type) is None:
+			errors.append([i, f'Unknown task type: {task.type}'])
+		elif len(task.args) < 1 or not tasks.is_valid_blend(task.args[0]):
+			errors.append([i, 'Invalid blend file'])
+		else:
+			new_tasks.append(task)
+	if len(new_tasks) > 0:
+		taskfile.create_tasks(new_tasks, int(req.get('index', -1)))
+		M.bgd_thread.notify_thread()
+	return {'ids': [t.id() for t in new_tasks], 'errors': errors}
+
+def op_move(req):
+	taskfile.lock_disk()
+	try:
+		if 'id' in req:
+			src = taskfile.index_of(taskfile.read_tasks(), req['id'])
+		else:
+			src = int(req['index'])
+		if not taskfile.move_task(src, int(req.get('to', -1))):
+			raise ControlError('No such task')
+	finally:
+		taskfile.unlock_disk()
+	M.bgd_thread.notify_thread()
+	return {}
+
+def op_cancel(req):
+	cancelled = [t.id() for t in taskfile.remove_tasks(req.get('ids', []))]
+	if req.get('current', False):
+		current = taskfile.get_current_task()
+		if current is not None:
+			msgq.add_message(msgq.MessageType.SKIP)
+			cancelled.append(current.id())
+	return {'cancelled': cancelled}
+
+def op_query(req):
+	what = req.get('what', ['current', 'queued', 'completed', 'failed'])
+	limit = int(req.get('limit', -1))
+	result = {}
+	if 'current' in what:
+		current = taskfile.get_current_task()
+		result['current'] = current.to_dict() if current is not None else None
+	if 'queued' in what:
+		queued = taskfile.read_tasks()
+		result['queued'] = [t.to_dict() for t in (queued[:limit] if limit >= 0 else queued)]
+	if 'completed' in what:
+		result['completed'] = [t.to_dict() for t in taskfile.read_completed(limit)]
+	if 'failed' in what:
+		result['failed'] = [t.to_dict() for t in taskfile.read_failed(limit)]
+	return result
+
+def op_stats(req):
+	return {'stats': stats.load()}
+
+def op_ping(req):
+	return {}
+
+ops = {
+	'submit': op_submit,
+	'move': op_move,
+	'cancel': op_cancel,
+	'query': op_query,
+	'stats': op_stats,
+	'ping': op_ping,
+}
+
+
+def handle_request(line):
+	try:
+		req = json.loads(line)
+		op = ops.get(req.get('op', None), None)
+		if op is None:
+			raise ControlError(f'Unknown op: {req.get("op", None)}')
+		response = op(req)
+		response['ok'] = True
+	except (ValueError, KeyError, TypeError, AttributeError, ControlError) as e:
+		response = {'ok': False, 'error': str(e)}
+	return response
+
+# Each connection is served by its own thread and may send any number of requests
+def connection_func(connection : socket.socket):
+	with connection, connection.makefile('rwb') as f:
+		try:
+			for line in f:
+				f.write((json.dumps(handle_request(line)) + '\n').encode())
+				f.flush()
+		except OSError:
+			pass
+
+def server_thread_func():
+	while True:
+		try:
+			connection, _ = server_socket.accept()
+		except OSError:
+			# The socket was closed by stop_server()
+			return
+		threading.Thread(target=connection_func, args=[connection], daemon=True).start()
+
+
+# Starts serving the control endpoint. Returns whether it was started
+def start_server():
+	global server_socket
+	global server_thread
+	if not is_supported():
+		print('The control endpoint is not supported on this platform')
+		return False
+	if os.path.exists(socket_filename):
+		try:
+			connect().close()
+			print('Another instance is already serving the control endpoint')
+			return False
+		except OSError:
+			# Left behind by an instance that did not shut down cleanly
+			os.remove(socket_filename)
+	os.makedirs(os.path.dirname(socket_filename), exist_ok=True)
+	server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	server_socket.bind(socket_filename)
+	server_socket.listen(BACKLOG)
+	server_thread = threading.Thread(target=server_thread_func, name='ControlThread', daemon=True)
+	server_thread.start()
+	return True
+
+def stop_server():
+	global server_socket
+	global server_thread
+	if server_socket is None:
+		return
+	# shutdown() wakes the thread blocked in accept()
+	try:
+		server_socket.shutdown(socket.SHUT_RDWR)
+	except OSError:
+		pass
+	server_socket.close()
+	server_socket = None
+	server_thread.join()
+	server_thread = None
+	if os.path.exists(socket_filename):
+		os.remove(socket_filename)
@@ -0,0 +1,78 @@
+import sys
+import os
+import json
+import argparse
+
+import control
+
+
+'''
+ctl
+A thin command line client for the control endpoint (see control.py) of a running render queue
+Run it from the same working directory as the render queue. Every command prints the JSON response
+
+Examples:
+	python RenderQueue/ctl.py submit a.blend b.blend
+	python RenderQueue/ctl.py submit --index 0 -o preview -o samples=16 a.blend
+	find shots -name '*.blend' | python RenderQueue/ctl.py submit --type rs --stdin
+	python RenderQueue/ctl.py move 3f2a9c01b7d4 0
+	python RenderQueue/ctl.py cancel 3f2a9c01b7d4 --current
+	python RenderQueue/ctl.py query queued --limit 10
+'''
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='ctl', description='Controls a running render queue')
+	sub = parser.add_subparsers(dest='op', required=True)
+
+	p = sub.add_parser('submit', help='queue blend files as one batch')
+	p.add_argument('files', nargs='*')
+	p.add_argument('--type', default='ra', help='task type: ra (animation), rs (still) or b (bake)')
+	p.add_argument('--index', type=int, default=-1, help='queue position of the first task (default: end)')
+	p.add_argument('--stdin', action='store_true', help='also read file paths from stdin, one per line')
+	p.add_argument('-o', '--option', action='append', default=[], help='a preset or setting=value, for every task')
+
+	p = sub.add_parser('move', help='move a queued task')
+	p.add_argument('id')
+	p.add_argument('to', type=int)
+
+	p = sub.add_parser('cancel', help='remove queued tasks')
+	p.add_argument('ids', nargs='*')
+	p.add_argument('--current', action='store_true', help='also skip the current task')
+
+	p = sub.add_parser('query', help='print tasks')
+	p.add_argument('what', nargs='*', help='any of: current, queued, completed, failed (default: all)')
+	p.add_argument('--limit', type=int, default=-1)
+
+	sub.add_parser('stats', help='print statistics over all finished tasks')
+	sub.add_parser('ping', help='check that the render queue is running')
+
+	args = parser.parse_args(argv)
+	if args.op == 'submit':
+		files = list(args.files)
+		if args.stdin:
+			files.extend(line.strip() for line in sys.stdin if line.strip() != '')
+		params = {'tasks': [{'type': args.type, 'args': [os.path.abspath(f)], 'options': args.option} for f in files],
+			'index': args.index}
+	elif args.op == 'move':
+		params = {'id': args.id, 'to': args.to}
+	elif args.op == 'cancel':
+		params = {'ids': args.ids, 'current': args.current}
+	elif args.op == 'query':
+		params = {'what': args.what, 'limit': args.limit} if len(args.what) > 0 else {'limit': args.limit}
+	else:
+		params = {}
+
+	try:
+		sock = control.connect()
+	except OSError:
+		print('Could not connect to the render queue. Is it running in this directory?', file=sys.stderr)
+		return 2
+	with sock:
+		response = control.request(sock, args.op, **params)
+	print(json.dumps(response, indent='\t'))
+	return 0 if response['ok'] else 1
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
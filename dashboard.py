@@ -0,0 +1,205 @@
+import sys
+import time
+import queue
+import shutil
+import threading
+import collections
+from datetime import timedelta
+
+import __main__ as M
+import taskfile
+import events
+import stats
+
+
+'''
+dashboard
+A continuously updating view of the queue in the terminal: the current task with its progress and ETA,
+suspended tasks, the queue (one page at a time) and recent completions and failures
+
+The view is kept up to date by events (see events.py) instead of reading the task files:
+	- the current task, its progress and recent results come from the events' tasks
+	- the queue is read again only when the task list changed (a queue_changed event)
+Only the lines that changed since the last redraw are written to the terminal. Everything is drawn again
+when the terminal is resized, the page changes, or every full_redraw_interval seconds (other output,
+e.g. from the background thread, may have been printed over the view)
+
+The ETA is based on the frames written so far, or on the mean time of earlier runs (see stats.py) until then
+'''
+
+
+# Seconds between redraws when there are no events (for elapsed times and ETAs)
+refresh_interval = 1.0
+full_redraw_interval = 10.0
+
+# The number of completed and failed tasks shown
+RECENT = 5
+
+PROGRESS_WIDTH = 30
+
+
+def duration(seconds):
+	return str(timedelta(seconds=round(max(seconds, 0))))
+
+def task_line(task : taskfile.Task):
+	s = f'{task.args[0] if len(task.args) > 0 else ""} ({taskfile.TaskType.get_name(task.type)})'
+	if task.info.get('priority', 0) != 0:
+		s += f' priority {task.info["priority"]}'
+	return s
+
+
+# The task being run, and how far it is
+class Current:
+	def __init__(self, task : taskfile.Task, start : float):
+		self.task = task
+		# time.perf_counter() when it was started or resumed; task.time is the time of earlier runs
+		self.start = start
+		self.frames = 0
+		self.expected = None
+		self.predicted = stats.predict_duration(task)
+
+	def elapsed(self):
+		return self.task.time + time.perf_counter() - self.start
+
+	# Returns the seconds left, or None if unknown
+	def eta(self):
+		elapsed = self.elapsed()
+		if self.expected is not None and self.frames > 0:
+			return elapsed / self.frames * (self.expected - self.frames)
+		if self.predicted is not None:
+			return self.predicted - elapsed
+		return None
+
+
+class Dashboard(threading.Thread):
+	# start_time is the time.perf_counter() at which the current task (if any) was started
+	def __init__(self, start_time=None, out=sys.stdout):
+		threading.Thread.__init__(self, name='Dashboard', daemon=True)
+		self.out = out
+		self.events = queue.Queue()
+		self.stop_event = threading.Event()
+		task = taskfile.get_current_task()
+		self.current = Current(task, start_time if start_time is not None and start_time >= 0 else time.perf_counter()) \
+			if task is not None else None
+		self.suspended = []
+		self.queued = taskfile.read_tasks()
+		finished = [(t, True) for t in taskfile.read_completed(RECENT)] + [(t, False) for t in taskfile.read_failed(RECENT)]
+		finished.sort(key=lambda f: f[0].finished)
+		self.recent = collections.deque(finished[-RECENT:], maxlen=RECENT)
+		self.page = 0
+		self.lines = []
+		self.size = None
+		self.last_full_redraw = 0
+
+	def on_event(self, kind, data):
+		self.events.put((kind, data))
+
+	def stop(self):
+		self.stop_event.set()
+		self.events.put(('stop', {}))
+
+	# Shows the next (1) or previous (-1) page of the queue
+	def turn_page(self, pages):
+		self.events.put(('page', {'pages': pages}))
+
+	def apply(self, kind, data):
+		task = data.get('task', None)
+		if kind == 'started':
+			self.current = Current(task, time.perf_counter())
+			self.suspended = [t for t in self.suspended if t.id() != task.id()]
+		elif kind == 'progress':
+			if self.current is not None and self.current.task.id() == task.id():
+				self.current.frames = data['frames']
+				self.current.expected = data['expected']
+		elif kind in ('completed', 'failed'):
+			self.recent.append((task, kind == 'completed'))
+		elif kind == 'suspended':
+			self.suspended.append(task)
+		elif kind == 'queue_changed':
+			self.queued = taskfile.read_tasks()
+		elif kind == 'page':
+			self.page += data['pages']
+			self.size = None
+		if kind in ('completed', 'failed', 'requeued', 'discarded', 'suspended') and \
+			self.current is not None and self.current.task.id() == task.id():
+			self.current = None
+
+	def render(self, width, height):
+		C = M.Color
+		lines = []
+		def add(text, color=''):
+			lines.append(color + text[:width - 1] + (C.RESET if color != '' else ''))
+		add('Lard Render Queue - ' + time.strftime('%H:%M:%S'), C.YELLOW)
+		add('===== Current Task =====', C.YELLOW)
+		if self.current is None:
+			add('No task is running')
+		else:
+			add(task_line(self.current.task))
+			eta = self.current.eta()
+			s = f'Elapsed {duration(self.current.elapsed())}'
+			if self.current.expected is not None:
+				s += f', frames {self.current.frames}/{self.current.expected}'
+			s += ', ETA ' + (duration(eta) if eta is not None else 'unknown')
+			add(s)
+			if self.current.expected:
+				done = round(PROGRESS_WIDTH * min(self.current.frames / self.current.expected, 1))
+				add('[' + '#' * done + '-' * (PROGRESS_WIDTH - done) + f'] {100 * self.current.frames // self.current.expected}%')
+		if len(self.suspended) > 0:
+			add(f'===== Suspended ({len(self.suspended)}) =====', C.YELLOW)
+			for task in self.suspended:
+				add(task_line(task))
+		# The queue gets whatever room is left
+		footer = 2 + len(self.recent) + 1
+		rows = max(height - len(lines) - 1 - footer, 1)
+		pages = max((len(self.queued) + rows - 1) // rows, 1)
+		self.page = min(max(self.page, 0), pages - 1)
+		add(f'===== Queued ({len(self.queued)}) =====' + (f' page {self.page + 1}/{pages}' if pages > 1 else ''), C.CYAN)
+		if len(self.queued) == 0:
+			add('There are no tasks currently queued')
+		start = self.page * rows
+		for i, task in enumerate(self.queued[start:start + rows]):
+			add(f'{start + i + 1}. {task_line(task)}')
+		add('===== Recent =====', C.GREEN)
+		for task, completed in reversed(self.recent):
+			if completed:
+				add(f'Completed {task_line(task)} in {duration(task.time)}', C.GREEN)
+			else:
+				add(f'Failed {task_line(task)} with exit code {task.exit_code}', C.MAGENTA)
+		add("'n' + Enter: next page, 'p' + Enter: previous page, Enter: stop watching")
+		return lines
+
+	# Writes the lines that changed since the last call, or all of them if necessary
+	def draw(self):
+		size = shutil.get_terminal_size()
+		lines = self.render(size.columns, size.lines)
+		now = time.monotonic()
+		full = size != self.size or now - self.last_full_redraw > full_redraw_interval
+		if full:
+			self.size = size
+			self.last_full_redraw = now
+			self.out.write('\033[2J')
+		s = ''
+		for row, line in enumerate(lines):
+			if full or row >= len(self.lines) or self.lines[row] != line:
+				s += f'\033[{row + 1};1H{line}\033[K'
+		# Clear below the view (it may have become shorter) and leave the cursor under it for input
+		s += f'\033[{len(lines) + 1};1H\033[J'
+		self.out.write(s)
+		self.out.flush()
+		self.lines = lines
+
+	def run(self):
+		events.subscribe(self.on_event)
+		try:
+			while not self.stop_event.is_set():
+				self.draw()
+				try:
+					kind, data = self.events.get(timeout=refresh_interval)
+					# Events that arrive together are drawn once
+					while True:
+						self.apply(kind, data)
+						kind, data = self.events.get_nowait()
+				except queue.Empty:
+					pass
+		finally:
+			events.unsubscribe(self.on_event)
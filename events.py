@@ -0,0 +1,41 @@
+import threading
+
+
+'''
+events
+Lets other parts of the script follow what the queue does as it happens, without reading the task files
+The background thread (and its watchdog) publish events; subscribers are called with (kind, data) in the
+publishing thread, so they must return quickly (e.g. by putting the event in a queue.Queue)
+
+Kinds, and their data:
+	started: task. A task was launched (or resumed, with resumed=True)
+	progress: task, frames (the number of frames written so far), expected (the number of frames it will write,
+	          or None if unknown). Published by the watchdog when new frames are written (see watchdog.py)
+	completed: task (a taskfile.CompletedTask)
+	failed: task (a taskfile.FailedTask)
+	requeued: task, reason. The task was put back in the queue (skipped, preempted or stalled)
+	discarded: task. The task was skipped without being put back in the queue
+	suspended: task. The task was stopped for a more urgent one (see preempt.py)
+	queue_changed: nothing. The task list on disk changed, possibly in another process
+'''
+
+
+subscribers = []
+mutex = threading.Lock()
+
+
+# Calls callback(kind, data) for every event published until unsubscribe() is called
+def subscribe(callback):
+	with mutex:
+		subscribers.append(callback)
+
+def unsubscribe(callback):
+	with mutex:
+		if callback in subscribers:
+			subscribers.remove(callback)
+
+def publish(kind, **data):
+	with mutex:
+		callbacks = subscribers[:]
+	for callback in callbacks:
+		callback(kind, data)
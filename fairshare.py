@@ -0,0 +1,163 @@
+import json
+import math
+import collections
+
+import taskfile
+
+
+'''
+fairshare
+Shares the queue between submitters, so one person queueing hundreds of tasks does not make everyone else wait
+(the 'fair' scheduling policy, see taskfile.POLICIES)
+
+Every task belongs to the submitter in task.info['submitter'] (e.g. submitter=anna, or a project name);
+tasks without one share the submitter ''. Tasks of equal priority are taken from the submitters' queues by
+weighted deficit round-robin:
+	- submitters take turns, in the order in which they first queued a task
+	- on its turn, a submitter's deficit grows by quantum * its share (shares default to 1), and it runs its
+	  tasks in queue order for as long as its deficit covers their predicted time (see stats.py, default_cost
+	  if unknown); what is left carries over to its next turn
+	- a submitter with nothing queued loses what is left of its deficit
+So over time each busy submitter gets time in proportion to its share, and a submitter with a single task
+waits for at most one turn of the others. Tasks with a higher priority still always run first
+
+A submitter may have a quota: the most of its tasks that may be running or suspended at the same time
+A submitter at its quota is passed over while other submitters have tasks ready; if none do, it runs anyway,
+so the queue never idles. Parts of animations given to LAN workers count against their own queues' quotas
+(see capacity.py) and are charged to the submitter's deficit here
+
+Shares, quotas and deficits are kept in state_filename, and set with the 'share' command
+'''
+
+
+# The file in which shares, quotas and deficits are stored. The cwd is used
+state_filename = 'tasks/fairshare.json'
+
+# The seconds added to a submitter's deficit on each turn, per unit of share
+quantum = 300.0
+
+# The cost in seconds of a task without a predicted time
+default_cost = 300.0
+
+
+def submitter(task : taskfile.Task):
+	return task.info.get('submitter', '')
+
+def empty_state():
+	return {'shares': {}, 'quotas': {}, 'deficits': {}, 'order': [], 'pointer': 0}
+
+def read_state() -> dict:
+	state = empty_state()
+	try:
+		with open(state_filename, 'r') as f:
+			state.update(json.load(f))
+	except (OSError, ValueError):
+		pass
+	# set_share() only stores positive shares, but the file may have been edited. Any other share is ignored
+	# (so the default is used), since picks() divides by it and a deficit it never grows would never run
+	state['shares'] = {n: s for n, s in state['shares'].items()
+		if isinstance(s, (int, float)) and math.isfinite(s) and s > 0}
+	return state
+
+def write_state(state : dict):
+	taskfile.lock_disk()
+	try:
+		taskfile.write_atomic(state_filename, json.dumps(state))
+	finally:
+		taskfile.unlock_disk()
+
+# Sets the share (and quota, if not None; 0 removes it) of a submitter
+def set_share(name, share : float, quota : int = None):
+	if share <= 0:
+		raise ValueError('Shares must be positive')
+	with taskfile.locked_disk():
+		state = read_state()
+		state['shares'][name] = share
+		if quota is not None:
+			if quota > 0:
+				state['quotas'][name] = quota
+			else:
+				state['quotas'].pop(name, None)
+		write_state(state)
+
+
+def cost(task : taskfile.Task, predict):
+	predicted = predict(task) if predict is not None else None
+	return predicted if predicted is not None else default_cost
+
+# Charges a submitter for time used outside of picks(), e.g. by a LAN worker
+def charge(state : dict, task : taskfile.Task, seconds):
+	name = submitter(task)
+	state['deficits'][name] = state['deficits'].get(name, 0) - seconds
+
+# Yields the given tasks (ready to run, highest priority first and otherwise in queue order, as sorted by
+# taskfile.iter_ready()) in the order in which they run, updating the deficits
+# and turn in state as each one is yielded. running is {submitter: the number of its tasks running or suspended}
+# Pass a copy of state to only look at the order
+def picks(tasks : list, predict, state : dict, running : dict = None):
+	running = collections.Counter(running or {})
+	order = state['order']
+	deficits = state['deficits']
+	# Priority -> submitter -> its tasks of that priority, in queue order. Each priority is done before the next
+	groups = collections.OrderedDict()
+	left = collections.Counter()
+	for task in tasks:
+		name = submitter(task)
+		groups.setdefault(task.info.get('priority', 0), collections.OrderedDict()) \
+			.setdefault(name, collections.deque()).append(task)
+		left[name] += 1
+		if left[name] == 1 and name not in order:
+			order.append(name)
+	for queues in groups.values():
+		while len(queues) > 0:
+			for name in order:
+				# Debts (see charge()) are kept
+				if left[name] == 0 and deficits.get(name, 0) > 0:
+					del deficits[name]
+			under_quota = [n for n in queues if running[n] < state['quotas'].get(n, math.inf)]
+			eligible = under_quota if len(under_quota) > 0 else list(queues)
+			shares = {n: state['shares'].get(n, 1) * quantum for n in eligible}
+			# Skip the turns in which no eligible submitter could afford its next task
+			rounds = min(math.ceil((cost(queues[n][0], predict) - deficits.get(n, 0)) / shares[n]) for n in eligible)
+			if rounds > 1:
+				for n in eligible:
+					deficits[n] = deficits.get(n, 0) + (rounds - 1) * shares[n]
+			while True:
+				state['pointer'] %= len(order)
+				name = order[state['pointer']]
+				if name in shares:
+					c = cost(queues[name][0], predict)
+					if deficits.get(name, 0) >= c:
+						deficits[name] = deficits.get(name, 0) - c
+						break
+					deficits[name] = deficits.get(name, 0) + shares[name]
+				state['pointer'] += 1
+			task = queues[name].popleft()
+			if len(queues[name]) == 0:
+				del queues[name]
+			left[name] -= 1
+			running[name] += 1
+			yield task
+
+# Returns the given tasks (ready to run, in queue order) in the order in which they would run, without changing state
+def order(tasks : list, predict, state : dict = None, running : dict = None):
+	state = json.loads(json.dumps(state if state is not None else read_state()))
+	return list(picks(sorted(tasks, key=lambda t: -t.info.get('priority', 0)), predict, state, running))
+
+# Returns {submitter: the number of its tasks running or suspended} on this machine
+def running_counts():
+	import preempt
+	counts = collections.Counter(submitter(t) for t in preempt.read_suspended())
+	current = taskfile.get_current_task()
+	if current is not None:
+		counts[submitter(current)] += 1
+	return counts
+
+# Returns [(submitter, share, quota, deficit, queued tasks)] for every known submitter
+def summary(tasks : list):
+	state = read_state()
+	queued = collections.Counter(submitter(t) for t in tasks)
+	names = list(state['order']) + [n for n in list(state['shares']) + list(queued) if n not in state['order']]
+	names = list(dict.fromkeys(names))
+	return [(n, state['shares'].get(n, 1), state['quotas'].get(n, None), state['deficits'].get(n, 0), queued[n])
+		for n in names]
@@ -0,0 +1,59 @@
+import sys
+import os
+import time
+import json
+import random
+
+
+'''
+fakeblender
+A stand-in for the Blender executable, used by bench.py to drive the queue without rendering anything
+Accepts (and ignores) Blender's command line. Behaviour is configured through environment variables:
+	LRQ_FAKE_SLEEP: seconds to "render" for (default 0)
+	LRQ_FAKE_EXIT: exit code to return (default 0)
+	LRQ_FAKE_FAIL_RATE: probability (0-1) of returning LRQ_FAKE_FAIL_EXIT (default 1) instead
+	LRQ_FAKE_LOG: if set, "<start> <end>" wall clock times are appended to this file
+If brender.py's --phases argument is given, a plausible sequence of timing events is written (see phases.py)
+'''
+
+
+# Writes the events brender.py would write for a one frame render taking the given time
+def write_phases(argv, duration):
+	argv = argv[argv.index('--') + 1:] if '--' in argv else []
+	if '--phases' not in argv:
+		return
+	launch = float(argv[argv.index('--launch-time') + 1]) if '--launch-time' in argv else None
+	with open(argv[argv.index('--phases') + 1], 'a') as f:
+		def emit(event, **data):
+			data['event'] = event
+			data['t'] = time.time()
+			f.write(json.dumps(data) + '\n')
+			f.flush()
+		emit('startup', launch=launch)
+		emit('loaded')
+		emit('frame_pre', frame=1)
+		emit('sample', frame=1)
+		time.sleep(duration)
+		emit('frame_post', frame=1)
+		emit('write', frame=1, path=os.path.abspath('fake_0001.png'))
+
+
+def main():
+	start = time.time()
+	duration = float(os.environ.get('LRQ_FAKE_SLEEP', '0'))
+	if '--phases' in sys.argv:
+		write_phases(sys.argv, duration)
+	else:
+		time.sleep(duration)
+	code = int(os.environ.get('LRQ_FAKE_EXIT', '0'))
+	if random.random() < float(os.environ.get('LRQ_FAKE_FAIL_RATE', '0')):
+		code = int(os.environ.get('LRQ_FAKE_FAIL_EXIT', '1'))
+	log = os.environ.get('LRQ_FAKE_LOG', None)
+	if log is not None:
+		with open(log, 'a') as f:
+			f.write(f'{start} {time.time()}\n')
+	return code
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,171 @@
+import os
+import sys
+import struct
+import select
+import threading
+import ctypes
+import ctypes.util
+
+
+'''
+fsnotify
+Watches a directory and calls a function whenever files in it change
+On Linux, inotify is used so changes are reported immediately without polling
+Everywhere else (or if inotify is unavailable), the directory is polled every poll_interval seconds
+
+The callback receives a list of (path, event) tuples, where event is CHANGED or REMOVED
+It is called from the watcher's own thread
+'''
+
+
+class Event:
+	# The file was created, written and closed, or moved into the directory
+	CHANGED = 'c'
+	# The file was deleted or moved out of the directory
+	REMOVED = 'r'
+
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+inotify_event = struct.Struct('iIII')
+
+libc = None
+def load_inotify():
+	global libc
+	if libc is None and sys.platform.startswith('linux'):
+		try:
+			lib = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			lib.inotify_init1, lib.inotify_add_watch
+			libc = lib
+		except (OSError, AttributeError):
+			pass
+	return libc
+
+
+class Watcher:
+	def __init__(self, directory, callback, recursive=False, poll_interval=1.0):
+		self.directory = os.path.abspath(directory)
+		self.callback = callback
+		self.recursive = recursive
+		self.poll_interval = poll_interval
+		self.thread = None
+		self.stop_event = threading.Event()
+		# Written to in order to wake the inotify thread when stopping
+		self.wake_pipe = None
+		self.inotify_fd = -1
+		# watch descriptor -> directory
+		self.watches = {}
+
+	def uses_inotify(self):
+		return load_inotify() is not None
+
+	def start(self):
+		os.makedirs(self.directory, exist_ok=True)
+		self.stop_event.clear()
+		if self.uses_inotify():
+			self.inotify_fd = libc.inotify_init1(IN_CLOEXEC)
+		if self.inotify_fd >= 0:
+			self.wake_pipe = os.pipe()
+			self.add_watch(self.directory)
+			target = self.inotify_func
+		else:
+			target = self.poll_func
+		self.thread = threading.Thread(target=target, name='Watcher', daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		if self.thread is None:
+			return
+		self.stop_event.set()
+		if self.wake_pipe is not None:
+			os.write(self.wake_pipe[1], b'\0')
+		if self.thread is not threading.current_thread():
+			self.thread.join()
+		self.thread = None
+		if self.inotify_fd >= 0:
+			os.close(self.inotify_fd)
+			self.inotify_fd = -1
+			self.watches = {}
+		if self.wake_pipe is not None:
+			os.close(self.wake_pipe[0])
+			os.close(self.wake_pipe[1])
+			self.wake_pipe = None
+
+	def add_watch(self, directory):
+		wd = libc.inotify_add_watch(self.inotify_fd, os.fsencode(directory), IN_WATCH_MASK)
+		if wd < 0:
+			return
+		self.watches[wd] = directory
+		if self.recursive:
+			for entry in os.scandir(directory):
+				if entry.is_dir(follow_symlinks=False):
+					self.add_watch(entry.path)
+
+	def inotify_func(self):
+		while not self.stop_event.is_set():
+			readable, _, _ = select.select([self.inotify_fd, self.wake_pipe[0]], [], [])
+			if self.inotify_fd not in readable:
+				continue
+			try:
+				data = os.read(self.inotify_fd, 65536)
+			except OSError:
+				return
+			events = []
+			offset = 0
+			while offset < len(data):
+				wd, mask, cookie, length = inotify_event.unpack_from(data, offset)
+				offset += inotify_event.size
+				name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+				offset += length
+				directory = self.watches.get(wd, None)
+				if directory is None or name == '':
+					continue
+				path = os.path.join(directory, name)
+				if mask & IN_ISDIR:
+					if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+						self.add_watch(path)
+				elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+					events.append((path, Event.CHANGED))
+				elif mask & (IN_DELETE | IN_MOVED_FROM):
+					events.append((path, Event.REMOVED))
+			if len(events) > 0:
+				self.callback(events)
+
+	# Returns {path: (mtime, size)} for every file being watched
+	def snapshot(self):
+		result = {}
+		dirs = [self.directory]
+		while len(dirs) > 0:
+			try:
+				entries = list(os.scandir(dirs.pop()))
+			except OSError:
+				continue
+			for entry in entries:
+				try:
+					if entry.is_dir(follow_symlinks=False):
+						if self.recursive:
+							dirs.append(entry.path)
+					else:
+						st = entry.stat()
+						result[entry.path] = (st.st_mtime_ns, st.st_size)
+				except OSError:
+					pass
+		return result
+
+	def poll_func(self):
+		previous = self.snapshot()
+		while not self.stop_event.wait(self.poll_interval):
+			current = self.snapshot()
+			events = [(path, Event.CHANGED) for path, st in current.items() if previous.get(path, None) != st]
+			events += [(path, Event.REMOVED) for path in previous if path not in current]
+			previous = current
+			if len(events) > 0:
+				self.callback(events)
@@ -0,0 +1,285 @@
+import os
+import json
+import mmap
+import struct
+
+
+'''
+history
+A compact binary format for the lists of completed and failed tasks, which only ever grow
+Reading the newest entries only touches those entries, so it takes the same time however long the history is
+
+A history file is a FILE_HEADER followed by records, oldest first. Each record is:
+	RECORD_HEADER: task type id, blend file id, elapsed time, time finished, exit code, payload length
+	payload: JSON of any other arguments and the task's info (empty if there are none)
+	RECORD_TRAILER: the length of the whole record, so the file can be read backwards from the end
+A record cut short at the end (e.g. by a crash while appending) is skipped when reading, by reading forwards
+from the start instead, and removed before the next append
+Files are read through mmap, and records are only decoded as they are iterated over
+
+Task types and blend file paths are stored once in a StringTable shared by all history files and referred to by id
+Both files are only ever appended to, except when a history is cleared or trimmed
+'''
+
+
+MAGIC = b'LRQH'
+VERSION = 1
+
+FILE_HEADER = struct.Struct('<4sHH')
+RECORD_HEADER = struct.Struct('<IIddiI')
+RECORD_TRAILER = struct.Struct('<I')
+STRING_HEADER = struct.Struct('<I')
+
+# The id of a string that is not present, e.g. the file of a task without arguments
+NO_STRING = 0xFFFFFFFF
+
+
+class HistoryError(Exception):
+	pass
+
+
+# One entry of a history
+class Record:
+	__slots__ = ('type', 'args', 'time', 'finished', 'exit_code', 'info')
+
+	def __init__(self, type : str, args : list, time : float, finished : float, exit_code : int, info : dict):
+		self.type = type
+		self.args = args
+		self.time = time
+		self.finished = finished
+		self.exit_code = exit_code
+		self.info = info
+
+
+# Strings referred to by id. Ids are indices in order of addition, so the table can only be appended to
+# Other processes may add strings at any time; unknown ids cause the new part of the file to be read
+class StringTable:
+	__slots__ = ('filename', 'strings', 'ids', 'size')
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.strings = []
+		self.ids = {}
+		# The number of bytes of the file that have been read
+		self.size = 0
+
+	# Reads strings added since the last call
+	def load_new(self):
+		try:
+			with open(self.filename, 'rb') as f:
+				f.seek(self.size)
+				data = f.read()
+		except OSError:
+			return
+		pos = 0
+		while pos + STRING_HEADER.size <= len(data):
+			length, = STRING_HEADER.unpack_from(data, pos)
+			end = pos + STRING_HEADER.size + length
+			if end > len(data):
+				break
+			string = data[pos + STRING_HEADER.size:end].decode('utf-8')
+			self.ids[string] = len(self.strings)
+			self.strings.append(string)
+			pos = end
+		self.size += pos
+
+	def get(self, id):
+		if id == NO_STRING:
+			return None
+		if id >= len(self.strings):
+			self.load_new()
+			if id >= len(self.strings):
+				raise HistoryError(f'Unknown string id {id}')
+		return self.strings[id]
+
+	# Returns the id of the string, adding it if necessary. The disk must be locked by the caller
+	def intern(self, string):
+		if string is None:
+			return NO_STRING
+		id = self.ids.get(string, None)
+		if id is not None:
+			return id
+		self.load_new()
+		id = self.ids.get(string, None)
+		if id is not None:
+			return id
+		encoded = string.encode('utf-8')
+		with open(self.filename, 'ab') as f:
+			f.write(STRING_HEADER.pack(len(encoded)) + encoded)
+		self.load_new()
+		return self.ids[string]
+
+
+# A history file. lock is a context manager that locks the disk for other threads and processes
+class History:
+	def __init__(self, filename, strings : StringTable, lock):
+		self.filename = filename
+		self.strings = strings
+		self.lock = lock
+
+	def encode(self, record : Record) -> bytes:
+		extra = {}
+		if len(record.args) > 1:
+			extra['args'] = record.args[1:]
+		if len(record.info) > 0:
+			extra['info'] = record.info
+		payload = json.dumps(extra).encode() if len(extra) > 0 else b''
+		length = RECORD_HEADER.size + len(payload) + RECORD_TRAILER.size
+		return RECORD_HEADER.pack(self.strings.intern(record.type),
+			self.strings.intern(record.args[0] if len(record.args) > 0 else None),
+			record.time, record.finished, record.exit_code, len(payload)) + payload + RECORD_TRAILER.pack(length)
+
+	def decode(self, data, offset) -> Record:
+		type_id, file_id, time, finished, exit_code, payload_length = RECORD_HEADER.unpack_from(data, offset)
+		start = offset + RECORD_HEADER.size
+		extra = json.loads(bytes(data[start:start + payload_length])) if payload_length > 0 else {}
+		file = self.strings.get(file_id)
+		args = ([file] if file is not None else []) + extra.get('args', [])
+		return Record(self.strings.get(type_id), args, time, finished, exit_code, extra.get('info', {}))
+
+	# Appends the given records (oldest first)
+	# A record cut short at the end of the file (e.g. by a crash while appending) is removed first
+	def append(self, records):
+		with self.lock():
+			data = b''.join(self.encode(r) for r in records)
+			self.repair()
+			try:
+				size = os.path.getsize(self.filename)
+			except OSError:
+				size = 0
+			with open(self.filename, 'ab') as f:
+				if size < FILE_HEADER.size:
+					# A file cut short before its header was written (see map()) is started again
+					f.truncate(0)
+					f.write(FILE_HEADER.pack(MAGIC, VERSION, 0))
+				f.write(data)
+
+	# Replaces the whole history with the given records (oldest first)
+	def write(self, records):
+		with self.lock():
+			data = b''.join(self.encode(r) for r in records)
+			tmp = f'{self.filename}.{os.getpid()}.tmp'
+			with open(tmp, 'wb') as f:
+				f.write(FILE_HEADER.pack(MAGIC, VERSION, 0) + data)
+			os.replace(tmp, self.filename)
+
+	def clear(self):
+		with self.lock():
+			if os.path.exists(self.filename):
+				os.remove(self.filename)
+
+	# Returns a read-only mmap of the file as it is now, or None if there is no history
+	# A file shorter than its header (e.g. after a crash while it was created) has no history
+	# Records appended later are not part of the map
+	def map(self):
+		with self.lock():
+			try:
+				with open(self.filename, 'rb') as f:
+					m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (OSError, ValueError):
+				return None
+		if len(m) < FILE_HEADER.size:
+			m.close()
+			return None
+		magic, version, _ = FILE_HEADER.unpack_from(m, 0)
+		if magic != MAGIC or version != VERSION:
+			m.close()
+			raise HistoryError(f'"{self.filename}" is not a history file of version {VERSION}')
+		return m
+
+	# Returns the offset of the record that ends at pos, or None if no valid record ends there
+	def record_before(self, m, pos):
+		if pos - RECORD_TRAILER.size < FILE_HEADER.size:
+			return None
+		length, = RECORD_TRAILER.unpack_from(m, pos - RECORD_TRAILER.size)
+		start = pos - length
+		if start < FILE_HEADER.size or length < RECORD_HEADER.size + RECORD_TRAILER.size or \
+			RECORD_HEADER.unpack_from(m, start)[5] + RECORD_HEADER.size + RECORD_TRAILER.size != length:
+			return None
+		return start
+
+	# Reads the records forwards from the start of the file, up to the first damaged one
+	# Returns (their offsets, oldest first, and the offset at which the valid records end)
+	def scan(self, m):
+		offsets = []
+		pos = FILE_HEADER.size
+		while pos + RECORD_HEADER.size + RECORD_TRAILER.size <= len(m):
+			end = pos + RECORD_HEADER.size + RECORD_HEADER.unpack_from(m, pos)[5] + RECORD_TRAILER.size
+			if end > len(m) or RECORD_TRAILER.unpack_from(m, end - RECORD_TRAILER.size)[0] != end - pos:
+				break
+			offsets.append(pos)
+			pos = end
+		return offsets, pos
+
+	# Truncates the file after its last valid record, if a record at its end was cut short
+	def repair(self):
+		with self.lock():
+			m = self.map()
+			if m is None:
+				return
+			try:
+				if len(m) <= FILE_HEADER.size or self.record_before(m, len(m)) is not None:
+					return
+				end = self.scan(m)[1]
+			finally:
+				m.close()
+			print(f'History "{self.filename}" ends with a damaged entry, which is removed')
+			os.truncate(self.filename, end)
+
+	# Yields the offsets of records, newest first
+	def offsets(self, m):
+		pos = len(m)
+		if pos > FILE_HEADER.size and self.record_before(m, pos) is None:
+			# A record cut short at the end (e.g. by a crash while appending) is skipped, and removed by the
+			# next append(). The records before it are found by reading from the start
+			yield from reversed(self.scan(m)[0])
+			return
+		while pos > FILE_HEADER.size:
+			start = self.record_before(m, pos)
+			if start is None:
+				print(f'History "{self.filename}" is damaged before byte {pos}; older entries are ignored')
+				return
+			yield start
+			pos = start
+
+	# Yields the records, newest first. Only the records iterated over are read
+	def iter_newest(self):
+		m = self.map()
+		if m is None:
+			return
+		try:
+			for offset in self.offsets(m):
+				yield self.decode(m, offset)
+		finally:
+			m.close()
+
+	# Returns the newest num records, newest first. If num is negative, returns all records
+	def newest(self, num=-1) -> list:
+		records = []
+		if num == 0:
+			return records
+		for record in self.iter_newest():
+			records.append(record)
+			if len(records) == num:
+				break
+		return records
+
+	# Removes all but the newest num records
+	def keep_newest(self, num):
+		with self.lock():
+			m = self.map()
+			if m is None:
+				return
+			try:
+				start = len(m)
+				for i, offset in enumerate(self.offsets(m)):
+					if i == num:
+						break
+					start = offset
+				data = m[start:]
+			finally:
+				m.close()
+			tmp = f'{self.filename}.{os.getpid()}.tmp'
+			with open(tmp, 'wb') as f:
+				f.write(FILE_HEADER.pack(MAGIC, VERSION, 0) + data)
+			os.replace(tmp, self.filename)
@@ -2,11 +2,18 @@
 import socket
 import threading
 import shlex
+import hashlib
+import uuid
+import json
+import time
 from pathlib import Path
 import os
 
 import __main__ as M
 import taskfile
+import bundle
+import capacity
+import events
 
 
 '''
@@ -16,6 +23,7 @@ When working over LAN, the script can run in one of 3 states:
 2. Server: the script receives tasks from a Client, renders them, and then returns the result
 3. Worker: the script shares a task list with a Server and helps it render
 If the current script instance is running as a server, a thread is created to monitor connections
+Each connection it accepts is handled on its own thread
 
 --- A Client/Worker -> Server connection goes as follows:
 1. C/S -> Server: Send a header with basic version/state info
@@ -25,8 +33,23 @@ If the current script instance is running as a server, a thread is created to mo
 3. C -> Server: Send the request to the server, as well as a header defining all supplementary files (if any)
 4. Server -> C: Send a response either accepting or refusing the request and supplementary files
 5. C -> Server: If supplementary files are needed, send them
+	- For ADD_TASK, the request is "addtask&<length of the task>". Once it is accepted, the client sends the task,
+	  and once that is accepted, the blend file and its dependencies as one bundle (see send_bundle())
 --- Worker:
-# TODO
+The worker's header includes its capacity (see capacity.py), which the server uses to choose its tasks
+3. W -> Server: Send a NEXT_TASK request
+4. Server -> W: Send "accept&<length of the task>", or REFUSE if no queued task suits the worker
+5. W -> Server: ACCEPT, then the server sends the task, followed by its bundle (see send_bundle())
+	- If the bundle is not received, the server puts the task back at the front of its queue
+	- Part of an animation may be sent, in which case the rest stays in the server's queue (see capacity.assign())
+	- The task is leased to the worker (see capacity.py). Outputs relative to the blend file are written where
+	  the server would write them (task.info['original_file']), so they end up on the storage the two share
+The worker queues the task it received and asks for another one once its queue is empty
+Every report_interval seconds, and as soon as a leased task ends, the worker sends a REPORT request instead:
+3. W -> Server: "report&<length of the report>"
+4. Server -> W: ACCEPT
+5. W -> Server: the report, JSON {"renew": [ids of the leases it still has], "ended": {lease id: result}}
+6. Server -> W: SUCCESS once it has recorded the results (see capacity.end_lease())
 ---
 6. All sockets are closed
 '''
@@ -44,16 +67,22 @@ current_LAN_ip_port = (None, None)
 
 current_socket = None
 
+# The directory in which bundles received from clients are unpacked. The cwd is used
+received_dir = 'tasks/received'
 
 # Basic communication definitions
 class Comm:
 	# The maximum number of bytes to accept at one time. Must be larger than the max Header size (see below)
 	BUFFER_LENGTH = 4096
 
+	# The number of bytes read from disk at a time when streaming bundles
+	STREAM_BUFFER_LENGTH = 1 << 20
+
 	ACCEPT = 'accept'
 	REFUSE = 'refuse'
 	DELIMITER = '&'
 	FILE = 'file'
+	BUNDLE = 'bundle'
 	SUCCESS = 'success'
 	FAILURE = 'failure'
 
@@ -65,6 +94,8 @@ class RequestType:
 	ADD_TASK = 'addtask'
 	# Ask the server for the next task from its queue
 	NEXT_TASK = 'nexttask'
+	# Renew the leases of tasks from the server, and report those that ended
+	REPORT = 'report'
 
 
 
@@ -74,10 +105,15 @@ class Header:
 	def __init__(self):
 		self.version = M.version
 		self.LANState = LANState.NONE
+		# A capacity.Capacity, sent by workers only
+		self.capacity = None
 		# TODO: Password, if appropriate
 	
 	def __str__(self):
-		return f'"{self.version}" "{self.LANState}"'
+		s = f'"{self.version}" "{self.LANState}"'
+		if self.capacity is not None:
+			s += ' ' + shlex.quote(str(self.capacity))
+		return s
 
 	# If parsing fails, returns None
 	def parse(string):
@@ -86,7 +122,9 @@ class Header:
 			tmp = Header()
 			tmp.version = tokens[0]
 			tmp.LANState = tokens[1]
-		except IndexError:
+			if len(tokens) > 2:
+				tmp.capacity = capacity.Capacity.parse(tokens[2])
+		except (IndexError, ValueError):
 			return None
 		return tmp
 
@@ -94,6 +132,8 @@ class Header:
 	def create_header():
 		tmp = Header()
 		tmp.LANState = current_LAN_state
+		if current_LAN_state == LANState.WORKER:
+			tmp.capacity = capacity.measure()
 		return tmp
 
 
@@ -103,6 +143,8 @@ class Header:
 
 server_thread = None
 server_continue = True
+# Seconds between checks for leases that have ended (see capacity.expire_leases())
+lease_check_interval = 30.0
 def server_thread_func():
 	global current_LAN_state
 	global current_LAN_ip_port
@@ -110,32 +152,50 @@ def server_thread_func():
 	global server_thread
 	current_socket.listen()
 	current_socket.settimeout(1.0)
+	next_lease_check = 0
 	while server_continue:
+		if time.time() >= next_lease_check:
+			if capacity.expire_leases() > 0:
+				M.bgd_thread.notify_thread()
+			next_lease_check = time.time() + lease_check_interval
 		try:
 			connection, address = current_socket.accept()
 		except socket.timeout:
 			continue
-		print(f'Connected to {address}')
-		
+		# Each connection has its own thread, so a slow one (e.g. a bundle being remapped) does not hold up others
+		threading.Thread(target=server_handle_connection, args=[connection, address], daemon=True).start()
+
+	# Clean up
+	current_socket.close()
+	current_socket = None
+
+
+# Handles a connection accepted by the server thread, on its own thread. The connection is closed once it ends
+def server_handle_connection(connection : socket.socket, address):
+	print(f'Connected to {address}')
+	try:
 		# Wait for a header
 		header = receive_string(connection)
 		if header is None:
 			print('Connection failed')
-			continue
+			return
 		header = Header.parse(header)
-		if header.version != M.version:
+		if header is None or header.version != M.version:
 			# Wrong version, refuse the connection
 			send_data(connection, Comm.REFUSE)
-			continue
+			return
 		send_data(connection, Comm.ACCEPT)
 		print(f'Connection accepted from instance of type "{header.LANState}"')
-		
+		if header.LANState == LANState.CLIENT:
+			server_handle_request(connection)
+		elif header.LANState == LANState.WORKER:
+			# Workers that do not send their capacity count as one idle core
+			server_handle_worker(connection, address[0], header.capacity or capacity.Capacity())
+	except OSError:
+		print(f'Connection to {address} lost')
+	finally:
 		connection.close()
 
-	# Clean up
-	current_socket.close()
-	current_socket = None
-
 
 
 def make_client(ip, port):
@@ -156,6 +216,7 @@ def make_client(ip, port):
 		return
 	print(f'Connected to {ip} on port {port}')
 	current_LAN_state = LANState.CLIENT
+	current_LAN_ip_port = (ip, port)
 	# Send header
 	send_data(current_socket, str(Header.create_header()))
 	# Get response
@@ -213,11 +274,19 @@ def make_worker(ip, port):
 	global current_LAN_ip_port
 	global current_socket
 	global server_thread
+	global worker_thread
 	if current_LAN_state != LANState.NONE:
 		print(M.get_col('RED') + "The script is already in an LAN-enabled state. Run 'disconnect' first\n" +
 		M.get_col('RESET'))
 		return
-	pass
+	current_LAN_state = LANState.WORKER
+	current_LAN_ip_port = (ip, port)
+	events.subscribe(worker_on_event)
+	worker_stop.clear()
+	worker_thread = threading.Thread(target=worker_thread_func, name='Worker', daemon=True)
+	worker_thread.start()
+	print(M.get_col('CYAN') + f"Working for the server at {ip} on port {port}")
+	print(f"Capacity: {capacity.measure().desc()}\n" + M.get_col('RESET'))
 
 def disconnect():
 	global current_LAN_state
@@ -228,6 +297,10 @@ def disconnect():
 	server_continue = False
 	if current_LAN_state == LANState.SERVER:
 		server_thread.join()
+	elif current_LAN_state == LANState.WORKER:
+		worker_stop.set()
+		worker_thread.join()
+		events.unsubscribe(worker_on_event)
 	current_LAN_state = LANState.NONE
 	current_LAN_ip_port = (None, None)
 	print("Disconnected")
@@ -314,6 +387,346 @@ def receive_file(socket : socket.socket, destination : Path):
 
 
 
+# Receives exactly amount bytes from the socket. If the connection fails first, returns None
+def receive_exact(socket : socket.socket, amount):
+	chunks = []
+	while amount > 0:
+		data = receive_data(socket, min(Comm.STREAM_BUFFER_LENGTH, amount))
+		if data is None or len(data) == 0:
+			return None
+		chunks.append(data)
+		amount -= len(data)
+	return b''.join(chunks)
+
+
+# Sends a job bundle (see bundle.Manifest) as one streamed transfer:
+# 1. Sender -> Receiver: "bundle&<manifest length>&<total size>"
+# 2. Receiver -> Sender: ACCEPT or REFUSE
+# 3. Sender -> Receiver: The manifest, followed by the contents of every file in manifest order, back to back
+# 4. Receiver -> Sender: SUCCESS or FAILURE, once all hashes have been verified
+# Returns whether the bundle was successfully sent
+def send_bundle(socket : socket.socket, manifest : bundle.Manifest):
+	meta = str(manifest).encode()
+	send_data(socket, f'{Comm.BUNDLE}{Comm.DELIMITER}{len(meta)}{Comm.DELIMITER}{manifest.total_size()}')
+	if not await_msg(socket, Comm.ACCEPT):
+		return False
+	send_data(socket, meta)
+	for f in manifest.files:
+		with open(f.path, 'rb') as file:
+			# sendfile() avoids copying through Python where the OS supports it
+			sent = socket.sendfile(file, 0, f.size)
+		if sent != f.size:
+			print(f'"{f.path}" changed size while being sent')
+			return False
+	return await_msg(socket, Comm.SUCCESS)
+
+
+# Receives a job bundle into the destination directory, and points its blend file at the received dependencies
+# Returns the received manifest, with paths pointing into destination, or None on failure
+def receive_bundle(socket : socket.socket, destination : Path):
+	destination = Path(destination).absolute()
+	meta = receive_string(socket)
+	splitmeta = meta.split(Comm.DELIMITER) if meta is not None else []
+	if len(splitmeta) != 3 or splitmeta[0] != Comm.BUNDLE:
+		print('Expected a bundle')
+		send_data(socket, Comm.REFUSE)
+		return None
+	try:
+		meta_size, total_size = int(splitmeta[1]), int(splitmeta[2])
+	except ValueError:
+		send_data(socket, Comm.REFUSE)
+		return None
+	# Same limit as receive_file()
+	if total_size > 10000000000 or total_size <= 0 or meta_size <= 0:
+		print('Invalid bundle size')
+		send_data(socket, Comm.REFUSE)
+		return None
+	send_data(socket, Comm.ACCEPT)
+	meta = receive_exact(socket, meta_size)
+	try:
+		manifest = bundle.Manifest.parse(meta.decode())
+	except (AttributeError, ValueError, KeyError):
+		send_data(socket, Comm.FAILURE)
+		return None
+	if manifest.total_size() != total_size:
+		send_data(socket, Comm.FAILURE)
+		return None
+	originals = [f.path for f in manifest.files]
+	for f in manifest.files:
+		path = destination.joinpath(f.name).resolve()
+		# Never write outside of the destination directory
+		if destination not in path.parents:
+			print(f'Refusing bundle entry "{f.name}"')
+			send_data(socket, Comm.FAILURE)
+			return None
+		os.makedirs(path.parent, exist_ok=True)
+		h = hashlib.sha256()
+		remaining = f.size
+		with open(path, 'wb') as file:
+			while remaining > 0:
+				data = receive_data(socket, min(Comm.STREAM_BUFFER_LENGTH, remaining))
+				if data is None or len(data) == 0:
+					return None
+				h.update(data)
+				file.write(data)
+				remaining -= len(data)
+		if h.hexdigest() != f.sha256:
+			print(f'Hash mismatch for bundle entry "{f.name}"')
+			send_data(socket, Comm.FAILURE)
+			return None
+		f.path = str(path)
+	send_data(socket, Comm.SUCCESS)
+	# The sender does not wait for this. If it fails, dependencies at the same paths here are still found
+	bundle.remap_received(manifest, originals)
+	return manifest
+
+
+# The largest task a server accepts from a client, in bytes
+max_task_size = 10000000
+
+# Handles a request from a client whose connection was just accepted
+def server_handle_request(connection : socket.socket):
+	request = receive_string(connection)
+	if request is None:
+		return
+	splitrequest = request.split(Comm.DELIMITER, 1)
+	if splitrequest[0] == RequestType.ADD_TASK and len(splitrequest) == 2:
+		# The task may not fit in one buffer, so its length is sent first
+		try:
+			length = int(splitrequest[1])
+		except ValueError:
+			send_data(connection, Comm.REFUSE)
+			return
+		if length <= 0 or length > max_task_size:
+			send_data(connection, Comm.REFUSE)
+			return
+		send_data(connection, Comm.ACCEPT)
+		data = receive_exact(connection, length)
+		if data is None:
+			print('Connection lost')
+			return
+		try:
+			task = taskfile.Task.parse(data.decode())
+		except (IndexError, ValueError):
+			send_data(connection, Comm.REFUSE)
+			return
+		send_data(connection, Comm.ACCEPT)
+		manifest = receive_bundle(connection, Path(received_dir).joinpath(uuid.uuid4().hex))
+		if manifest is None:
+			print('Failed to receive task bundle')
+			return
+		# Options such as tiles are kept; the id is the client's, so a new one is assigned
+		info = {k: v for k, v in task.info.items() if k != 'id'}
+		taskfile.create_task(task.type, [manifest.blend().path] + task.args[1:], info=info)
+		M.bgd_thread.notify_thread()
+		print(f'Received task for "{task.args[0]}"')
+	else:
+		send_data(connection, Comm.REFUSE)
+
+
 # Only call if the current LAN state is CLIENT
+# Sends the task to the server, along with the bundle of its blend file and all dependencies
+# Returns whether the task was queued on the server
 def client_send_task(task : taskfile.Task):
-	pass
\ No newline at end of file
+	manifest = bundle.preflight(task)
+	if manifest is None:
+		return False
+	sock = socket.socket()
+	try:
+		sock.connect(current_LAN_ip_port)
+		send_data(sock, str(Header.create_header()))
+		if not await_msg(sock, Comm.ACCEPT):
+			print('Connection refused')
+			return False
+		data = str(task).encode()
+		send_data(sock, f'{RequestType.ADD_TASK}{Comm.DELIMITER}{len(data)}')
+		if not await_msg(sock, Comm.ACCEPT):
+			print('Task refused')
+			return False
+		send_data(sock, data)
+		if not await_msg(sock, Comm.ACCEPT):
+			print('Task refused')
+			return False
+		return send_bundle(sock, manifest)
+	except OSError:
+		print('Connection lost')
+		return False
+	finally:
+		sock.close()
+
+# Handles a request from a worker whose connection was just accepted
+# name identifies the worker, and worker_capacity is the capacity it sent
+def server_handle_worker(connection : socket.socket, name, worker_capacity : capacity.Capacity):
+	request = receive_string(connection)
+	if request is not None and request.startswith(RequestType.REPORT + Comm.DELIMITER):
+		server_handle_report(connection, name, request)
+		return
+	if request != RequestType.NEXT_TASK:
+		send_data(connection, Comm.REFUSE)
+		return
+	assigned = capacity.assign(name, worker_capacity)
+	if assigned is None:
+		send_data(connection, Comm.REFUSE)
+		return
+	task, charged = assigned
+	task.info['lease'] = uuid.uuid4().hex
+	# Leased before it is sent, so a fast worker's report always finds it
+	capacity.lease(task, name)
+	sent = False
+	try:
+		manifest = bundle.preflight(task)
+		if manifest is not None:
+			data = str(task).encode()
+			send_data(connection, f'{Comm.ACCEPT}{Comm.DELIMITER}{len(data)}')
+			if await_msg(connection, Comm.ACCEPT):
+				send_data(connection, data)
+				sent = send_bundle(connection, manifest)
+	except OSError:
+		pass
+	if sent:
+		print(f'Sent task for "{task.args[0]}" to worker {name}')
+	else:
+		print(f'Failed to send task for "{task.args[0]}" to worker {name}')
+		# Nothing is lost: the task (or part of one) is run here instead, and charged when it runs
+		capacity.refund(task, charged)
+		capacity.end_lease(task.info['lease'], name, {'result': 'returned'})
+		M.bgd_thread.notify_thread()
+
+# Handles a REPORT request (see above) from the worker with the given name
+def server_handle_report(connection : socket.socket, name, request):
+	try:
+		length = int(request.split(Comm.DELIMITER)[1])
+	except (IndexError, ValueError):
+		send_data(connection, Comm.REFUSE)
+		return
+	if length <= 0 or length > max_report_size:
+		send_data(connection, Comm.REFUSE)
+		return
+	send_data(connection, Comm.ACCEPT)
+	data = receive_exact(connection, length)
+	try:
+		report = json.loads(data.decode())
+		for id, result in report.get('ended', {}).items():
+			capacity.end_lease(id, name, result)
+		capacity.renew(report.get('renew', []), name)
+	except (AttributeError, ValueError, TypeError, KeyError) as e:
+		print(f'Invalid report from worker {name}: {e}')
+		send_data(connection, Comm.FAILURE)
+		return
+	send_data(connection, Comm.SUCCESS)
+	if len(report.get('ended', {})) > 0:
+		M.bgd_thread.notify_thread()
+
+
+# The worker asks the server for a task whenever it has nothing to do, at most once every worker_interval seconds
+worker_interval = 5.0
+# Seconds between the reports that renew a worker's leases. Must be well below capacity.lease_timeout
+report_interval = 60.0
+# The largest report a server accepts, in bytes
+max_report_size = 10000000
+worker_thread = None
+worker_stop = threading.Event()
+
+# Lease id -> the result (see capacity.end_lease()) of a leased task that ended on this worker, not yet reported
+worker_results = {}
+worker_results_mutex = threading.Lock()
+
+def worker_thread_func():
+	last_report = 0
+	while not worker_stop.is_set():
+		with worker_results_mutex:
+			ended = len(worker_results) > 0
+		if ended or time.time() - last_report >= report_interval:
+			if worker_send_report():
+				last_report = time.time()
+		if taskfile.get_current_task() is None and taskfile.num_tasks() == 0:
+			worker_request_task()
+		worker_stop.wait(worker_interval)
+
+# Subscribed to events.py while this is a worker: keeps the results of leased tasks for the next report
+def worker_on_event(kind, data):
+	task = data.get('task', None)
+	if kind not in ('completed', 'failed', 'discarded') or task is None or 'lease' not in task.info:
+		return
+	result = {
+		# A skipped task is given back to the server
+		'result': 'returned' if kind == 'discarded' else kind,
+		'time': task.time,
+		'finished': getattr(task, 'finished', None),
+		'exit_code': getattr(task, 'exit_code', None),
+		'info': dict(task.info),
+	}
+	with worker_results_mutex:
+		worker_results[task.info['lease']] = result
+
+# Only call if the current LAN state is WORKER
+# Renews the leases of the tasks from the server that are still here, and reports those that ended
+# Returns whether the server recorded the report
+def worker_send_report():
+	import preempt
+	held = [taskfile.get_current_task()] + taskfile.read_tasks() + preempt.read_suspended()
+	with worker_results_mutex:
+		ended = dict(worker_results)
+	report = {'renew': [t.info['lease'] for t in held if t is not None and 'lease' in t.info], 'ended': ended}
+	if len(report['renew']) == 0 and len(ended) == 0:
+		return True
+	data = json.dumps(report).encode()
+	sock = socket.socket()
+	try:
+		sock.connect(current_LAN_ip_port)
+		send_data(sock, str(Header.create_header()))
+		if not await_msg(sock, Comm.ACCEPT):
+			return False
+		send_data(sock, f'{RequestType.REPORT}{Comm.DELIMITER}{len(data)}')
+		if not await_msg(sock, Comm.ACCEPT):
+			return False
+		send_data(sock, data)
+		if not await_msg(sock, Comm.SUCCESS):
+			return False
+	except OSError:
+		return False
+	finally:
+		sock.close()
+	with worker_results_mutex:
+		for id in ended:
+			worker_results.pop(id, None)
+	return True
+
+# Only call if the current LAN state is WORKER
+# Asks the server for a task and queues it, along with its bundle
+# Returns whether a task was queued
+def worker_request_task():
+	sock = socket.socket()
+	try:
+		sock.connect(current_LAN_ip_port)
+		send_data(sock, str(Header.create_header()))
+		if not await_msg(sock, Comm.ACCEPT):
+			print('Connection refused')
+			return False
+		send_data(sock, RequestType.NEXT_TASK)
+		response = receive_string(sock)
+		tokens = response.split(Comm.DELIMITER) if response is not None else []
+		if len(tokens) != 2 or tokens[0] != Comm.ACCEPT:
+			# The server has nothing for this worker
+			return False
+		send_data(sock, Comm.ACCEPT)
+		data = receive_exact(sock, int(tokens[1]))
+		if data is None:
+			print('Connection lost')
+			return False
+		task = taskfile.Task.parse(data.decode())
+		manifest = receive_bundle(sock, Path(received_dir).joinpath(uuid.uuid4().hex))
+		if manifest is None:
+			print('Failed to receive task bundle')
+			return False
+		# Relative outputs are written where the server would write them
+		task.info['original_file'] = task.args[0]
+		taskfile.create_task(task.type, [manifest.blend().path] + task.args[1:], info=task.info)
+		M.bgd_thread.notify_thread()
+		print(f'Received task for "{task.args[0]}" from the server')
+		return True
+	except (OSError, ValueError, IndexError):
+		print('Connection lost')
+		return False
+	finally:
+		sock.close()
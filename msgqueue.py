@@ -12,8 +12,10 @@ I.e., these messages are only relevant within one runtime; these messages do not
 
 
 class MessageType:
+	# arg: the index at which to re-insert the current task, or None to discard it
 	SKIP = 's'
 	QUIT = 'q'
+	# arg: the process (see tasks.run_task()) that finished
 	COMPLETE = 'c'
 	FAILED = 'f'
 
@@ -23,14 +25,14 @@ msg_queue = queue.Queue()
 
 
 
-# Adds a message of the specified MessageType
-def add_message(type):
-	msg_queue.put(type)
+# Adds a message of the specified MessageType. arg is passed to the handler of the message
+def add_message(type, arg=None):
+	msg_queue.put((type, arg))
 	__main__.bgd_thread.notify_thread()
 
 
 
-# Gets the next message from the queue if there is one, otherwise returns None
+# Gets the next message from the queue as (MessageType, arg) if there is one, otherwise returns None
 def next_message():
 	try:
 		return msg_queue.get_nowait()
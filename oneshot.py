@@ -0,0 +1,122 @@
+import os
+import sys
+import copy
+import json
+
+import taskfile
+
+
+'''
+oneshot
+Runs a single command given on the command line and exits, without starting the queue, e.g.
+	python RenderQueue render a.blend b.blend preview
+	python RenderQueue status --json --limit 10
+Meant for scripts and pipeline hooks, so it only imports what the command needs: nothing starts a thread,
+opens a socket or launches Blender. Tasks are added to the task list directly; a running queue picks them up
+as soon as the file changes (see bgdthread.py)
+
+Commands:
+	render/r, still/s, bake/b <filepath ...> [preset] [setting=value ...] [-- filepath ...]
+		Queues every file with the same options (see tasks.parse_task_options()), with a single rewrite of the
+		task list. Prints the id of each task, one per line
+		Blend files and existing files are never taken for options; files after "--" are never options either
+	status [--json] [--limit n]
+		Prints the current, queued, suspended, completed and failed tasks. --limit applies to each list
+		With --json, prints one JSON object with a key per list, as the control endpoint's query op does
+Exits with 0 on success, 1 if the command failed and 2 if it was used incorrectly
+
+bench.py measures how long these take and fails if it is more than target_s
+'''
+
+
+# The time in seconds a one-shot status or render should take, including starting Python (see bench.py)
+target_s = 0.15
+
+USAGE = '''Usage:
+	render/r, still/s, bake/b <filepath ...> [preset] [setting=value ...] [-- filepath ...]
+	status [--json] [--limit n]'''
+
+
+def usage_error(message):
+	print(message, file=sys.stderr)
+	print(USAGE, file=sys.stderr)
+	return 2
+
+
+def queue_files(type, args):
+	import tasks
+	# Arguments after "--" are all files. Otherwise blend files and existing files are files, even if their name
+	# is that of a preset or contains "=", and options are presets or setting=value
+	if '--' in args:
+		split = args.index('--')
+		args, files = args[:split], args[split + 1:]
+	else:
+		files = []
+	is_file = lambda a: a.lower().endswith('.blend') or os.path.exists(a)
+	files = [a for a in args if is_file(a) or (a not in tasks.PRESETS and '=' not in a)] + files
+	options = [a for a in args if not is_file(a) and (a in tasks.PRESETS or '=' in a)]
+	if len(files) == 0:
+		return usage_error('No blend files given')
+	try:
+		info = tasks.parse_task_options(options, type)
+	except ValueError as e:
+		print(e, file=sys.stderr)
+		return 1
+	invalid = [f for f in files if not tasks.is_valid_blend(f)]
+	for f in invalid:
+		print(f"'{f}' is not a valid blend file", file=sys.stderr)
+	if len(invalid) > 0:
+		return 1
+	# The queue may run in another directory
+	new_tasks = [taskfile.Task(type, [os.path.abspath(f)], info=copy.deepcopy(info)) for f in files]
+	taskfile.create_tasks(new_tasks)
+	for task in new_tasks:
+		print(task.id())
+	return 0
+
+def status(args):
+	import preempt
+	as_json = '--json' in args
+	rest = [a for a in args if a != '--json']
+	limit = -1
+	if len(rest) == 2 and rest[0] == '--limit':
+		try:
+			limit = int(rest[1])
+		except ValueError:
+			return usage_error(f"Invalid limit '{rest[1]}'")
+	elif len(rest) > 0:
+		return usage_error(f"Unknown arguments: {' '.join(rest)}")
+	current = taskfile.get_current_task()
+	lists = {
+		'queued': taskfile.read_tasks(),
+		'suspended': preempt.read_suspended(),
+		'completed': taskfile.read_completed(limit),
+		'failed': taskfile.read_failed(limit),
+	}
+	if limit >= 0:
+		lists = {name: tasks[:limit] for name, tasks in lists.items()}
+	if as_json:
+		result = {'current': current.to_dict() if current is not None else None}
+		result.update({name: [t.to_dict() for t in tasks] for name, tasks in lists.items()})
+		print(json.dumps(result))
+		return 0
+	print('Current: ' + (current.desc() if current is not None else 'none'))
+	for name, tasks in lists.items():
+		print(f'{name.capitalize()}: {len(tasks)}')
+		for i, task in enumerate(tasks):
+			print(f'{i + 1}. {task.desc()}')
+	return 0
+
+
+# Runs the command in argv (without the program name). Returns the exit code
+def main(argv):
+	command, args = argv[0], argv[1:]
+	if command in ('render', 'r'):
+		return queue_files(taskfile.TaskType.RENDER_ANIMATION, args)
+	elif command in ('still', 's'):
+		return queue_files(taskfile.TaskType.RENDER_STILL, args)
+	elif command in ('bake', 'b'):
+		return queue_files(taskfile.TaskType.BAKE, args)
+	elif command == 'status':
+		return status(args)
+	return usage_error(f"Unknown command '{command}'")
@@ -0,0 +1,153 @@
+import os
+import json
+
+import taskfile
+
+
+'''
+phases
+Collects the timing events that brender.py writes while rendering and turns them into time per phase
+
+Phases:
+	startup: launching Blender until it is ready to load the blend file
+	load: loading the blend file (and running brender.py's setup)
+	init: preparing the render, before the first frame starts
+	sync: per frame, until the BVH build starts (scene/object synchronization)
+	bvh: per frame, building the BVH
+	sampling: per frame, rendering samples
+	write: per frame, writing the image to disk
+A task that is resumed runs Blender again; the phases of all runs are added together
+brender.py also reports the images it is expected to write, which verify.py checks once the task completes
+
+When a task finishes, its summary is stored in task.info['phases'] (phase -> seconds) and
+task.info['frames'] (the number of frames written)
+'''
+
+
+# The directory in which the event files of running tasks are stored. The cwd is used
+phases_dir = 'tasks/phases'
+
+# The order in which phases happen (and are printed)
+PHASES = ['startup', 'load', 'init', 'sync', 'bvh', 'sampling', 'write']
+
+
+def phases_filename(task : taskfile.Task):
+	id = task.id()
+	return os.path.join(phases_dir, f'{id if id is not None else "current"}.jsonl')
+
+# Returns the list of events written for the task so far
+def read_events(task : taskfile.Task):
+	events = []
+	try:
+		with open(phases_filename(task), 'r') as f:
+			for line in f:
+				try:
+					events.append(json.loads(line))
+				except ValueError:
+					# The last line may still be being written
+					pass
+	except OSError:
+		pass
+	return events
+
+# Reads the events of a task as they are written, reading only the part of the file that is new
+class EventReader:
+	def __init__(self, task : taskfile.Task):
+		self.filename = phases_filename(task)
+		self.offset = 0
+
+	# Returns the events written since the last call
+	def read_new(self):
+		events = []
+		try:
+			with open(self.filename, 'r') as f:
+				f.seek(self.offset)
+				for line in f:
+					# The last line may still be being written; it is read again next time
+					if not line.endswith('\n'):
+						break
+					self.offset += len(line.encode())
+					try:
+						events.append(json.loads(line))
+					except ValueError:
+						pass
+		except OSError:
+			pass
+		return events
+
+
+# Returns (phase -> seconds, list of written output paths) from a list of events
+def summarize(events):
+	totals = {}
+	outputs = []
+	def add(phase, start, end):
+		if start is not None and end is not None and end >= start:
+			totals[phase] = totals.get(phase, 0) + end - start
+	# The time of the previous event of each kind within the current run of Blender, and the current frame
+	run = {}
+	frame = {}
+	for e in events:
+		kind, t = e['event'], e['t']
+		if kind == 'startup':
+			run = {'startup': t}
+			frame = {}
+			add('startup', e.get('launch', None), t)
+		elif kind == 'loaded':
+			add('load', run.get('startup', None), t)
+			run['loaded'] = t
+		elif kind == 'init':
+			run['init'] = t
+		elif kind == 'frame_pre':
+			if 'frame_pre' not in run:
+				add('init', run.get('init', run.get('loaded', None)), t)
+			run['frame_pre'] = t
+			frame = {'frame_pre': t}
+		elif kind == 'bvh':
+			add('sync', frame.get('frame_pre', None), t)
+			frame['bvh'] = t
+		elif kind == 'sample':
+			if 'bvh' in frame:
+				add('bvh', frame['bvh'], t)
+			else:
+				add('sync', frame.get('frame_pre', None), t)
+			frame['sample'] = t
+		elif kind == 'frame_post':
+			add('sampling', frame.get('sample', frame.get('frame_pre', None)), t)
+			frame['frame_post'] = t
+		elif kind == 'write':
+			add('write', frame.get('frame_post', None), t)
+			# Stills report their image again after the render; only count it once
+			frame.pop('frame_post', None)
+			if e.get('path', None) is not None and e['path'] not in outputs:
+				outputs.append(e['path'])
+	return totals, outputs
+
+# Stores the task's phase summary in task.info and removes the event file
+# Returns the list of written output paths
+def attach(task : taskfile.Task):
+	events = read_events(task)
+	if len(events) == 0:
+		return []
+	totals, outputs = summarize(events)
+	task.info['phases'] = {p: round(totals[p], 3) for p in PHASES if p in totals}
+	task.info['frames'] = len(outputs)
+	try:
+		os.remove(phases_filename(task))
+	except OSError:
+		pass
+	return outputs
+
+# Returns a one line description of phase -> seconds, e.g. "load 2.0s (10%), sampling 18.0s (90%)"
+def desc(totals : dict):
+	total = sum(totals.values())
+	if total <= 0:
+		return 'none recorded'
+	return ', '.join(f'{p} {totals[p]:.1f}s ({100 * totals[p] / total:.0f}%)' for p in PHASES if p in totals)
+
+# Adds up the phases of many tasks. If totals is given, the phases are added to it
+def combine(task_list, totals : dict = None):
+	totals = totals if totals is not None else {}
+	for task in task_list:
+		for p, seconds in task.info.get('phases', {}).items():
+			totals[p] = totals.get(p, 0) + seconds
+	return totals
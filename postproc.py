@@ -0,0 +1,218 @@
+import os
+import json
+import queue
+import tempfile
+import threading
+from pathlib import Path
+
+import taskfile
+import tasks
+import blendfile
+import bundle
+
+
+'''
+postproc
+Runs post-processing steps on the outputs of completed tasks in a pool of worker threads,
+so the next render starts as soon as the previous one finishes instead of waiting for them
+
+Steps are requested per task with the "post" option, e.g. "render a.blend post=encode,checksum"
+	encode: encodes an image sequence into an H.264 video next to it with Blender's sequencer (see bpost.py)
+	thumbnails: writes a small JPEG of every image into a "thumbnails" directory next to it (see bpost.py)
+	checksum: writes the SHA-256 of every output into a checksums.sha256 file next to it (sha256sum format)
+Outputs are the files brender.py reported writing (see phases.py)
+
+The queue of jobs is bounded. If post-processing falls behind, submit() drops the job (and records that it did)
+rather than hold back the next render. A worker that dies is replaced by the next submit()
+The results of each job are appended to results_filename, one JSON object per line
+'''
+
+
+# The file to which the results of each job are appended. The cwd is used
+results_filename = 'tasks/postproc.txt'
+
+bpost_path = Path(__file__).parent.joinpath('bpost.py').absolute()
+
+# The steps that can be requested, in the order they are run
+STEPS = ['encode', 'thumbnails', 'checksum']
+
+# The number of jobs run at the same time. Encoding is itself multithreaded, so this is kept low
+max_workers = 2
+# The number of jobs that may wait for a worker before submit() drops new ones
+max_pending = 8
+
+# The size in pixels of the longest side of thumbnails
+THUMBNAIL_SIZE = 256
+
+# Outputs with these extensions are treated as images; anything else (e.g. a rendered video) is only checksummed
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.exr', '.tif', '.tiff', '.bmp', '.tga', '.hdr', '.webp', '.jp2', '.dpx'}
+
+
+class PostError(Exception):
+	pass
+
+
+class Job:
+	def __init__(self, task : taskfile.Task, outputs : list):
+		self.task = task
+		self.outputs = outputs
+
+
+jobs = queue.Queue(maxsize=max_pending)
+workers = []
+# The number of jobs currently being run by workers
+running = 0
+mutex = threading.Lock()
+# Set by stop(): workers finish the queued jobs and exit
+stopping = threading.Event()
+
+
+# Parses the value of the "post" option. Raises ValueError if a step is not recognized
+def parse_steps(value : str) -> list:
+	steps = [s for s in value.split(',') if s != '']
+	for step in steps:
+		if step not in STEPS:
+			raise ValueError(f"Unknown post-processing step '{step}'. Steps are: {', '.join(STEPS)}")
+	return steps
+
+def images(outputs):
+	return [p for p in outputs if Path(p).suffix.lower() in IMAGE_EXTENSIONS and os.path.isfile(p)]
+
+# Runs bpost.py with the given arguments. They are passed in a file, since a sequence may have thousands of frames
+def run_bpost(args : dict):
+	fd, args_filename = tempfile.mkstemp(prefix='lrq-post-', suffix='.json')
+	try:
+		with os.fdopen(fd, 'w') as f:
+			json.dump(args, f)
+		code = tasks.run_blender(None, bpost_path, [args_filename])
+	finally:
+		os.remove(args_filename)
+	if code != 0:
+		raise PostError(f'Blender exited with code {code}')
+
+
+def encode(job : Job):
+	frames = sorted(images(job.outputs))
+	if len(frames) < 2:
+		return {'skipped': 'Not an image sequence'}
+	directory = os.path.dirname(frames[0])
+	if any(os.path.dirname(f) != directory for f in frames):
+		raise PostError('The frames are not all in one directory')
+	info = blendfile.read_info(job.task.args[0])
+	output = os.path.join(directory, Path(job.task.args[0]).stem + '.mp4')
+	run_bpost({'mode': 'encode', 'output': output, 'fps': info.fps if info is not None else 24, 'frames': frames})
+	return {'output': output}
+
+def thumbnails(job : Job):
+	paths = images(job.outputs)
+	if len(paths) == 0:
+		return {'skipped': 'No images'}
+	outputs = [os.path.join(os.path.dirname(p), 'thumbnails', Path(p).stem + '.jpg') for p in paths]
+	run_bpost({'mode': 'thumbnails', 'size': THUMBNAIL_SIZE, 'images': list(zip(paths, outputs))})
+	return {'count': len(outputs)}
+
+def checksum(job : Job):
+	by_dir = {}
+	for path in job.outputs:
+		if os.path.isfile(path):
+			by_dir.setdefault(os.path.dirname(path), []).append(path)
+	if len(by_dir) == 0:
+		return {'skipped': 'No outputs'}
+	outputs = []
+	for directory, paths in by_dir.items():
+		output = os.path.join(directory, 'checksums.sha256')
+		with open(output, 'w') as f:
+			for path in sorted(paths):
+				f.write(f'{bundle.hash_file(path)}  {os.path.basename(path)}\n')
+		outputs.append(output)
+	return {'outputs': outputs}
+
+step_funcs = {
+	'encode': encode,
+	'thumbnails': thumbnails,
+	'checksum': checksum,
+}
+
+
+# Runs every requested step of a job. A failed step does not stop the others
+def run_job(job : Job):
+	results = {}
+	for step in STEPS:
+		if step not in job.task.info.get('post', []):
+			continue
+		try:
+			results[step] = step_funcs[step](job)
+		except Exception as e:
+			print(f'Post-processing step {step} failed for "{job.task.args[0]}": {e}')
+			results[step] = {'error': str(e)}
+	write_results(job, results)
+
+def write_results(job : Job, results : dict):
+	record = {'id': job.task.id(), 'file': job.task.args[0], 'results': results}
+	try:
+		with mutex:
+			os.makedirs(os.path.dirname(results_filename), exist_ok=True)
+			with open(results_filename, 'a') as f:
+				f.write(json.dumps(record) + '\n')
+	except OSError as e:
+		print(f'Could not record the post-processing results of "{job.task.args[0]}": {e}')
+
+def worker_func():
+	global running
+	while True:
+		# Once stopping, the queue is only emptied, so no worker waits on it
+		try:
+			job = jobs.get_nowait() if stopping.is_set() else jobs.get()
+		except queue.Empty:
+			return
+		if job is None:
+			return
+		with mutex:
+			running += 1
+		try:
+			run_job(job)
+		except Exception as e:
+			print(f'Post-processing failed for "{job.task.args[0]}": {e}')
+		finally:
+			with mutex:
+				running -= 1
+
+
+# Queues post-processing of a completed task's outputs. Never blocks: if max_pending jobs are already waiting,
+# the job is dropped
+def submit(task : taskfile.Task, outputs : list):
+	with mutex:
+		workers[:] = [w for w in workers if w.is_alive()]
+		while len(workers) < max_workers:
+			worker = threading.Thread(target=worker_func, name='PostProcThread', daemon=True)
+			worker.start()
+			workers.append(worker)
+	job = Job(task, outputs)
+	try:
+		jobs.put_nowait(job)
+	except queue.Full:
+		print(f'Post-processing of "{task.args[0]}" dropped: {max_pending} jobs are already waiting')
+		write_results(job, {step: {'error': 'Dropped: too many jobs waiting'} for step in task.info.get('post', [])})
+
+# The number of jobs that are waiting or running
+def pending():
+	with mutex:
+		return jobs.qsize() + running
+
+# Waits for all queued jobs to finish and stops the workers
+def stop():
+	if len(workers) == 0:
+		return
+	if pending() > 0:
+		print(f'Waiting for {pending()} post-processing job(s) to finish...')
+	stopping.set()
+	# Workers waiting for a job are woken up. If the queue is full, none are waiting
+	for worker in workers:
+		try:
+			jobs.put_nowait(None)
+		except queue.Full:
+			break
+	for worker in workers:
+		worker.join()
+	workers.clear()
+	stopping.clear()
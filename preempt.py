@@ -0,0 +1,116 @@
+import os
+import signal
+
+import taskfile
+import phases
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+
+'''
+preempt
+Lets urgent tasks interrupt the running task. Every task has a priority: its "priority" option, or 0
+next_task() starts the queued task with the highest priority (the first one among equals), and when a queued
+task has a higher priority than the running task, the running task is preempted in one of two ways:
+	- Suspended: its process is stopped with SIGSTOP, and continued with SIGCONT once no queued task has a
+	  higher priority than it. This is only done if there is enough free memory to keep it resident next to
+	  the urgent task (see can_suspend()) and on platforms with SIGSTOP
+	- Requeued: its process is killed and the task is put back at the front of the queue. Its elapsed time and
+	  timing events are kept, and an animation only renders the frames it has not written yet when it runs
+	  again (see skip_written_frames()), so only the frame in progress is lost. This holds even when brender.py
+	  overwrites existing frames (a task with overrides, see tasks.PRESETS)
+Suspended tasks are listed in suspended_filename. If the queue stops while tasks are suspended,
+they are put back at the front of the queue (see BgdThread.quit() and BgdThread.run())
+'''
+
+
+# The file in which suspended tasks are listed. The cwd is used
+suspended_filename = 'tasks/suspended.txt'
+
+# A task is suspended only if the free memory is at least this many times its process's memory,
+# since the urgent task is assumed to need about as much
+suspend_memory_factor = 1.0
+
+
+# Called before an animation that was killed part way is run again: limits it to the frames that its
+# earlier runs have not written (task.info['frame_list']), from its timing events (see phases.py)
+# Does nothing if the frames it renders are not known yet
+def skip_written_frames(task : taskfile.Task):
+	if task.type != taskfile.TaskType.RENDER_ANIMATION:
+		return
+	expected = None
+	written = set()
+	for e in phases.read_events(task):
+		if e['event'] == 'expected':
+			expected = [frame for frame, _ in e['frames']]
+		elif e['event'] == 'write' and 'frame' in e:
+			written.add(e['frame'])
+	if expected is None:
+		return
+	remaining = [f for f in expected if f not in written]
+	# If every frame was written, the last one is rendered again so the task still runs and completes
+	task.info['frame_list'] = remaining if len(remaining) > 0 else expected[-1:]
+
+
+def priority(task : taskfile.Task):
+	return task.info.get('priority', 0)
+
+def supports_suspend():
+	return hasattr(signal, 'SIGSTOP')
+
+# Returns the resident memory in bytes of the given process, or None if unknown
+def rss(pid):
+	if psutil is not None:
+		try:
+			return psutil.Process(pid).memory_info().rss
+		except psutil.Error:
+			return None
+	try:
+		with open(f'/proc/{pid}/status', 'r') as f:
+			for line in f:
+				if line.startswith('VmRSS:'):
+					return int(line.split()[1]) * 1024
+	except (OSError, ValueError, IndexError):
+		pass
+	return None
+
+# Returns the memory in bytes available to new processes, or None if unknown
+def available_memory():
+	if psutil is not None:
+		return psutil.virtual_memory().available
+	try:
+		with open('/proc/meminfo', 'r') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	except (OSError, ValueError, IndexError):
+		pass
+	return None
+
+# Whether the process running a task (as returned by tasks.run_task()) can be suspended
+def can_suspend(proc):
+	# Bake jobs start new processes as they go, so they cannot be stopped as a whole
+	if not supports_suspend() or getattr(proc, 'pid', None) is None:
+		return False
+	used = rss(proc.pid)
+	available = available_memory()
+	return used is not None and available is not None and available >= used * suspend_memory_factor
+
+def suspend(proc):
+	os.kill(proc.pid, signal.SIGSTOP)
+
+def resume(proc):
+	try:
+		os.kill(proc.pid, signal.SIGCONT)
+	except ProcessLookupError:
+		# The process was killed while it was suspended
+		pass
+
+
+def write_suspended(task_list : list):
+	taskfile.write_list(suspended_filename, task_list)
+
+def read_suspended() -> list:
+	return taskfile.read_list(suspended_filename, taskfile.Task)
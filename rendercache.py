@@ -0,0 +1,201 @@
+import os
+import json
+import hashlib
+import threading
+
+import taskfile
+import tasks
+import blendfile
+import bundle
+
+
+'''
+rendercache
+Remembers the outputs of completed renders, so that a task identical to one already rendered is completed
+immediately instead of rendering it again
+
+A render is identified by a key: the hash of the blend file and all of its dependencies (see bundle.py),
+the task type, the frame range, the render setting overrides and the Blender executable
+The key is computed when a task is launched and stored in task.info['cache_key']; when the task completes,
+its outputs are stored under the key. A queued task with the same key is a hit as long as every output
+is still present with the size and mtime it had when it was written
+
+Keys are only computed from manifests that are already cached and up to date, so the scheduler never waits for
+Blender or for hashing. A task whose file has no such manifest is not cached; its file is scanned in a
+background thread instead (see scan_later()), so later tasks of the same file are
+'''
+
+
+# The file in which the cache index is stored. The cwd is used
+index_filename = 'tasks/rendercache.json'
+
+# Set to False to always render
+enabled = True
+
+# The number of results kept. The oldest are forgotten first
+MAX_ENTRIES = 1000
+
+
+# Blend files waiting to be scanned by scan_thread, oldest first. The one being scanned stays until it is done
+scan_pending = []
+scan_mutex = threading.Lock()
+scan_thread = None
+# (blend file, mtime) of the files that could not be scanned. They are not scanned again until they change
+scan_failed = set()
+
+
+# Tasks that re-render some frames of another task (see verify.py) or render part of a still (see tiles.py)
+# do not produce the whole result
+def is_cacheable(task : taskfile.Task):
+	return task.type in (taskfile.TaskType.RENDER_ANIMATION, taskfile.TaskType.RENDER_STILL) and \
+		not any(k in task.info for k in ('frame_list', 'tile', 'stitch'))
+
+# Returns [start, end, step] of the frames the task renders, or None if the blend file could not be read
+def frame_range(task : taskfile.Task):
+	info = blendfile.read_info(task.args[0])
+	if info is None:
+		return None
+	overrides = task.info.get('overrides', {})
+	return [overrides.get('frame_start', info.frame_start), overrides.get('frame_end', info.frame_end),
+		overrides.get('frame_step', info.frame_step)]
+
+# Returns the key of the given task from the given manifest
+def task_key(task : taskfile.Task, manifest : bundle.Manifest):
+	key = {
+		'type': task.type,
+		'files': [[f.name, f.sha256] for f in manifest.files],
+		'missing': sorted(manifest.missing),
+		'frames': frame_range(task),
+		'overrides': task.info.get('overrides', {}),
+		'blender': tasks.blender_path,
+	}
+	return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def read_index() -> dict:
+	try:
+		with open(index_filename, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def write_index(index : dict):
+	os.makedirs(os.path.dirname(index_filename), exist_ok=True)
+	taskfile.lock_disk()
+	try:
+		taskfile.write_atomic(index_filename, json.dumps(index))
+	finally:
+		taskfile.unlock_disk()
+
+# Whether every output of a cache entry is still on disk, unchanged
+def is_present(entry : dict):
+	for path, size, mtime in entry['outputs']:
+		try:
+			st = os.stat(path)
+		except OSError:
+			return False
+		if st.st_size != size or st.st_mtime != mtime:
+			return False
+	return True
+
+
+def scan_thread_func():
+	global scan_thread
+	while True:
+		with scan_mutex:
+			if len(scan_pending) == 0:
+				scan_thread = None
+				return
+			blend = scan_pending[0]
+		mtime = None
+		try:
+			mtime = os.path.getmtime(blend)
+			manifest = bundle.get_manifest(blend)
+		except OSError as e:
+			print(f'Exception while scanning dependencies of "{blend}": {e}')
+			manifest = None
+		with scan_mutex:
+			scan_pending.remove(blend)
+			if manifest is None:
+				scan_failed.add((blend, mtime))
+
+# Makes the manifest of the given blend file in a background thread (see bundle.get_manifest())
+def scan_later(blend):
+	global scan_thread
+	try:
+		mtime = os.path.getmtime(blend)
+	except OSError:
+		return
+	with scan_mutex:
+		if blend in scan_pending or (blend, mtime) in scan_failed:
+			return
+		scan_pending.append(blend)
+		if scan_thread is None:
+			scan_thread = threading.Thread(target=scan_thread_func, name='ManifestScan', daemon=True)
+			scan_thread.start()
+
+# Returns the up-to-date cached manifest of the task's file. If there is none, requests one (see scan_later())
+# and returns None. Never launches Blender or hashes files
+def current_manifest(task : taskfile.Task):
+	manifest = bundle.cached_manifest(task.args[0], rehash=False)
+	if manifest is None:
+		scan_later(task.args[0])
+	return manifest
+
+
+# Called when a task is launched: stores the task's key in task.info['cache_key']
+# Without an up-to-date manifest of its file, the task is rendered without being cached
+def prepare(task : taskfile.Task):
+	task.info.pop('cache_key', None)
+	if not enabled or not is_cacheable(task):
+		return
+	manifest = current_manifest(task)
+	if manifest is not None:
+		task.info['cache_key'] = task_key(task, manifest)
+
+# Returns the cache entry for a queued task, or None if it is not a hit
+def lookup(task : taskfile.Task):
+	if not enabled or not is_cacheable(task):
+		return None
+	manifest = current_manifest(task)
+	if manifest is None:
+		return None
+	entry = read_index().get(task_key(task, manifest), None)
+	if entry is None or not is_present(entry):
+		return None
+	return entry
+
+# Called when a task completes: stores its outputs under the key computed by prepare()
+def store(task : taskfile.Task, outputs : list):
+	key = task.info.get('cache_key', None)
+	if key is None or len(outputs) == 0:
+		return
+	frames = frame_range(task)
+	if task.type == taskfile.TaskType.RENDER_ANIMATION and frames is not None and \
+		len(outputs) < len(range(frames[0], frames[1] + 1, max(frames[2], 1))):
+		# Frames rendered before the task was resumed were not reported
+		return
+	entry = {'id': task.id(), 'time': task.time, 'outputs': []}
+	for path in outputs:
+		try:
+			st = os.stat(path)
+		except OSError:
+			return
+		entry['outputs'].append([path, st.st_size, st.st_mtime])
+	taskfile.lock_disk()
+	try:
+		index = read_index()
+		# Re-inserting moves the key to the end, so the oldest entries come first
+		index.pop(key, None)
+		index[key] = entry
+		while len(index) > MAX_ENTRIES:
+			del index[next(iter(index))]
+		write_index(index)
+	finally:
+		taskfile.unlock_disk()
+
+# Returns the completed task recorded for a hit (see lookup())
+def complete_hit(task : taskfile.Task, entry : dict):
+	task.info['cache_hit'] = entry['id']
+	task.info['frames'] = len(entry['outputs'])
+	return taskfile.CompletedTask(task)
@@ -0,0 +1,199 @@
+import sys
+import copy
+import json
+import heapq
+import argparse
+import statistics
+import collections
+
+import taskfile
+import stats
+import fairshare
+
+
+'''
+simulate
+Replays the recorded history of completed and failed tasks through the scheduler in simulated time,
+to compare scheduling policies (see taskfile.POLICIES) and numbers of slots before changing the real queue
+Nothing is run and the queue is not modified. Run it from the same working directory as the render queue
+
+Each finished task is replayed as it was recorded:
+	- it is queued at task.info['submitted'] (tasks finished before it was recorded are assumed to have been
+	  queued when they started)
+	- it runs for its recorded elapsed time, and uses its recorded peak memory (task.info['peak_rss'], see
+	  watchdog.py) for as long as it runs
+Whenever a slot is free, the next task is chosen with taskfile.select_next(), the same decision next_task()
+makes. Its predictions (see stats.py) only come from the tasks the simulation has finished by then, starting
+with none, so a policy never knows a task's time before an earlier run of it has finished
+The 'fair' policy starts with no deficits and the current shares and quotas (see fairshare.py). With --memory,
+a task only starts if the peak memory of all running tasks stays within the limit; otherwise the slot waits for it
+
+For each policy and number of slots, prints:
+	makespan: from the first task being queued to the last one finishing
+	wait: time from being queued to starting (mean and 95th percentile)
+	turnaround: time from being queued to finishing (50th, 95th and 99th percentiles)
+	utilization: the fraction of slot time spent running tasks
+The recorded history itself (one slot, as it ran) is printed first where queue times were recorded
+
+Example:
+	python RenderQueue/simulate.py --policies priority shortest --slots 1 2 4 --memory 64
+'''
+
+
+# A finished task as it is replayed
+class TraceTask:
+	def __init__(self, task : taskfile.Task, failed : bool):
+		# As recorded, for the statistics once it finishes
+		self.recorded_task = task
+		self.task = taskfile.Task(task.type, task.args, 0, dict(task.info))
+		# Simulated tasks are never waiting for a retry
+		self.task.info.pop('not_before', None)
+		self.duration = task.time
+		started = task.finished - task.time
+		self.recorded = 'submitted' in task.info
+		self.submitted = min(task.info.get('submitted', started), started)
+		self.started = started
+		self.peak_rss = task.info.get('peak_rss', 0)
+		self.failed = failed
+
+
+# Returns the TraceTasks of the newest limit finished tasks (all if limit is negative), oldest first
+def load_trace(limit=-1):
+	trace = [TraceTask(t, False) for t in taskfile.read_completed(limit)] + \
+		[TraceTask(t, True) for t in taskfile.read_failed(limit)]
+	trace = [t for t in trace if t.started > 0]
+	trace.sort(key=lambda t: t.submitted)
+	return trace
+
+
+def percentile(values, p):
+	if len(values) == 0:
+		return 0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+# Returns the metrics (see above) of tasks given as (TraceTask, start time)
+def metrics(runs, slots):
+	if len(runs) == 0:
+		return None
+	begin = min(t.submitted for t, _ in runs)
+	end = max(start + t.duration for t, start in runs)
+	makespan = end - begin
+	waits = [start - t.submitted for t, start in runs]
+	turnarounds = [start + t.duration - t.submitted for t, start in runs]
+	busy = sum(t.duration for t, _ in runs)
+	return {
+		'tasks': len(runs),
+		'makespan_s': makespan,
+		'wait_mean_s': statistics.mean(waits),
+		'wait_p95_s': percentile(waits, 95),
+		'turnaround_p50_s': percentile(turnarounds, 50),
+		'turnaround_p95_s': percentile(turnarounds, 95),
+		'turnaround_p99_s': percentile(turnarounds, 99),
+		'utilization': busy / (slots * makespan) if makespan > 0 else 1,
+	}
+
+# Replays the trace with the given policy and number of slots. memory is the limit in bytes, or None
+# Returns the metrics of the simulated run
+def simulate(trace : list, policy, slots, memory=None):
+	arrivals = list(trace)
+	# By id(task), since the scheduler only sees taskfile.Tasks
+	by_task = {id(t.task): t for t in trace}
+	queued = []
+	# (end time, sequence number, TraceTask)
+	running = []
+	runs = []
+	used_memory = 0
+	# Submitter -> the number of its tasks running
+	running_counts = collections.Counter()
+	# The statistics of the tasks finished so far. predict() reads them as they grow
+	aggregates = stats.empty()
+	predict = stats.predictor(aggregates)
+	fair_state = None
+	if policy == 'fair':
+		stored = fairshare.read_state()
+		fair_state = fairshare.empty_state()
+		fair_state['shares'], fair_state['quotas'] = stored['shares'], stored['quotas']
+	now = arrivals[0].submitted if len(arrivals) > 0 else 0
+	next_arrival = 0
+	sequence = 0
+	while next_arrival < len(arrivals) or len(queued) > 0 or len(running) > 0:
+		while next_arrival < len(arrivals) and arrivals[next_arrival].submitted <= now:
+			queued.append(arrivals[next_arrival].task)
+			next_arrival += 1
+		while len(running) < slots and len(queued) > 0:
+			# A task that does not start does not use up its submitter's turn
+			before = copy.deepcopy(fair_state)
+			task = taskfile.select_next(queued, now, policy, predict, fair_state, running_counts)
+			t = by_task[id(task)]
+			# A task that needs more than the whole limit runs alone
+			if memory is not None and len(running) > 0 and used_memory + t.peak_rss > memory:
+				fair_state = before
+				break
+			queued.remove(task)
+			runs.append((t, now))
+			used_memory += t.peak_rss
+			running_counts[fairshare.submitter(task)] += 1
+			heapq.heappush(running, (now + t.duration, sequence, t))
+			sequence += 1
+		# Advance to whichever happens first: a task finishing or a task being queued
+		times = []
+		if len(running) > 0:
+			times.append(running[0][0])
+		if next_arrival < len(arrivals):
+			times.append(arrivals[next_arrival].submitted)
+		if len(times) == 0:
+			break
+		now = max(now, min(times))
+		while len(running) > 0 and running[0][0] <= now:
+			_, _, t = heapq.heappop(running)
+			used_memory -= t.peak_rss
+			running_counts[fairshare.submitter(t.task)] -= 1
+			stats.add(aggregates, t.recorded_task, t.failed)
+	return metrics(runs, slots)
+
+# Returns the metrics of the trace as it actually ran, or None if queue times were not recorded
+def recorded(trace : list):
+	runs = [(t, t.started) for t in trace if t.recorded]
+	return metrics(runs, 1)
+
+
+def print_table(rows):
+	print(f'{"policy":>10} {"slots":>5} {"tasks":>6} {"makespan":>12} {"wait mean":>12} {"wait p95":>12} '
+		f'{"turn p50":>12} {"turn p95":>12} {"turn p99":>12} {"util":>6}')
+	for name, slots, m in rows:
+		print(f'{name:>10} {slots:>5} {m["tasks"]:>6} {m["makespan_s"]:>11.1f}s {m["wait_mean_s"]:>11.1f}s '
+			f'{m["wait_p95_s"]:>11.1f}s {m["turnaround_p50_s"]:>11.1f}s {m["turnaround_p95_s"]:>11.1f}s '
+			f'{m["turnaround_p99_s"]:>11.1f}s {100 * m["utilization"]:>5.1f}%')
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog='simulate', description='Replays the task history with scheduling policies')
+	parser.add_argument('--policies', nargs='*', default=list(taskfile.POLICIES), choices=list(taskfile.POLICIES))
+	parser.add_argument('--slots', type=int, nargs='*', default=[1], help='numbers of tasks run at the same time')
+	parser.add_argument('--memory', type=float, default=None, help='memory limit in GiB for running tasks')
+	parser.add_argument('--limit', type=int, default=-1, help='only replay the newest n completed and n failed tasks')
+	parser.add_argument('--json', action='store_true', help='print the results as JSON')
+	args = parser.parse_args(argv)
+
+	trace = load_trace(args.limit)
+	if len(trace) == 0:
+		print('There are no finished tasks to replay')
+		return 1
+	memory = args.memory * 1024 ** 3 if args.memory is not None else None
+	rows = []
+	actual = recorded(trace)
+	if actual is not None:
+		rows.append(('recorded', 1, actual))
+	for slots in args.slots:
+		for policy in args.policies:
+			rows.append((policy, slots, simulate(trace, policy, slots, memory)))
+	if args.json:
+		print(json.dumps([{'policy': name, 'slots': slots, **m} for name, slots, m in rows], indent='\t'))
+	else:
+		print_table(rows)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import shutil
+import threading
+from pathlib import Path
+
+import taskfile
+import bundle
+
+
+'''
+staging
+Copies the blend file and dependencies of a render task to a local scratch directory before Blender is
+launched, so Blender loads them from a local disk instead of shared storage (e.g. a NAS)
+Disabled unless scratch_dir is set, e.g. with the LRQ_SCRATCH_DIR environment variable
+
+Files are copied to the same absolute path below scratch_dir (/mnt/nas/a.blend -> <scratch_dir>/mnt/nas/a.blend),
+so Blender's relative paths (//textures/..., //../lib.blend) resolve to the staged copies
+The dependencies are those of the file's manifest (see bundle.py); a file without one is not staged
+Outputs relative to the blend file are still written next to the original (see brender.py)
+
+The staged files are a cache, indexed in index_filename within scratch_dir by source path. A staged file is
+reused as long as the source's size and mtime are unchanged. Once the cache is larger than max_size bytes,
+the least recently used files are removed, except those of the tasks being staged or rendered
+
+While a task renders, the files of the next queued task are staged in the background (see prefetch()),
+if its manifest is already cached. Only render tasks are staged: bakes write their caches next to the blend file
+'''
+
+
+# The local directory in which files are staged. None disables staging
+scratch_dir = os.environ.get('LRQ_SCRATCH_DIR', None)
+
+# The largest total size in bytes of the staged files
+max_size = 50 * 1024 ** 3
+
+# The index of staged files, within scratch_dir
+index_filename = 'index.json'
+
+# The directory within scratch_dir in which files are staged
+files_dir = 'files'
+
+
+# Held while files are copied or removed. Launching a task waits for a prefetch of the same files
+mutex = threading.Lock()
+# Source paths that must not be removed: those of the task being rendered and the one being staged
+pinned = set()
+prefetch_thread = None
+
+
+def is_enabled():
+	return scratch_dir is not None
+
+def is_stageable(task : taskfile.Task):
+	return task.type in (taskfile.TaskType.RENDER_ANIMATION, taskfile.TaskType.RENDER_STILL)
+
+# The path of the staged copy of a source file
+def staged_path(path) -> Path:
+	path = Path(path).absolute()
+	# Drive letters and roots are dropped, e.g. C:\a.blend -> C\a.blend
+	parts = [p.replace(':', '').strip('/\\') for p in path.parts]
+	return Path(scratch_dir).joinpath(files_dir, *[p for p in parts if p != ''])
+
+
+def read_index() -> dict:
+	try:
+		with open(Path(scratch_dir).joinpath(index_filename), 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def write_index(index : dict):
+	taskfile.write_atomic(Path(scratch_dir).joinpath(index_filename), json.dumps(index))
+
+# Whether the staged copy of a file is up to date
+def is_staged(index : dict, f : bundle.BundleFile):
+	entry = index.get(f.path, None)
+	return entry is not None and entry['size'] == f.size and entry['mtime'] == f.mtime and \
+		staged_path(f.path).is_file()
+
+# Removes the least recently used files until needed more bytes fit in max_size. Returns whether they fit
+def evict(index : dict, needed):
+	total = sum(e['size'] for e in index.values())
+	for path, entry in sorted(index.items(), key=lambda i: i[1]['used']):
+		if total + needed <= max_size:
+			break
+		if path in pinned:
+			continue
+		try:
+			os.remove(staged_path(path))
+		except OSError:
+			pass
+		del index[path]
+		total -= entry['size']
+	return total + needed <= max_size
+
+# Copies the given files to the scratch directory if they are not staged yet. Returns whether all are staged
+def stage_files(files : list):
+	with mutex:
+		pinned.update(f.path for f in files)
+		index = read_index()
+		missing = [f for f in files if not is_staged(index, f)]
+		if not evict(index, sum(f.size for f in missing)):
+			write_index(index)
+			return False
+		for f in missing:
+			destination = staged_path(f.path)
+			os.makedirs(destination.parent, exist_ok=True)
+			tmp = f'{destination}.{os.getpid()}.tmp'
+			try:
+				# copy2() keeps the mtime, which Blender uses for some caches
+				shutil.copy2(f.path, tmp)
+				os.replace(tmp, destination)
+			except OSError as e:
+				print(f'Could not stage "{f.path}": {e}')
+				write_index(index)
+				return False
+			index[f.path] = {'size': f.size, 'mtime': f.mtime, 'used': 0}
+		now = time.time()
+		for f in files:
+			index[f.path]['used'] = now
+		write_index(index)
+		return True
+
+
+# Stages the task's files for launching. Returns the path of the staged blend file,
+# or None if the task should load the original (staging is disabled or failed)
+def stage(task : taskfile.Task):
+	if not is_enabled() or not is_stageable(task):
+		return None
+	manifest = bundle.get_manifest(task.args[0])
+	if manifest is None:
+		return None
+	# Only the files of the task being launched stay pinned
+	with mutex:
+		pinned.clear()
+	if manifest.total_size() > max_size or not stage_files(manifest.files):
+		print(f'Could not stage "{task.args[0]}"; loading it from its original location')
+		return None
+	return str(staged_path(manifest.blend().path))
+
+# Stages the files of a queued task in a background thread, unless another prefetch is still running
+# Only uses a cached manifest, so Blender is never launched to scan the file
+def prefetch(task : taskfile.Task):
+	global prefetch_thread
+	if not is_enabled() or task is None or not is_stageable(task):
+		return
+	if prefetch_thread is not None and prefetch_thread.is_alive():
+		return
+	manifest = bundle.cached_manifest(task.args[0])
+	if manifest is None or manifest.total_size() > max_size:
+		return
+	prefetch_thread = threading.Thread(target=stage_files, args=[manifest.files], name='Prefetch', daemon=True)
+	prefetch_thread.start()
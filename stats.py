@@ -0,0 +1,226 @@
+import os
+import json
+import math
+import time
+from datetime import timedelta
+
+import taskfile
+
+
+'''
+stats
+Aggregate statistics over the completed and failed lists, kept up to date as tasks finish
+Answering questions about the whole history (throughput, time per file, failure rates) therefore never
+reads the history itself. The aggregates are stored in stats_filename as a JSON object:
+	completed, failed, cache_hits: counts of tasks
+	time, failed_time: the sum of the elapsed time of completed and failed tasks (cache hits are not included)
+	time_histogram: {k: the number of completed tasks that took between 2^(k-1) and 2^k seconds}
+	exit_codes: {exit code: the number of failed tasks}
+	files: {blend file: {"completed", "failed", "time", "peak_rss"}}, peak_rss being the highest peak memory in bytes
+		of a run (see watchdog.py), if any was recorded
+	workloads: {type, file and render settings: [completed tasks, their total time]}, used for predictions
+	hours: {start of the hour (unix time): [completed, failed, time]}, for the last MAX_HOURS hours
+Their size depends on the number of different files, not on the length of the history
+
+If stats_filename is missing or the history was cleared, the aggregates are rebuilt from the history once
+'''
+
+
+# The file in which the aggregates are stored. The cwd is used
+stats_filename = 'tasks/stats.json'
+
+VERSION = 1
+
+# The number of hourly buckets kept
+MAX_HOURS = 24 * 90
+
+
+def empty():
+	return {'version': VERSION, 'completed': 0, 'failed': 0, 'cache_hits': 0, 'time': 0, 'failed_time': 0,
+		'time_histogram': {}, 'exit_codes': {}, 'files': {}, 'workloads': {}, 'hours': {}}
+
+def workload_key(task : taskfile.Task):
+	return json.dumps([task.type, task.args, task.info.get('overrides', {})], sort_keys=True)
+
+# The histogram bucket of an elapsed time: the smallest k with time <= 2^k (0 for anything up to a second)
+def time_bucket(seconds):
+	return max(0, math.ceil(math.log2(seconds))) if seconds > 1 else 0
+
+# Adds one finished task to the aggregates
+def add(stats : dict, task : taskfile.Task, failed : bool):
+	file = task.args[0] if len(task.args) > 0 else ''
+	per_file = stats['files'].setdefault(file, {'completed': 0, 'failed': 0, 'time': 0})
+	finished = getattr(task, 'finished', 0)
+	hour = stats['hours'].setdefault(str(int(finished // 3600 * 3600)), [0, 0, 0]) if finished > 0 else [0, 0, 0]
+	if failed:
+		stats['failed'] += 1
+		stats['failed_time'] += task.time
+		code = str(task.exit_code)
+		stats['exit_codes'][code] = stats['exit_codes'].get(code, 0) + 1
+		per_file['failed'] += 1
+		hour[1] += 1
+	elif 'cache_hit' in task.info:
+		stats['completed'] += 1
+		stats['cache_hits'] += 1
+		per_file['completed'] += 1
+		hour[0] += 1
+	else:
+		stats['completed'] += 1
+		stats['time'] += task.time
+		bucket = str(time_bucket(task.time))
+		stats['time_histogram'][bucket] = stats['time_histogram'].get(bucket, 0) + 1
+		per_file['completed'] += 1
+		per_file['time'] += task.time
+		if 'peak_rss' in task.info:
+			per_file['peak_rss'] = max(per_file.get('peak_rss', 0), task.info['peak_rss'])
+		workload = stats['workloads'].setdefault(workload_key(task), [0, 0])
+		workload[0] += 1
+		workload[1] += task.time
+		hour[0] += 1
+		hour[2] += task.time
+	if len(stats['hours']) > MAX_HOURS:
+		for key in sorted(stats['hours'], key=int)[:len(stats['hours']) - MAX_HOURS]:
+			del stats['hours'][key]
+
+
+# The aggregates last read or saved, as ((mtime_ns, size) of stats_filename at the time, aggregates), or None
+# load() only parses the file again once it changes, since the queue loads them before every task it picks
+cached = None
+
+def file_key():
+	st = os.stat(stats_filename)
+	return st.st_mtime_ns, st.st_size
+
+def save(stats : dict):
+	global cached
+	taskfile.lock_disk()
+	try:
+		taskfile.write_atomic(stats_filename, json.dumps(stats))
+		try:
+			cached = (file_key(), stats)
+		except OSError:
+			cached = None
+	finally:
+		taskfile.unlock_disk()
+
+# Computes the aggregates from the whole history. Takes time proportional to its length
+def rebuild():
+	taskfile.lock_disk()
+	try:
+		stats = empty()
+		# Oldest first, so the newest hours are the ones kept
+		for task in reversed(list(taskfile.iter_completed())):
+			add(stats, task, False)
+		for task in reversed(list(taskfile.iter_failed())):
+			add(stats, task, True)
+		save(stats)
+		return stats
+	finally:
+		taskfile.unlock_disk()
+
+# Returns the aggregates, rebuilding them if necessary
+# The same dict is returned until the file changes, so a caller that changes it must save() it
+def load() -> dict:
+	global cached
+	taskfile.lock_disk()
+	try:
+		try:
+			key = file_key()
+			if cached is not None and cached[0] == key:
+				return cached[1]
+			with open(stats_filename, 'r') as f:
+				stats = json.load(f)
+			if stats.get('version', None) == VERSION:
+				cached = (key, stats)
+				return stats
+		except (OSError, ValueError):
+			pass
+		return rebuild()
+	finally:
+		taskfile.unlock_disk()
+
+# Called by taskfile when a task is added to the completed or failed list
+def record(task : taskfile.Task, failed : bool):
+	taskfile.lock_disk()
+	try:
+		stats = load()
+		add(stats, task, failed)
+		save(stats)
+	finally:
+		taskfile.unlock_disk()
+
+# Called by taskfile when a history is rewritten or cleared
+def invalidate():
+	taskfile.lock_disk()
+	try:
+		if os.path.exists(stats_filename):
+			os.remove(stats_filename)
+	finally:
+		taskfile.unlock_disk()
+
+
+# Returns the mean time of earlier completed runs of the same file with the same type and settings,
+# or None if there were none
+def predict_duration(task : taskfile.Task):
+	return predictor(load())(task)
+
+# Returns a function that predicts the time of a task from the given aggregates, without reading them again
+def predictor(stats : dict):
+	def predict(task : taskfile.Task):
+		workload = stats['workloads'].get(workload_key(task), None)
+		if workload is None or workload[0] == 0:
+			return None
+		return workload[1] / workload[0]
+	return predict
+
+# Returns a function that returns the highest peak memory in bytes of earlier completed runs of a task's file,
+# or None if none was recorded
+def memory_predictor(stats : dict):
+	def predict(task : taskfile.Task):
+		file = task.args[0] if len(task.args) > 0 else ''
+		return stats['files'].get(file, {}).get('peak_rss', None)
+	return predict
+
+# Returns (completed, failed, time) over the last num hours, including the current one
+def recent(stats : dict, num):
+	now = int(time.time() // 3600 * 3600)
+	totals = [0, 0, 0]
+	for key, bucket in stats['hours'].items():
+		if now - int(key) < num * 3600:
+			totals = [a + b for a, b in zip(totals, bucket)]
+	return totals
+
+# Returns a description of the aggregates. If file is given, only that file is described
+def desc(stats : dict, file=None):
+	if file is not None:
+		per_file = stats['files'].get(file, None)
+		if per_file is None:
+			return 'No finished tasks for this file'
+		average = per_file['time'] / per_file['completed'] if per_file['completed'] > 0 else 0
+		return f'{file}' + \
+			f'\n\t- Completed: {per_file["completed"]}, failed: {per_file["failed"]}' + \
+			f'\n\t- Total time: {timedelta(seconds=round(per_file["time"]))}, average: {timedelta(seconds=round(average))}'
+	finished = stats['completed'] + stats['failed']
+	rendered = stats['completed'] - stats['cache_hits']
+	s = f'Completed: {stats["completed"]} ({stats["cache_hits"]} cache hits), failed: {stats["failed"]}'
+	if finished > 0:
+		s += f' ({100 * stats["failed"] / finished:.1f}% failure rate)'
+	s += f'\nTotal time: {timedelta(seconds=round(stats["time"]))}'
+	if rendered > 0:
+		s += f', average: {timedelta(seconds=round(stats["time"] / rendered))}'
+	for hours in [1, 24]:
+		completed, failed, seconds = recent(stats, hours)
+		s += f'\nLast {hours} hour(s): {completed} completed ({completed / hours:.1f}/hour), {failed} failed'
+	if len(stats['time_histogram']) > 0:
+		s += '\nTime per task:'
+		for k in sorted(stats['time_histogram'], key=int):
+			s += f'\n\t- up to {timedelta(seconds=2 ** int(k))}: {stats["time_histogram"][k]}'
+	if len(stats['exit_codes']) > 0:
+		s += '\nFailures by exit code: ' + \
+			', '.join(f'{code}: {count}' for code, count in sorted(stats['exit_codes'].items(), key=lambda i: -i[1]))
+	if len(stats['files']) > 0:
+		s += '\nFiles by total time:'
+		for file, per_file in sorted(stats['files'].items(), key=lambda i: -i[1]['time'])[:10]:
+			s += f'\n\t- {file}: {per_file["completed"]} completed, {per_file["failed"]} failed, ' + \
+				f'{timedelta(seconds=round(per_file["time"]))}'
+	return s
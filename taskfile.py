@@ -2,8 +2,18 @@
 import threading
 import pathlib
 import json
+import uuid
+import time
 from datetime import timedelta
 import os
+import contextlib
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+	import msvcrt
+
+import history
 
 '''
 taskfile
@@ -15,6 +25,10 @@ There are 2 files that this module interfaces with:
 	- This task is NOT also stored in the taskfile
 3. completed.dat: Stores the list of all tasks that have been completed
 4. failed.dat: Stores the list of all tasks that have failed
+	- Both are stored in a binary format that is only appended to (see history.py)
+
+Several processes (e.g. a headless instance or a pipeline script) may share these files
+lock_disk() therefore also takes an OS file lock, and files are replaced atomically rather than rewritten
 '''
 
 # The name of the file in which tasks are stored. The current working directory is used
@@ -26,10 +40,21 @@ tasklist_filename = 'tasks/tasklist.txt'
 currenttask_filename = 'tasks/currenttask.txt'
 
 # The name of the file in which the list of completed tasks is stored. The cwd is used
-completed_filename = 'tasks/completed.txt'
+completed_filename = 'tasks/completed.hist'
 
 # The name of the file in which the list of failed tasks is stored. The cwd is used
-failed_filename = 'tasks/failed.txt'
+failed_filename = 'tasks/failed.hist'
+
+# The name of the file in which strings shared by the completed and failed lists are stored. The cwd is used
+history_strings_filename = 'tasks/history.strings'
+
+# Completed and failed tasks used to be stored as text, one task per line, newest first
+# These files are converted the first time the lists are used (see migrate_history())
+legacy_completed_filename = 'tasks/completed.txt'
+legacy_failed_filename = 'tasks/failed.txt'
+
+# The file locked by lock_disk() so that other processes sharing the task files wait for us. The cwd is used
+lock_filename = 'tasks/.lock'
 
 
 class TaskType:
@@ -45,67 +70,230 @@ class TaskType:
 			return 'Bake Dynamics'
 
 
+# The info keys (options given by the user, see tasks.parse_task_options()) that tasks made from a task keep,
+# e.g. its tiles and stitch task (see tiles.py) and the re-render of its bad frames (see verify.py)
+INHERITED_INFO = ('preset', 'overrides', 'priority', 'timeout', 'stall', 'max_attempts', 'post', 'submitter')
+
+
+# info holds optional per-task metadata (e.g. 'id'). It is only written to disk if non-empty
 class Task:
-	def __init__(self, type, args : str, time : float = 0):
+	def __init__(self, type, args : str, time : float = 0, info : dict = None):
 		self.type = type
 		self.args = args
 		self.time = time
+		self.info = info if info is not None else {}
 	
 	def time_str(self):
 		return str(timedelta(seconds=round(self.time)))
 
+	def id(self):
+		return self.info.get('id', None)
+
 	def __str__(self):
-		return f'{self.type} {self.time} ' + json.dumps(self.args)
+		s = f'{self.type} {self.time} ' + json.dumps(self.args)
+		if len(self.info) > 0:
+			s += ' ' + json.dumps(self.info)
+		return s
 
 	def desc(self):
-		return f'{TaskType.get_name(self.type)}' + \
+		s = f'{TaskType.get_name(self.type)}' + \
 			f'\n\t- Elapsed: {self.time_str()}' + \
 			f'\n\t- File: {self.args[0]}'
+		if 'overrides' in self.info:
+			s += '\n\t- Settings: ' + (self.info['preset'] + ' ' if 'preset' in self.info else '') + \
+				'(' + ', '.join(f'{k}={v}' for k, v in self.info['overrides'].items()) + ')'
+		if 'cache_hit' in self.info:
+			# See rendercache.py
+			s += f'\n\t- Render cache hit: outputs of task {self.info["cache_hit"]} reused'
+		if 'submitter' in self.info:
+			# See fairshare.py
+			s += f'\n\t- Submitter: {self.info["submitter"]}'
+		if 'worker' in self.info:
+			# See capacity.py
+			s += f'\n\t- Rendered by worker {self.info["worker"]}'
+		if self.info.get('priority', 0) != 0:
+			# See preempt.py
+			s += f'\n\t- Priority: {self.info["priority"]}'
+		if 'not_before' in self.info:
+			# See watchdog.py
+			s += '\n\t- Retry after: ' + time.strftime('%H:%M:%S', time.localtime(self.info['not_before']))
+		if 'attempts' in self.info:
+			s += f'\n\t- Attempts: {self.info["attempts"]} (stalled: {self.info["stalled"]})'
+		if 'verify_of' in self.info:
+			# See verify.py
+			s += f'\n\t- Renders the bad frames of task {self.info["verify_of"]}' + \
+				(': ' + ', '.join(str(f) for f in self.info['frame_list']) if 'frame_list' in self.info else '')
+		elif 'frame_list' in self.info:
+			# Part of an animation split between machines (see capacity.py)
+			frames = self.info['frame_list']
+			s += f'\n\t- Frames: {len(frames)} ({frames[0]}-{frames[-1]})' if len(frames) > 0 else '\n\t- Frames: none'
+			if 'chunk_of' in self.info:
+				s += f' of task {self.info["chunk_of"]}'
+		if 'tile' in self.info:
+			# See tiles.py
+			x, y, columns, rows = self.info['tile']
+			s += f'\n\t- Tile {y * columns + x + 1} of {columns * rows} of task {self.info["tile_of"]}'
+		elif 'stitch' in self.info:
+			s += f'\n\t- Stitches the tiles of task {self.info["stitch"]}'
+			if 'tile_time' in self.info:
+				s += f' (rendering them took {timedelta(seconds=round(self.info["tile_time"]))})'
+		elif 'tiles' in self.info:
+			s += f'\n\t- Tiles: {self.info["tiles"][0]}x{self.info["tiles"][1]}'
+		if 'bad_frames' in self.info:
+			s += '\n\t- Bad frames: ' + ', '.join(f'{f} ({r})' for f, r in self.info['bad_frames'].items())
+		if 'post' in self.info:
+			# See postproc.py
+			s += '\n\t- Post-processing: ' + ', '.join(self.info['post'])
+		if 'phases' in self.info:
+			# See phases.py
+			s += '\n\t- Phases: ' + ', '.join(f'{p} {t:.1f}s' for p, t in self.info['phases'].items())
+		if 'log' in self.info:
+			# See tasklog.py
+			s += f'\n\t- Log: {self.info["log"]}'
+		return s
+
+	def to_dict(self):
+		return {'type': self.type, 'args': self.args, 'time': self.time, 'info': self.info}
+
+	def from_dict(d):
+		return Task(d['type'], d['args'], d.get('time', 0), d.get('info', None))
 
 	def parse(line):
 		if line[-1] == '\n':
 			line = line[:-1]
 		split = line.split(sep=' ', maxsplit=2)
-		return Task(split[0], json.loads(split[2]), float(split[1]))
+		# args and info are two JSON values separated by a space. Older files have no info
+		args, end = json_decoder.raw_decode(split[2])
+		rest = split[2][end:].strip()
+		info = json.loads(rest) if len(rest) > 0 else None
+		return Task(split[0], args, float(split[1]), info)
 
+json_decoder = json.JSONDecoder()
+
+# finished is the wall clock time at which the task finished. It is 0 if unknown
 class CompletedTask(Task):
-	def __init__(self, task):
-		super().__init__(task.type, task.args, task.time)
+	def __init__(self, task, finished : float = None):
+		super().__init__(task.type, task.args, task.time, task.info)
+		self.finished = finished if finished is not None else time.time()
+
+	def to_dict(self):
+		d = super().to_dict()
+		d['finished'] = self.finished
+		return d
+
+	def to_record(self):
+		return history.Record(self.type, self.args, self.time, self.finished, 0, self.info)
+
+	def from_record(record : history.Record):
+		return CompletedTask(Task(record.type, record.args, record.time, record.info), record.finished)
 
 class FailedTask(Task):
 	# TODO: add more args (such as time until fail, etc.)
-	def __init__(self, task, exit_code):
-		super().__init__(task.type, task.args, task.time)
+	def __init__(self, task, exit_code, finished : float = None):
+		super().__init__(task.type, task.args, task.time, task.info)
 		self.exit_code = exit_code
+		self.finished = finished if finished is not None else time.time()
+
+	def to_record(self):
+		return history.Record(self.type, self.args, self.time, self.finished, self.exit_code, self.info)
+
+	def from_record(record : history.Record):
+		return FailedTask(Task(record.type, record.args, record.time, record.info), record.exit_code, record.finished)
 
 	def __str__(self):
 		return f'{self.exit_code} ' + super().__str__()
 
 	def desc(self):
-		return super().desc() + f'\n\t- Exit code: {self.exit_code}'
+		s = super().desc() + f'\n\t- Exit code: {self.exit_code}'
+		# See bakejob.py. An exit code of None means the cache was skipped
+		for failure in self.info.get('failed_caches', []):
+			code = failure['exit_code']
+			s += f'\n\t- Cache "{failure["cache"]}": ' + ('skipped' if code is None else f'exit code {code}')
+		return s
+
+	def to_dict(self):
+		d = super().to_dict()
+		d['exit_code'] = self.exit_code
+		d['finished'] = self.finished
+		return d
 
 	def parse(line):
 		split = line.split(sep=' ', maxsplit=1)
 		task = Task.parse(split[1])
-		return FailedTask(task, int(split[0]))
+		return FailedTask(task, int(split[0]), 0)
 
 
 disk_mutex = threading.RLock()
-
-# Locks the task list on disk
+# How many times the current owner of disk_mutex has locked it
+lock_depth = 0
+lock_file = None
+
+# Locks (or unlocks) lock_file, blocking until it is available
+def lock_file_os(lock):
+	global lock_file
+	if lock_file is None:
+		os.makedirs(os.path.dirname(lock_filename), exist_ok=True)
+		lock_file = open(lock_filename, 'a+')
+	if fcntl is not None:
+		fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if lock else fcntl.LOCK_UN)
+	else:
+		lock_file.seek(0)
+		if lock:
+			# LK_LOCK only retries for 10 seconds before failing
+			while True:
+				try:
+					msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+					break
+				except OSError:
+					pass
+		else:
+			msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+# Locks the task list on disk, for both other threads and other processes
 # This is a recursive operation, i.e. it can be locked multiple times (and must be unlocked multiple times)
+# The file lock is only taken by the outermost lock_disk() call
 def lock_disk():
+	global lock_depth
 	disk_mutex.acquire()
+	lock_depth += 1
+	if lock_depth == 1:
+		try:
+			lock_file_os(True)
+		except:
+			lock_depth -= 1
+			disk_mutex.release()
+			raise
 def unlock_disk():
+	global lock_depth
+	lock_depth -= 1
+	if lock_depth == 0:
+		lock_file_os(False)
 	disk_mutex.release()
 
+# Utility: lock_disk() and unlock_disk() as a context manager
+@contextlib.contextmanager
+def locked_disk():
+	lock_disk()
+	try:
+		yield
+	finally:
+		unlock_disk()
+
+# Utility: writes the given text to the given file atomically, by writing a temporary file and renaming it
+# Readers (including other processes) see either the old or the new contents, never a partial file
+def write_atomic(filename, text : str):
+	tmp = f'{filename}.{os.getpid()}.tmp'
+	with open(tmp, 'w') as f:
+		f.write(text)
+	os.replace(tmp, filename)
+
 # Utility: writes the given list of elements to the given file using str() and newlines
 def write_list(filename, elements : list):
 	lock_disk()
-	with open(filename, 'w') as f:
-		for e in elements:
-			f.write(str(e) + '\n')
-	unlock_disk()
+	try:
+		write_atomic(filename, ''.join(str(e) + '\n' for e in elements))
+	finally:
+		unlock_disk()
 
 # Utility: returns a list of type from the given file using type.parse() separated by newlines
 # If num is positive, only reads the first num elements
@@ -147,37 +335,182 @@ def write_tasks(tasks : list):
 	write_list(tasklist_filename, tasks)
 
 
+# Returns a new unique task id
+def new_task_id():
+	return uuid.uuid4().hex[:12]
+
 # idx is the index at which to insert the task into the queue. If out of range (default = -1), adds to end
-def create_task(type, args, idx=-1):
-	task = Task(type, args)
+# Returns the created task
+def create_task(type, args, idx=-1, info : dict = None):
+	task = Task(type, args, info=dict(info) if info is not None else {})
+	create_tasks([task], idx)
+	return task
+
+# Inserts all the given tasks at idx (keeping their order) with a single rewrite of the taskfile
+# Tasks without an id are assigned one. If idx is out of range (default = -1), adds to end
+def create_tasks(new_tasks : list, idx=-1):
+	now = time.time()
+	for task in new_tasks:
+		if task.id() is None:
+			task.info['id'] = new_task_id()
+		# Tasks put back in the queue keep the time they were first queued (see simulate.py)
+		if 'submitted' not in task.info:
+			task.info['submitted'] = now
 	lock_disk()
-	current_list = read_tasks()
-	if idx < 0 or idx >= len(current_list):
-		current_list.append(task)
-	else:
-		current_list.insert(idx, task)
-	write_tasks(current_list)
-	unlock_disk()
+	try:
+		current_list = read_tasks()
+		if idx < 0 or idx >= len(current_list):
+			current_list.extend(new_tasks)
+		else:
+			current_list[idx:idx] = new_tasks
+		write_tasks(current_list)
+	finally:
+		unlock_disk()
 
+# Returns the index in the given list of the task with the given id, or -1 if there is none
+def index_of(task_list : list, id):
+	for i, task in enumerate(task_list):
+		if task.id() == id:
+			return i
+	return -1
+
+# Moves the queued task at index src to index dst. If dst is out of range, moves it to the end
+# Returns whether src was a valid index
+def move_task(src, dst):
+	lock_disk()
+	try:
+		current_list = read_tasks()
+		if src < 0 or src >= len(current_list):
+			return False
+		task = current_list.pop(src)
+		if dst < 0 or dst >= len(current_list):
+			current_list.append(task)
+		else:
+			current_list.insert(dst, task)
+		write_tasks(current_list)
+		return True
+	finally:
+		unlock_disk()
+
+# Removes all queued tasks whose id is in ids, with a single rewrite of the taskfile
+# Returns the list of removed tasks
+def remove_tasks(ids):
+	ids = set(ids)
+	lock_disk()
+	try:
+		current_list = read_tasks()
+		removed = [t for t in current_list if t.id() in ids]
+		if len(removed) > 0:
+			write_tasks([t for t in current_list if t.id() not in ids])
+		return removed
+	finally:
+		unlock_disk()
+
+
+# Orders in which ready tasks are run. Each maps a task to its sort key; tasks with equal keys keep
+# their order in the queue. predict(task) returns the task's predicted time in seconds, or None (see stats.py)
+# Tasks with a higher 'priority' always run first (see preempt.py)
+POLICIES = {
+	# The order of the queue
+	'priority': lambda task, predict: priority_key(task),
+	# The shortest (or longest) predicted task first. Tasks without a prediction run last
+	'shortest': lambda task, predict: (priority_key(task), none_last(predict(task))),
+	'longest': lambda task, predict: (priority_key(task), none_last(negated(predict(task)))),
+	# The submitters' tasks in turn, in proportion to their shares (see fairshare.py). With a single submitter,
+	# the same as 'priority'
+	'fair': lambda task, predict: priority_key(task),
+}
+
+# The policy used by next_task(). See simulate.py to compare policies on the recorded history
+scheduling_policy = 'fair'
+
+def priority_key(task):
+	return -task.info.get('priority', 0)
+
+def negated(value):
+	return -value if value is not None else None
+
+def none_last(value):
+	return (value is None, value if value is not None else 0)
+
+# Returns an iterator over the tasks in the given list that are ready to run at now (default: the current time),
+# in the order the given policy (default: scheduling_policy) runs them. predict defaults to stats.predict_duration
+# For the 'fair' policy, the submitters' turns are taken from fair_state (default: the stored state, which is not
+# changed), which is updated as tasks are iterated over. running is passed to fairshare.picks()
+def iter_ready(tasks : list, now=None, policy=None, predict=None, fair_state=None, running=None):
+	now = time.time() if now is None else now
+	policy = scheduling_policy if policy is None else policy
+	if predict is None and policy != 'priority':
+		import stats
+		predict = stats.predictor(stats.load())
+	ready = [t for t in tasks if t.info.get('not_before', 0) <= now]
+	# sort() is stable, so equal keys keep their order in the queue
+	ready.sort(key=lambda t: POLICIES[policy](t, predict))
+	if policy == 'fair':
+		import fairshare
+		return fairshare.picks(ready, predict, fair_state if fair_state is not None else fairshare.read_state(), running)
+	return iter(ready)
+
+# Returns the tasks in the given list that are ready to run, in order (see iter_ready())
+def ready_tasks(tasks : list, now=None, policy=None, predict=None):
+	return list(iter_ready(tasks, now, policy, predict))
+
+# Returns the task that runs next among the given tasks, or None if none are ready
+# This is the decision next_task() makes, without its side effects (see simulate.py)
+def select_next(tasks : list, now=None, policy=None, predict=None, fair_state=None, running=None):
+	return next(iter_ready(tasks, now, policy, predict, fair_state, running), None)
+
+# Returns the task that next_task() would take after the current one, without taking it, or None
+def peek_task():
+	return select_next(read_tasks())
 
 # Make sure to call clear_current_task() first is appropriate
 # If a current task exists, returns that one. Otherwise, retrieves the next one from a list
+# The task with the highest 'priority' is retrieved, or the next one among equals by scheduling_policy (see preempt.py)
+# Tasks waiting to be retried (see watchdog.py) are passed over until their 'not_before' time
+# Queued tasks whose results are in the render cache are completed immediately and skipped (see rendercache.py)
 def next_task():
+	import rendercache
 	lock_disk()
 	current = get_current_task()
 	if current is not None:
 		unlock_disk()
 		return current
 	tasks = read_tasks()
-	if len(tasks) == 0:
-		unlock_disk()
-		return None
-	next = tasks[0]
-	tasks = tasks[1:]
-	write_tasks(tasks)
+	# Taking tasks uses up their submitters' turns (see fairshare.py)
+	fair_state, running = None, None
+	if scheduling_policy == 'fair':
+		import fairshare
+		fair_state, running = fairshare.read_state(), fairshare.running_counts()
+	next = None
+	taken = set()
+	for task in iter_ready(tasks, fair_state=fair_state, running=running):
+		taken.add(id(task))
+		entry = rendercache.lookup(task)
+		if entry is None:
+			next = task
+			next.info.pop('not_before', None)
+			break
+		print(f'Render cache hit: "{task.args[0]}"')
+		add_completed(rendercache.complete_hit(task, entry))
+	if len(taken) > 0:
+		write_tasks([t for t in tasks if id(t) not in taken])
+		if fair_state is not None:
+			fairshare.write_state(fair_state)
 	unlock_disk()
 	return next
 
+# Returns the highest priority of the queued tasks that are ready to run, or None if there are none
+def highest_priority():
+	now = time.time()
+	priorities = [t.info.get('priority', 0) for t in read_tasks() if t.info.get('not_before', 0) <= now]
+	return max(priorities) if len(priorities) > 0 else None
+
+# Returns the earliest time at which a queued task waiting to be retried becomes ready, or None if there is none
+def next_retry_time():
+	times = [t.info['not_before'] for t in read_tasks() if 'not_before' in t.info]
+	return min(times) if len(times) > 0 else None
+
 # Clears the queue of all tasks. Does not affect the current task
 def clear_tasks():
 	lock_disk()
@@ -213,73 +546,108 @@ def get_current_task():
 
 def make_task_current(task : Task):
 	lock_disk()
-	clear_current_task()
-	with open(currenttask_filename, 'w') as f:
-		f.write(str(task))
+	write_atomic(currenttask_filename, str(task))
 	unlock_disk()
 
 
 
-# Writes the given list of CompletedTasks to disk
-def write_completed(tasks : list):
-	write_list(completed_filename, tasks)
-
-# Reads the first num completed tasks. If num is negative, returns all completed tasks
+history_strings = history.StringTable(history_strings_filename)
+completed_history = history.History(completed_filename, history_strings, locked_disk)
+failed_history = history.History(failed_filename, history_strings, locked_disk)
+history_migrated = False
+
+# Converts the completed and failed lists from the old text format, if they have not been yet
+# The text files are kept, renamed to end in .migrated
+def migrate_history():
+	global history_migrated
+	if history_migrated:
+		return
+	with locked_disk():
+		for legacy, hist, type in [(legacy_completed_filename, completed_history, CompletedTask),
+			(legacy_failed_filename, failed_history, FailedTask)]:
+			if os.path.exists(legacy):
+				# Completed tasks were stored as plain tasks. The time they finished was not recorded
+				tasks = [t if isinstance(t, type) else type(t, 0) for t in read_list(legacy, type)]
+				# Text files are newest first
+				hist.append(t.to_record() for t in reversed(tasks))
+				os.replace(legacy, legacy + '.migrated')
+		history_migrated = True
+
+
+# Writes the given list of CompletedTasks (newest first) to disk, replacing the list
+def write_completed(tasks):
+	import stats
+	migrate_history()
+	completed_history.write(t.to_record() for t in reversed(list(tasks)))
+	stats.invalidate()
+
+# Reads the first (newest) num completed tasks. If num is negative, returns all completed tasks
+# Only the tasks returned are read, however many there are
 def read_completed(num=-1) -> list:
-	return read_list(completed_filename, CompletedTask, num)
+	migrate_history()
+	return [CompletedTask.from_record(r) for r in completed_history.newest(num)]
+
+# Yields completed tasks, newest first, reading each one only when it is needed
+def iter_completed():
+	migrate_history()
+	for record in completed_history.iter_newest():
+		yield CompletedTask.from_record(record)
 
 # Adds the given task to the list of completed tasks
+# The aggregate statistics are updated at the same time (see stats.py)
 def add_completed(task : CompletedTask):
-	lock_disk()
-	tasks = read_completed()
-	tasks.insert(0, task)
-	write_completed(tasks)
-	unlock_disk()
+	import stats
+	migrate_history()
+	with locked_disk():
+		stats.record(task, False)
+		completed_history.append([task.to_record()])
 
 # Clears the list of completed tasks. If keep is positive, clears all except the most recent keep tasks
 def clear_completed(keep=-1):
+	import stats
+	migrate_history()
 	if keep > 0:
-		lock_disk()
-		tasks = read_completed()
-		tasks = tasks[keep - 1:]
-		write_completed(tasks)
-		unlock_disk()
+		completed_history.keep_newest(keep)
 	else:
-		lock_disk()
-		path = pathlib.Path(completed_filename)
-		if path.exists():
-			path.unlink()
-		unlock_disk()
+		completed_history.clear()
+	stats.invalidate()
 
 
 
-# Writes the given list of FailedTasks to disk
-def write_failed(tasks : list):
-	write_list(failed_filename, tasks)
+# Writes the given list of FailedTasks (newest first) to disk, replacing the list
+def write_failed(tasks):
+	import stats
+	migrate_history()
+	failed_history.write(t.to_record() for t in reversed(list(tasks)))
+	stats.invalidate()
 
-# Reads the first num failed tasks. If num is negative, returns all failed tasks
+# Reads the first (newest) num failed tasks. If num is negative, returns all failed tasks
+# Only the tasks returned are read, however many there are
 def read_failed(num=-1) -> list:
-	return read_list(failed_filename, FailedTask, num)
+	migrate_history()
+	return [FailedTask.from_record(r) for r in failed_history.newest(num)]
+
+# Yields failed tasks, newest first, reading each one only when it is needed
+def iter_failed():
+	migrate_history()
+	for record in failed_history.iter_newest():
+		yield FailedTask.from_record(record)
 
 # Adds the given task to the list of failed tasks
+# The aggregate statistics are updated at the same time (see stats.py)
 def add_failed(task : FailedTask):
-	lock_disk()
-	tasks = read_failed()
-	tasks.insert(0, task)
-	write_failed(tasks)
-	unlock_disk()
+	import stats
+	migrate_history()
+	with locked_disk():
+		stats.record(task, True)
+		failed_history.append([task.to_record()])
 
 # Clears the list of failed tasks. If keep is positive, clears all except the most recent keep tasks
 def clear_failed(keep=-1):
+	import stats
+	migrate_history()
 	if keep > 0:
-		lock_disk()
-		tasks = read_failed()
-		tasks = tasks[keep - 1:]
-		write_failed(tasks)
-		unlock_disk()
+		failed_history.keep_newest(keep)
 	else:
-		lock_disk()
-		path = pathlib.Path(failed_filename)
-		if path.exists():
-			path.unlink()
-		unlock_disk()
+		failed_history.clear()
+	stats.invalidate()
@@ -0,0 +1,204 @@
+import os
+import gzip
+import time
+import threading
+import itertools
+import collections
+
+import taskfile
+
+
+'''
+tasklog
+Captures the output (stdout and stderr) of the Blender processes of tasks, so it can be read after they finish
+
+While a process runs, a Capture thread reads its output and keeps the first head_size bytes and a ring buffer
+of the last tail_size bytes in memory; anything in between is dropped (and counted). When the process ends,
+this is appended to the task's log file (see log_filename()) as its own gzip member, after a header line naming
+the process and its exit code. A task run several times (e.g. resumed, retried or a bake with several
+processes) therefore has one section per process, and its log never holds more than head_size + tail_size
+bytes per process. The log's path is stored in task.info['log']
+
+Stored logs are read by decompressing them as a stream, so reading the end of a log only keeps that much
+in memory. The output of running processes is read from their Captures (see live())
+Once there are more than max_logs log files, the oldest are removed
+'''
+
+
+# The directory in which logs are stored. The cwd is used
+logs_dir = 'tasks/logs'
+
+# The bytes kept from the start and the end of the output of each process
+head_size = 64 * 1024
+tail_size = 256 * 1024
+
+# The number of log files kept
+max_logs = 1000
+
+
+# Held while log files are written or removed
+mutex = threading.Lock()
+# Task id -> the Captures of its running processes
+captures = {}
+captures_mutex = threading.Lock()
+
+
+def log_filename(id):
+	return os.path.join(logs_dir, f'{id}.log.gz')
+
+
+# Reads the output of one process until it ends
+class Capture(threading.Thread):
+	def __init__(self, task : taskfile.Task, proc, label):
+		threading.Thread.__init__(self, name='Capture', daemon=True)
+		self.id = task.id()
+		self.filename = log_filename(self.id)
+		self.proc = proc
+		self.label = label
+		self.started = time.time()
+		self.cv = threading.Condition()
+		# (line number, line) of the first lines, at most head_size bytes together
+		self.head = []
+		self.head_bytes = 0
+		# (line number, line) of the last lines, at most tail_size bytes together
+		self.tail = collections.deque()
+		self.tail_bytes = 0
+		self.omitted = 0
+		self.count = 0
+		self.done = False
+
+	def run(self):
+		for line in iter(self.proc.stdout.readline, b''):
+			self.add(line)
+		with self.cv:
+			self.done = True
+			self.cv.notify_all()
+
+	def add(self, line : bytes):
+		with self.cv:
+			self.count += 1
+			if len(self.tail) == 0 and self.head_bytes + len(line) <= head_size:
+				self.head.append((self.count, line))
+				self.head_bytes += len(line)
+			else:
+				self.tail.append((self.count, line))
+				self.tail_bytes += len(line)
+				while self.tail_bytes > tail_size:
+					_, dropped = self.tail.popleft()
+					self.tail_bytes -= len(dropped)
+					self.omitted += len(dropped)
+			self.cv.notify_all()
+
+	# Returns the kept output as bytes
+	def contents(self):
+		with self.cv:
+			s = b''.join(line for _, line in self.head)
+			if self.omitted > 0:
+				s += f'[... {self.omitted} bytes omitted ...]\n'.encode()
+			return s + b''.join(line for _, line in self.tail)
+
+	# Yields lines as they are written, beginning with the last num kept lines, until the process ends
+	# or stop (a threading.Event) is set
+	def follow(self, num, stop):
+		seen = None
+		while not stop.is_set():
+			with self.cv:
+				if seen is None:
+					seen = max(self.count - num, 0)
+				elif self.count == seen:
+					if self.done:
+						return
+					self.cv.wait(0.5)
+				lines = self.since(seen)
+			for n, line in lines:
+				seen = n
+				yield line
+
+	# Returns the kept (line number, line) after line number seen, in order. Call with cv held
+	# Line numbers start at 1 and have no gaps within the head and within the tail
+	def since(self, seen):
+		lines = self.head[seen:]
+		if len(self.tail) > 0:
+			lines += itertools.islice(self.tail, max(seen + 1 - self.tail[0][0], 0), None)
+		return lines
+
+	def save(self):
+		code = self.proc.poll()
+		header = f'===== {self.label}, started {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started))}, ' + \
+			f'exit code {code} =====\n'
+		with mutex:
+			os.makedirs(logs_dir, exist_ok=True)
+			# Appending writes a new gzip member; readers decompress all members in order
+			with gzip.open(self.filename, 'ab') as f:
+				f.write(header.encode() + self.contents())
+		prune()
+
+
+# Starts capturing the output of proc, which must have been started with stdout=subprocess.PIPE
+# label names the process in the log
+def capture(task : taskfile.Task, proc, label):
+	c = Capture(task, proc, label)
+	proc.log = c
+	with captures_mutex:
+		captures.setdefault(c.id, []).append(c)
+	c.start()
+	return c
+
+# Called once proc has ended: stores its captured output. Does nothing if its output was not captured
+def finish(proc):
+	c = getattr(proc, 'log', None)
+	if c is None:
+		return
+	c.join()
+	try:
+		c.save()
+	except OSError as e:
+		print(f'Could not store the log of task {c.id}: {e}')
+	with captures_mutex:
+		running = captures.get(c.id, [])
+		if c in running:
+			running.remove(c)
+		if len(running) == 0:
+			captures.pop(c.id, None)
+
+# Returns the Captures of the running processes of the task with the given id
+def live(id):
+	with captures_mutex:
+		return list(captures.get(id, []))
+
+# Removes the oldest log files once there are more than max_logs
+def prune():
+	with mutex:
+		try:
+			names = [n for n in os.listdir(logs_dir) if n.endswith('.log.gz')]
+		except OSError:
+			return
+		if len(names) <= max_logs:
+			return
+		paths = sorted((os.path.join(logs_dir, n) for n in names), key=os.path.getmtime)
+		for path in paths[:len(paths) - max_logs]:
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+
+
+# Yields the lines of a stored log, decompressing it as they are read
+def iter_lines(filename):
+	with gzip.open(filename, 'rt', encoding='utf-8', errors='replace') as f:
+		for line in f:
+			yield line
+
+# Returns the last num lines of a stored log
+def read_tail(filename, num):
+	return list(collections.deque(iter_lines(filename), maxlen=num))
+
+# Returns the id of the task whose log matches the given id or unique prefix of one, or None
+def find(prefix):
+	ids = set(captures)
+	try:
+		ids.update(n[:-len('.log.gz')] for n in os.listdir(logs_dir) if n.endswith('.log.gz'))
+	except OSError:
+		pass
+	matches = [id for id in ids if id.startswith(prefix)]
+	return matches[0] if len(matches) == 1 else None
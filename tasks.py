@@ -1,8 +1,14 @@
 
 from pathlib import Path
 import subprocess
+import time
+import json
+import os
 
 import taskfile
+import blendfile
+import phases
+import tiles
 
 
 '''
@@ -14,29 +20,145 @@ Runs tasks of all types. Also has some utilities to validate files and task argu
 
 brender_path = Path(__file__).parent.joinpath('brender.py').absolute()
 
+# Either the executable, or a list of arguments that runs it (e.g. [sys.executable, 'fakeblender.py'])
 blender_path = "blender"
 
 
 
+# Render settings that can be overridden per task, and the type of their values. See brender.py
+OVERRIDES = {
+	'samples': int,
+	'adaptive_threshold': float,
+	'resolution_percentage': int,
+	# OFF, OPENIMAGEDENOISE or OPTIX
+	'denoiser': str,
+	'tile_size': int,
+	'threads': int,
+	'frame_start': int,
+	'frame_end': int,
+	'frame_step': int,
+	# Any of Blender's image formats, e.g. PNG, JPEG, OPEN_EXR
+	'file_format': str,
+}
+
+# Named sets of overrides. "final" renders every frame at full resolution, with the file's own sampling settings
+PRESETS = {
+	'preview': {'samples': 32, 'adaptive_threshold': 0.1, 'resolution_percentage': 50, 'denoiser': 'OPENIMAGEDENOISE'},
+	'final': {'resolution_percentage': 100, 'frame_step': 1},
+}
+
+# Options that are not render settings. Each is parsed into task.info[name] by the given function,
+# which raises ValueError if the value is invalid
+TASK_OPTIONS = {
+	# Steps to run once the task completes, e.g. post=encode,checksum (see postproc.py)
+	'post': lambda value: parse_post(value),
+	# Watchdog thresholds in seconds: total run time, and time without progress (see watchdog.py)
+	'timeout': float,
+	'stall': float,
+	# The number of times a stalling task is run before it fails (see watchdog.py)
+	'max_attempts': int,
+	# Tasks with a higher priority run first, and preempt running tasks with a lower one (see preempt.py)
+	'priority': int,
+	# Splits a still into COLUMNSxROWS tiles rendered as separate tasks, e.g. tiles=4x4 (see tiles.py)
+	'tiles': lambda value: tiles.parse_tiles(value),
+	# The person or project the task is run for. The queue is shared fairly between them (see fairshare.py)
+	'submitter': str,
+}
+
+# postproc (and bakejob, see bake()) are only imported when needed, so that one-shot commands start quickly
+def parse_post(value):
+	import postproc
+	return postproc.parse_steps(value)
+
+# Parses task options given on the command line, e.g. ['preview', 'samples=64']
+# Presets are applied first (in order), then individual settings
+# type is the taskfile.TaskType of the task, if known, so options that do not apply to it are rejected
+# Returns the info dict for the task. Raises ValueError if an option is not recognized or does not apply
+def parse_task_options(options : list, type=None) -> dict:
+	preset = None
+	overrides = {}
+	settings = {}
+	info = {}
+	for option in options:
+		if option in PRESETS:
+			preset = option
+			overrides.update(PRESETS[option])
+			continue
+		key, sep, value = option.partition('=')
+		if sep != '' and key in TASK_OPTIONS:
+			try:
+				info[key] = TASK_OPTIONS[key](value)
+			except ValueError as e:
+				raise ValueError(f"Invalid value for '{key}': {e}")
+			continue
+		if sep == '' or key not in OVERRIDES:
+			raise ValueError(f"Unknown option '{option}'")
+		try:
+			settings[key] = OVERRIDES[key](value)
+		except ValueError:
+			raise ValueError(f"Invalid value for '{key}': '{value}'")
+	overrides.update(settings)
+	if 'tiles' in info and type is not None and type != taskfile.TaskType.RENDER_STILL:
+		raise ValueError("'tiles' only applies to still renders")
+	if preset is not None:
+		info['preset'] = preset
+	if len(overrides) > 0:
+		info['overrides'] = overrides
+	return info
+
+
 def is_valid_file(file : Path):
 	file = Path(file)
 	return file.exists() and file.is_file()
 
+# Only reads the first few bytes of the file. Use blendfile.read_info() for metadata
 def is_valid_blend(file : Path):
 	file = Path(file)
-	return is_valid_file(file) and file.suffix == '.blend'
+	return is_valid_file(file) and file.suffix == '.blend' and blendfile.has_blend_header(file)
+
 
 
+# Run by Blender before it loads the blend file, so scripts can tell startup time apart from load time
+STARTUP_EXPR = "import os, time; os.environ['LRQ_STARTUP_TIME'] = str(time.time())"
 
-def launch_blender(filename, script, extra_args):
+# Returns the command line (as a list) that runs the given script in Blender on the given file
+# If filename is None, Blender starts with its factory settings and no file
+# extra_args is a list of strings passed to the script after "--"
+def blender_command(filename, script, extra_args : list) -> list:
+	command = [blender_path] if isinstance(blender_path, str) else list(blender_path)
+	command += ['-b', '--python-expr', STARTUP_EXPR]
+	command += ['--factory-startup'] if filename is None else [str(filename)]
+	return command + ['-P', str(script), '--'] + [str(a) for a in extra_args]
+
+# If task is given, Blender's output is captured in the task's log (see tasklog.py) instead of being shown
+def launch_blender(filename, script, extra_args : list, task : taskfile.Task = None):
 	if not is_valid_blend(filename):
 		# TODO: raise a warning and fail the task
 		print(f'Invalid blend file: {filename}')
 		return None
 	try:
-		return subprocess.Popen(
-			f'{blender_path} -b "{filename}" -P "{script}" -- {extra_args}',
-			creationflags=subprocess.CREATE_NEW_CONSOLE)
+		if task is None:
+			return subprocess.Popen(
+				blender_command(filename, script, extra_args),
+				# New consoles only exist on Windows
+				creationflags=getattr(subprocess, 'CREATE_NEW_CONSOLE', 0))
+		import tasklog
+		proc = subprocess.Popen(
+			blender_command(filename, script, extra_args),
+			stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		tasklog.capture(task, proc, Path(script).stem)
+		return proc
+	except OSError:
+		print("Could not find 'blender'. Make sure the executable is in your PATH.")
+		return None
+
+# Runs the given script in Blender on the given file and waits for it to finish, hiding its output
+# Returns Blender's exit code, or None if Blender could not be launched
+def run_blender(filename, script, extra_args : list):
+	try:
+		return subprocess.run(
+			blender_command(filename, script, extra_args),
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
 	except OSError:
 		print("Could not find 'blender'. Make sure the executable is in your PATH.")
 		return None
@@ -47,26 +169,54 @@ def launch_blender(filename, script, extra_args):
 # If the task failed to launch, returns None
 def run_task(task : taskfile.Task):
 	if task.type == taskfile.TaskType.RENDER_ANIMATION:
-		return render_animation(task.args)
+		return render_animation(task)
 	elif task.type == taskfile.TaskType.RENDER_STILL:
-		return render_still(task.args)
+		return render_still(task)
 	elif task.type == taskfile.TaskType.BAKE:
-		return bake(task.args)
+		return bake(task)
 	else:
 		print(f'Error: Unknown task type: {task.type}')
 		return None
 
-def render_animation(args):
-	filename = args[0]
-	# Arg 0: whether to render an animation (if false, then this is a still image)
-	return launch_blender(filename, brender_path, '1')
+# Returns the arguments passed to brender.py. This must match the argument parsing in brender.py
+def brender_args(task : taskfile.Task, animation : bool):
+	os.makedirs(phases.phases_dir, exist_ok=True)
+	return ['1' if animation else '0',
+		'--launch-time', repr(time.time()),
+		'--phases', Path(phases.phases_filename(task)).absolute(),
+		'--overrides', json.dumps(task.info.get('overrides', {}))] + \
+		(['--frames', ','.join(str(f) for f in task.info['frame_list'])] if 'frame_list' in task.info else []) + \
+		(['--tile', ','.join(str(i) for i in task.info['tile']), '--tile-output', tiles.tile_path(task)]
+			if 'tile' in task.info else []) + \
+		(['--stitch', tiles.stitch_filename(task.info['stitch'])] if 'stitch' in task.info else [])
+
+# Launches brender.py for the task, on a staged copy of its blend file if there is one (see staging.py)
+# Outputs relative to the blend file are written next to task.info['original_file'], if it is set (see lan.py),
+# and otherwise next to the queued file
+def launch_render(task : taskfile.Task, animation : bool):
+	import staging
+	filename = task.args[0]
+	args = brender_args(task, animation)
+	staged = staging.stage(task)
+	if staged is not None or 'original_file' in task.info:
+		args += ['--original-file', task.info.get('original_file', str(Path(filename).absolute()))]
+	if staged is not None:
+		filename = staged
+	return launch_blender(filename, brender_path, args, task)
+
+def render_animation(task : taskfile.Task):
+	return launch_render(task, True)
 	
 
-def render_still(args):
-	filename = args[0]
-	# Arg 0: whether to render an animation (if false, then this is a still image)
-	return launch_blender(filename, brender_path, '0')
+def render_still(task : taskfile.Task):
+	return launch_render(task, False)
 
 
-def bake(args):
-	pass
\ No newline at end of file
+# Returns a bakejob.BakeJob, which BgdThread treats like a subprocess.Popen object
+def bake(task : taskfile.Task):
+	filename = task.args[0]
+	if not is_valid_blend(filename):
+		print(f'Invalid blend file: {filename}')
+		return None
+	import bakejob
+	return bakejob.BakeJob(task).start()
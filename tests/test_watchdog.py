@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import taskfile
+import watchdog
+
+
+# Stands in for a process; bake jobs also report their pids this way (see bakejob.py)
+class FakeProc:
+	progress = None
+
+	def pids(self):
+		return []
+
+
+class TestTimeLimit(unittest.TestCase):
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.tmp = tempfile.TemporaryDirectory()
+		os.chdir(self.tmp.name)
+		os.makedirs('tasks')
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		self.tmp.cleanup()
+
+	def test_retry_after_time_limit_gets_the_whole_limit(self):
+		task = taskfile.Task(taskfile.TaskType.RENDER_STILL, ['a.blend'], info={'timeout': 10})
+		first = watchdog.Watchdog(task, FakeProc(), None)
+		reason = first.check(11)
+		self.assertIn('time limit', reason)
+		# As BgdThread.stop_timer() does when the stalled process is killed
+		task.time += 11
+		self.assertTrue(watchdog.retry(task, reason))
+		retried = taskfile.read_tasks()[0]
+		self.assertEqual(retried.time, 11)
+		second = watchdog.Watchdog(retried, FakeProc(), None)
+		self.assertIsNone(second.check(watchdog.check_interval))
+		self.assertIn('time limit', second.check(11))
+
+	def test_resumed_process_keeps_its_time(self):
+		task = taskfile.Task(taskfile.TaskType.RENDER_STILL, ['a.blend'], info={'timeout': 10})
+		resumed = watchdog.Watchdog(task, FakeProc(), None, run_time=8)
+		self.assertIsNone(resumed.check(resumed.elapsed()))
+		self.assertIn('time limit', resumed.check(8 + 3))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,171 @@
+import os
+import json
+import copy
+import shutil
+from pathlib import Path
+
+import taskfile
+
+
+'''
+tiles
+Splits a still render into tiles that are rendered as separate tasks, and stitches them once all are done,
+so that one large still can be rendered in parts, each of which can be preempted, retried and verified alone
+Requested with the "tiles" option, e.g. "still a.blend tiles=4x4"
+
+When a tiled still is taken from the queue, it is replaced by one task per tile, put at the front of the queue
+	- Each tile task (task.info['tile'] = [x, y, columns, rows], counted from the bottom left) renders only its
+	  region of the image with a render border (see brender.py), and saves it to tiles_dir
+	- Tile tasks are ordinary tasks, so they are verified, retried and preempted like any other. They are only
+	  rendered by the machine that queued the still, since their images must be in its tiles_dir to be stitched;
+	  LAN workers are not given tiles (see capacity.assign())
+	- Once every tile has completed, a stitch task (task.info['stitch']) is put at the front of the queue.
+	  It loads the blend file like the tile tasks did, and writes the tiles into the image the still would
+	  have written (see brender.py)
+Tiled stills in progress are stored in state_filename. If a tile fails, its still is abandoned
+'''
+
+
+# The file in which tiled stills in progress are stored. The cwd is used
+state_filename = 'tasks/tiles.json'
+
+# The directory in which tile images are stored, in a directory per still. The cwd is used
+tiles_dir = 'tasks/tiles'
+
+# The largest number of columns or rows
+MAX_TILES = 64
+
+
+# Parses the value of the "tiles" option, e.g. "4x2" (4 columns, 2 rows). Raises ValueError if it is invalid
+def parse_tiles(value : str) -> list:
+	columns, sep, rows = value.lower().partition('x')
+	if sep == '':
+		raise ValueError(f"'{value}' is not of the form COLUMNSxROWS, e.g. 4x4")
+	columns, rows = int(columns), int(rows)
+	if not (1 <= columns <= MAX_TILES and 1 <= rows <= MAX_TILES):
+		raise ValueError(f'Columns and rows must be between 1 and {MAX_TILES}')
+	return [columns, rows]
+
+# Whether the task is a tiled still that has not been split yet
+def is_tiled(task : taskfile.Task):
+	return task.type == taskfile.TaskType.RENDER_STILL and 'tiles' in task.info
+
+# The directory of a tiled still's tile images
+def still_dir(id):
+	return Path(tiles_dir).joinpath(str(id)).absolute()
+
+# The path of a tile task's image, without its extension (which depends on the file format, see brender.py)
+def tile_path(task : taskfile.Task):
+	x, y, _, _ = task.info['tile']
+	return still_dir(task.info['tile_of']).joinpath(f'{x}_{y}')
+
+# The file listing the tile images of a stitch task (see brender.py)
+def stitch_filename(id):
+	return still_dir(id).joinpath('tiles.json')
+
+
+def read_state() -> dict:
+	try:
+		with open(state_filename, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def write_state(state : dict):
+	taskfile.lock_disk()
+	try:
+		taskfile.write_atomic(state_filename, json.dumps(state))
+	finally:
+		taskfile.unlock_disk()
+
+
+def inherited_info(task : taskfile.Task):
+	return {k: copy.deepcopy(v) for k, v in task.info.items() if k in taskfile.INHERITED_INFO}
+
+# Replaces a tiled still (just taken from the queue) with its tile tasks, at the front of the queue
+def split(task : taskfile.Task):
+	columns, rows = task.info['tiles']
+	id = task.id()
+	tile_tasks = []
+	for y in range(rows):
+		for x in range(columns):
+			info = inherited_info(task)
+			info['tile'] = [x, y, columns, rows]
+			info['tile_of'] = id
+			tile_tasks.append(taskfile.Task(taskfile.TaskType.RENDER_STILL, list(task.args), 0, info))
+	os.makedirs(still_dir(id), exist_ok=True)
+	taskfile.lock_disk()
+	try:
+		state = read_state()
+		state[str(id)] = {'task': task.to_dict(), 'tiles': {}}
+		write_state(state)
+		taskfile.create_tasks(tile_tasks, 0)
+	finally:
+		taskfile.unlock_disk()
+	print(f'Split still "{task.args[0]}" into {columns}x{rows} tiles')
+
+# Called when a tile task completes with the images it wrote
+# Once every tile of its still has completed, puts the stitch task at the front of the queue
+def tile_done(task : taskfile.Task, outputs : list):
+	if len(outputs) == 0:
+		return
+	id = str(task.info['tile_of'])
+	x, y, columns, rows = task.info['tile']
+	taskfile.lock_disk()
+	try:
+		state = read_state()
+		still = state.get(id, None)
+		if still is None:
+			# The still was abandoned
+			return
+		still['tiles'][f'{x},{y}'] = {'tile': task.info['tile'], 'path': outputs[-1], 'time': task.time}
+		if len(still['tiles']) < columns * rows:
+			write_state(state)
+			return
+		with open(stitch_filename(id), 'w') as f:
+			json.dump(list(still['tiles'].values()), f)
+		parent = taskfile.Task.from_dict(still['task'])
+		info = inherited_info(parent)
+		info['stitch'] = parent.id()
+		stitch = taskfile.Task(taskfile.TaskType.RENDER_STILL, list(parent.args), 0, info)
+		write_state(state)
+		taskfile.create_tasks([stitch], 0)
+	finally:
+		taskfile.unlock_disk()
+	print(f'All {columns * rows} tiles of "{task.args[0]}" are done. Stitching')
+
+# Called when a tile task fails. Abandons its still
+def tile_failed(task : taskfile.Task):
+	id = task.info['tile_of']
+	taskfile.lock_disk()
+	try:
+		state = read_state()
+		if state.pop(str(id), None) is None:
+			return
+		write_state(state)
+	finally:
+		taskfile.unlock_disk()
+	print(f'A tile of "{task.args[0]}" failed. Its other tiles are not stitched')
+
+# Called when a stitch task completes. Records the total time of all tiles in task.info["tile_time"] and removes them
+def stitched(task : taskfile.Task):
+	id = str(task.info['stitch'])
+	taskfile.lock_disk()
+	try:
+		state = read_state()
+		still = state.pop(id, None)
+		write_state(state)
+	finally:
+		taskfile.unlock_disk()
+	if still is not None:
+		task.info['tile_time'] = round(sum(t['time'] for t in still['tiles'].values()), 3)
+	shutil.rmtree(still_dir(id), ignore_errors=True)
+
+# Returns the number of tiles done and the total number of each tiled still in progress, by file
+def in_progress():
+	progress = []
+	for still in read_state().values():
+		task = taskfile.Task.from_dict(still['task'])
+		columns, rows = task.info['tiles']
+		progress.append((task.args[0], len(still['tiles']), columns * rows))
+	return progress
@@ -0,0 +1,194 @@
+import os
+import copy
+import struct
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import taskfile
+import phases
+
+
+'''
+verify
+Checks the images of a completed render, and queues a task that renders again only the frames that are bad
+
+brender.py reports the images it is expected to write (an "expected" event, see phases.py). When a render task
+completes, each of them is checked in a pool of threads:
+	- the file exists and is not empty
+	- its header matches its format, and for formats whose end can be recognized (PNG, JPEG) or whose
+	  length is in the header (BMP, WebP), it is complete
+Formats that cannot be checked (e.g. TGA, which has no magic number) are only checked for existence and size.
+Movie outputs are written as a whole and are not checked
+
+If any frame is bad, a task rendering only those frames (task.info['frame_list']) is put at the front of the queue,
+and the completed task records them in task.info['bad_frames']. The new task's outputs are verified in turn,
+up to max_rounds times. Post-processing (see postproc.py) is passed on to the new task, so it runs once
+the sequence is whole
+'''
+
+
+# Set to False to never verify outputs
+enabled = True
+
+# The number of threads that check images at the same time. Checks mostly wait for the disk
+max_workers = 8
+
+# The number of times the bad frames of a task are rendered again
+max_rounds = 2
+
+# The number of bytes read from the start of a file (enough for every check) and from its end
+HEAD_SIZE = 16
+TRAILER_SIZE = 16
+
+
+# Each check is given the first bytes of the file, its last TRAILER_SIZE bytes and its size,
+# and returns the reason the image is bad, or None
+
+def check_png(head, tail, size):
+	if not head.startswith(b'\x89PNG\r\n\x1a\n'):
+		return 'not a PNG image'
+	if b'IEND' not in tail:
+		return 'truncated'
+	return None
+
+def check_jpeg(head, tail, size):
+	if not head.startswith(b'\xff\xd8\xff'):
+		return 'not a JPEG image'
+	if not tail.rstrip(b'\x00').endswith(b'\xff\xd9'):
+		return 'truncated'
+	return None
+
+def check_exr(head, tail, size):
+	if not head.startswith(b'\x76\x2f\x31\x01'):
+		return 'not an OpenEXR image'
+	return None
+
+def check_tiff(head, tail, size):
+	if not (head.startswith(b'II*\x00') or head.startswith(b'MM\x00*')):
+		return 'not a TIFF image'
+	return None
+
+def check_bmp(head, tail, size):
+	if not head.startswith(b'BM') or len(head) < 6:
+		return 'not a BMP image'
+	if struct.unpack_from('<I', head, 2)[0] > size:
+		return 'truncated'
+	return None
+
+def check_hdr(head, tail, size):
+	if not (head.startswith(b'#?RADIANCE') or head.startswith(b'#?RGBE')):
+		return 'not a Radiance HDR image'
+	return None
+
+def check_webp(head, tail, size):
+	if not head.startswith(b'RIFF') or head[8:12] != b'WEBP':
+		return 'not a WebP image'
+	if struct.unpack_from('<I', head, 4)[0] + 8 > size:
+		return 'truncated'
+	return None
+
+def check_jp2(head, tail, size):
+	if not (head.startswith(b'\x00\x00\x00\x0cjP  \r\n\x87\n') or head.startswith(b'\xff\x4f\xff\x51')):
+		return 'not a JPEG 2000 image'
+	return None
+
+def check_dpx(head, tail, size):
+	if not (head.startswith(b'SDPX') or head.startswith(b'XPDS')):
+		return 'not a DPX image'
+	return None
+
+CHECKS = {
+	'.png': check_png,
+	'.jpg': check_jpeg,
+	'.jpeg': check_jpeg,
+	'.exr': check_exr,
+	'.tif': check_tiff,
+	'.tiff': check_tiff,
+	'.bmp': check_bmp,
+	'.hdr': check_hdr,
+	'.webp': check_webp,
+	'.jp2': check_jp2,
+	'.j2c': check_jp2,
+	'.dpx': check_dpx,
+}
+
+
+# Returns the reason the image at path is bad, or None if it is good
+def check_image(path):
+	try:
+		size = os.path.getsize(path)
+	except OSError:
+		return 'missing'
+	if size == 0:
+		return 'empty'
+	check = CHECKS.get(Path(path).suffix.lower(), None)
+	if check is None:
+		return None
+	try:
+		with open(path, 'rb') as f:
+			head = f.read(HEAD_SIZE)
+			f.seek(max(0, size - TRAILER_SIZE))
+			tail = f.read(TRAILER_SIZE)
+	except OSError as e:
+		return f'unreadable ({e.strerror})'
+	return check(head, tail, size)
+
+# Returns [[frame, path]] of the images the task was expected to write, or None if brender.py reported none
+def expected_frames(events):
+	expected = None
+	# A resumed task reports them once per run. A run may only render the frames earlier runs did not
+	# (see preempt.skip_written_frames()), so all of them are checked, with the path of the latest run
+	for e in events:
+		if e['event'] == 'expected':
+			expected = expected if expected is not None else {}
+			expected.update((frame, path) for frame, path in e['frames'])
+	return [[frame, path] for frame, path in sorted(expected.items())] if expected is not None else None
+
+# Checks the given [[frame, path]] in parallel. Returns {frame: reason} of the bad ones
+def check_frames(frames):
+	if len(frames) == 0:
+		return {}
+	with ThreadPoolExecutor(max_workers=min(max_workers, len(frames))) as pool:
+		reasons = list(pool.map(check_image, [path for _, path in frames]))
+	return {frame: reason for (frame, _), reason in zip(frames, reasons) if reason is not None}
+
+
+# Called by BgdThread.complete() before the task's events are removed (see phases.attach())
+# Returns [[frame, path]] of every image the task was expected to write, or None if they cannot be verified
+def expected(task : taskfile.Task):
+	if not enabled or task.type not in (taskfile.TaskType.RENDER_ANIMATION, taskfile.TaskType.RENDER_STILL):
+		return None
+	return expected_frames(phases.read_events(task))
+
+# Checks the images of a completed task, recording any bad frames in task.info['bad_frames']
+# Returns the task that renders them again, or None if every image is good or no rounds are left
+# The returned task is not queued yet, so the completed task can be recorded first
+def verify(task : taskfile.Task, frames : list):
+	bad = check_frames(frames)
+	if len(bad) == 0:
+		return None
+	task.info['bad_frames'] = {str(frame): reason for frame, reason in sorted(bad.items())}
+	print(f'{len(bad)} of {len(frames)} frames are bad: ' +
+		', '.join(f'{frame} ({reason})' for frame, reason in sorted(bad.items())[:10]) +
+		(', ...' if len(bad) > 10 else ''))
+	rounds = task.info.get('verify_round', 0) + 1
+	if rounds > max_rounds:
+		print('Not rendering them again: no rounds left')
+		return None
+	# Re-rendering a tile or stitch task keeps what it renders
+	info = {k: copy.deepcopy(v) for k, v in task.info.items()
+		if k in taskfile.INHERITED_INFO + ('tile', 'tile_of', 'stitch')}
+	info['verify_of'] = task.id()
+	info['verify_round'] = rounds
+	# A still has a single image, so it is rendered again as it was (e.g. the same tile, see tiles.py)
+	if task.type == taskfile.TaskType.RENDER_ANIMATION:
+		info['frame_list'] = sorted(bad)
+	if 'post' in info:
+		# The whole sequence is post-processed once it is complete
+		info['post_outputs'] = task.info.get('post_outputs', [path for _, path in frames])
+	return taskfile.Task(task.type, list(task.args), 0, info)
+
+# Puts a task returned by verify() at the front of the queue
+def requeue(task : taskfile.Task):
+	taskfile.create_tasks([task], 0)
+	print(f'Rendering frames {", ".join(str(f) for f in task.info.get("frame_list", ["the still"]))} again')
@@ -0,0 +1,185 @@
+import os
+import time
+import threading
+
+import taskfile
+import phases
+import stats
+import events
+import preempt
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+
+'''
+watchdog
+Kills tasks whose Blender process has hung, and retries them with exponential backoff
+
+While a task runs, a Watchdog thread checks its heartbeat every check_interval seconds. Any of these counts:
+	- new timing events or written frames (see phases.py)
+	- CPU time used by the process (psutil if it is installed, otherwise /proc; unavailable elsewhere)
+	- caches baked, for bake tasks (see bakejob.py)
+A task stalls if it has no heartbeat for its stall threshold, or if it runs far longer than predicted
+	- The stall threshold is the task's "stall" option, or stall_timeout
+	- The time limit is the task's "timeout" option, or predict_factor times the mean time of earlier completed
+	  runs of the same file and settings (plus stall_timeout, see stats.py). Tasks with no earlier runs have no limit
+	  It applies to each run on its own, so a retry gets the whole limit again. A process that was suspended
+	  (see preempt.py) keeps the time it ran before
+
+A stalled task is killed and put back at the front of the queue with task.info['not_before'] set, so other
+tasks run in the meantime. Each retry waits twice as long as the one before. After max_attempts runs (or the
+task's "max_attempts" option), it fails; task.info['attempts'] and task.info['stalled'] record what happened
+
+The most memory the task's processes used at any check is recorded in task.info['peak_rss'] (see simulate.py)
+'''
+
+
+# Seconds between heartbeat checks
+check_interval = 5
+# Seconds without a heartbeat after which a task is stalled
+stall_timeout = 600
+# A task is stalled if it runs this many times longer than its predicted time
+predict_factor = 3
+# The number of runs a stalling task gets before it fails
+max_attempts = 3
+# Seconds before the first retry. Doubles with every attempt, up to max_retry_delay
+retry_delay = 30
+max_retry_delay = 3600
+
+# CPU seconds per check below which a process is considered idle
+MIN_CPU = 0.05
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+# Returns the total CPU seconds used by the given processes and their waited-for children, or None if unknown
+def cpu_time(pids):
+	total = 0
+	for pid in pids:
+		if psutil is not None:
+			try:
+				times = psutil.Process(pid).cpu_times()
+				total += times.user + times.system + times.children_user + times.children_system
+				continue
+			except psutil.Error:
+				return None
+		try:
+			with open(f'/proc/{pid}/stat', 'r') as f:
+				# The command name may contain spaces, but is the only field in parentheses
+				fields = f.read().rsplit(')', 1)[1].split()
+			# utime, stime, cutime and cstime are fields 14-17; fields[0] is field 3
+			total += sum(int(x) for x in fields[11:15]) / CLOCK_TICKS
+		except (OSError, IndexError, ValueError):
+			return None
+	return total
+
+# Watches a running task. proc is what tasks.run_task() returned; on_stall(proc, reason) is called once if it stalls
+# run_time is the seconds proc already ran before this Watchdog, e.g. before it was suspended
+class Watchdog(threading.Thread):
+	def __init__(self, task : taskfile.Task, proc, on_stall, run_time=0):
+		threading.Thread.__init__(self, name='Watchdog', daemon=True)
+		self.task = task
+		self.proc = proc
+		self.on_stall = on_stall
+		self.run_time = run_time
+		self.start_time = time.monotonic()
+		self.stop_event = threading.Event()
+		self.stall_after = float(task.info.get('stall', stall_timeout))
+		if 'timeout' in task.info:
+			self.time_limit = float(task.info['timeout'])
+		else:
+			predicted = stats.predict_duration(task)
+			self.time_limit = predicted * predict_factor + stall_timeout if predicted is not None else None
+		self.last_heartbeat = time.monotonic()
+		self.last_state = None
+		self.last_cpu = None
+		# For progress events (see events.py)
+		self.reader = phases.EventReader(task)
+		self.written = set()
+		self.expected = None
+		# The most resident memory the task's processes used at any check, in bytes (see simulate.py)
+		self.peak_rss = 0
+
+	def stop(self):
+		self.stop_event.set()
+
+	# The seconds proc has run, including run_time
+	def elapsed(self):
+		return self.run_time + time.monotonic() - self.start_time
+
+	# Records the peak memory in task.info['peak_rss'], keeping the peak of earlier runs
+	def record(self, task : taskfile.Task):
+		if self.peak_rss > 0:
+			task.info['peak_rss'] = max(task.info.get('peak_rss', 0), self.peak_rss)
+
+	def pids(self):
+		# Bake jobs run several processes (see bakejob.py)
+		if hasattr(self.proc, 'pids'):
+			return self.proc.pids()
+		return [self.proc.pid]
+
+	# Returns whether anything happened since the last check
+	def heartbeat(self):
+		try:
+			st = os.stat(phases.phases_filename(self.task))
+			state = (st.st_size, st.st_mtime, getattr(self.proc, 'progress', None))
+		except OSError:
+			state = (None, None, getattr(self.proc, 'progress', None))
+		beat = state != self.last_state
+		self.last_state = state
+		if beat:
+			self.publish_progress()
+		pids = self.pids()
+		rss = [preempt.rss(pid) for pid in pids]
+		self.peak_rss = max(self.peak_rss, sum(r for r in rss if r is not None))
+		cpu = cpu_time(pids)
+		if cpu is not None and self.last_cpu is not None and cpu - self.last_cpu >= MIN_CPU:
+			beat = True
+		self.last_cpu = cpu
+		return beat
+
+	# Publishes a progress event if frames were written since the last check
+	def publish_progress(self):
+		written = len(self.written)
+		for e in self.reader.read_new():
+			if e['event'] == 'expected':
+				self.expected = len(e['frames'])
+			elif e['event'] == 'write' and e.get('path', None) is not None:
+				self.written.add(e['path'])
+		if len(self.written) != written:
+			events.publish('progress', task=self.task, frames=len(self.written), expected=self.expected)
+
+	# Returns the reason the task is stalled, or None if it is not. elapsed is the seconds proc has run
+	# Earlier runs of the task (in task.time) do not count
+	def check(self, elapsed):
+		now = time.monotonic()
+		if self.heartbeat():
+			self.last_heartbeat = now
+		elif now - self.last_heartbeat > self.stall_after:
+			return f'No progress for {round(now - self.last_heartbeat)}s'
+		if self.time_limit is not None and elapsed > self.time_limit:
+			return f'Exceeded the time limit of {round(self.time_limit)}s'
+		return None
+
+	def run(self):
+		while not self.stop_event.wait(check_interval):
+			reason = self.check(self.elapsed())
+			if reason is not None:
+				self.on_stall(self.proc, reason)
+				return
+
+
+# Puts a stalled task back in the queue if it has attempts left. Returns whether it was requeued
+def retry(task : taskfile.Task, reason : str):
+	attempts = task.info.get('attempts', 0) + 1
+	task.info['attempts'] = attempts
+	task.info['stalled'] = reason
+	if attempts >= task.info.get('max_attempts', max_attempts):
+		return False
+	delay = min(retry_delay * 2 ** (attempts - 1), max_retry_delay)
+	task.info['not_before'] = time.time() + delay
+	taskfile.create_tasks([task], 0)
+	print(f'Task stalled ({reason}). Retrying in {delay}s')
+	return True
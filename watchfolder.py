@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import fnmatch
+import threading
+
+import __main__ as M
+import taskfile
+import tasks
+import fsnotify
+
+
+'''
+watchfolder
+Automatically queues .blend files that appear in watched folders (e.g. a share that artists drop files into)
+
+Files are only queued once they have settled, i.e. once their size and mtime have not changed for
+settle_time seconds, so that partially written or copied files are never queued
+Settled files are validated and then queued in batches (one taskfile rewrite per batch)
+Each version (mtime) of a file is queued at most once, even across restarts
+
+Folders are stored in watchfolders_filename as a JSON list of objects:
+	{"path": "/share/drop", "type": "ra", "position": "back", "recursive": false,
+	 "rules": [{"pattern": "*_still*.blend", "type": "rs", "position": "front"}]}
+type is a TaskType and position is "front" or "back" of the queue
+Folders and rules may also have "options", e.g. ["preview"] (see tasks.parse_task_options())
+The first rule whose pattern matches the file name overrides the folder's type, position and/or options
+'''
+
+
+# The name of the file in which watched folders are stored. The cwd is used
+watchfolders_filename = 'tasks/watchfolders.json'
+
+# The name of the file that records which file versions have already been queued. The cwd is used
+seen_filename = 'tasks/watchfolders_seen.json'
+
+# How long (in seconds) a file must remain unchanged before it is queued
+settle_time = 5.0
+
+# Used by the polling fallback when inotify is unavailable (e.g. on Windows or some network shares)
+poll_interval = 2.0
+
+
+class Position:
+	FRONT = 'front'
+	BACK = 'back'
+
+
+class WatchFolder:
+	def __init__(self, path, type=taskfile.TaskType.RENDER_ANIMATION, position=Position.BACK, recursive=False, rules=None,
+			options=None):
+		self.path = os.path.abspath(path)
+		self.type = type
+		self.position = position
+		self.recursive = recursive
+		self.rules = rules if rules is not None else []
+		self.options = options if options is not None else []
+		self.watcher = None
+
+	def to_dict(self):
+		return {'path': self.path, 'type': self.type, 'position': self.position,
+			'recursive': self.recursive, 'rules': self.rules, 'options': self.options}
+
+	def from_dict(d):
+		return WatchFolder(d['path'], d.get('type', taskfile.TaskType.RENDER_ANIMATION),
+			d.get('position', Position.BACK), d.get('recursive', False), d.get('rules', None), d.get('options', None))
+
+	# Returns (type, position, options) for a file in this folder
+	def rule_for(self, path):
+		name = os.path.basename(path)
+		for rule in self.rules:
+			if fnmatch.fnmatch(name, rule.get('pattern', '*')):
+				return rule.get('type', self.type), rule.get('position', self.position), rule.get('options', self.options)
+		return self.type, self.position, self.options
+
+	def desc(self):
+		s = f'{self.path}' + \
+			f'\n\t- Type: {taskfile.TaskType.get_name(self.type)}' + \
+			f'\n\t- Position: {self.position}' + \
+			f'\n\t- Recursive: {self.recursive}'
+		if len(self.options) > 0:
+			s += f'\n\t- Options: {" ".join(self.options)}'
+		for rule in self.rules:
+			s += f'\n\t- Rule: {rule}'
+		return s
+
+
+folders = []
+# path -> (folder, (mtime, size) when last checked, time at which it was last seen changing)
+pending = {}
+# path -> mtime_ns of the version that was queued
+seen = {}
+mutex = threading.RLock()
+settle_thread = None
+settle_continue = False
+settle_cv = threading.Condition(mutex)
+
+
+def load():
+	global folders
+	global seen
+	try:
+		with open(watchfolders_filename, 'r') as f:
+			folders = [WatchFolder.from_dict(d) for d in json.load(f)]
+	except FileNotFoundError:
+		folders = []
+	except (OSError, ValueError, KeyError) as e:
+		print(f'Exception while loading watch folders "{watchfolders_filename}": {e}')
+		folders = []
+	try:
+		with open(seen_filename, 'r') as f:
+			seen = json.load(f)
+	except (OSError, ValueError):
+		seen = {}
+
+def save_folders():
+	taskfile.lock_disk()
+	try:
+		taskfile.write_atomic(watchfolders_filename, json.dumps([f.to_dict() for f in folders], indent='\t'))
+	finally:
+		taskfile.unlock_disk()
+
+def save_seen():
+	# Forget files that no longer exist so the file does not grow forever
+	for path in [p for p in seen if not os.path.exists(p)]:
+		del seen[path]
+	taskfile.lock_disk()
+	try:
+		taskfile.write_atomic(seen_filename, json.dumps(seen))
+	finally:
+		taskfile.unlock_disk()
+
+
+def folder_for(path):
+	for folder in folders:
+		if os.path.dirname(path) == folder.path or (folder.recursive and path.startswith(folder.path + os.sep)):
+			return folder
+	return None
+
+# Marks the file as pending if it is a blend file version that has not been queued yet
+def consider(folder, path):
+	if not path.endswith('.blend'):
+		return
+	try:
+		st = os.stat(path)
+	except OSError:
+		pending.pop(path, None)
+		return
+	if seen.get(path, None) == st.st_mtime_ns:
+		return
+	pending[path] = (folder, (st.st_mtime_ns, st.st_size), time.monotonic())
+
+def on_events(events):
+	with mutex:
+		for path, event in events:
+			folder = folder_for(path)
+			if folder is None:
+				continue
+			if event == fsnotify.Event.REMOVED:
+				pending.pop(path, None)
+			else:
+				consider(folder, path)
+		settle_cv.notify_all()
+
+
+# Queues all pending files that have settled. Must be called with mutex held
+def ingest_settled():
+	now = time.monotonic()
+	# position -> list of tasks
+	batches = {Position.FRONT: [], Position.BACK: []}
+	settled = False
+	for path, (folder, stat, changed) in list(pending.items()):
+		try:
+			st = os.stat(path)
+		except OSError:
+			del pending[path]
+			continue
+		if (st.st_mtime_ns, st.st_size) != stat:
+			pending[path] = (folder, (st.st_mtime_ns, st.st_size), now)
+			continue
+		if now - changed < settle_time:
+			continue
+		del pending[path]
+		seen[path] = st.st_mtime_ns
+		settled = True
+		if not tasks.is_valid_blend(path):
+			print(f'Watch folder: ignoring invalid blend file "{path}"')
+			continue
+		type, position, options = folder.rule_for(path)
+		try:
+			info = tasks.parse_task_options(options, type)
+		except ValueError as e:
+			print(f'Watch folder: invalid options for "{path}": {e}')
+			continue
+		batches[position if position in batches else Position.BACK].append(taskfile.Task(type, [path], info=info))
+	if not settled:
+		return
+	if len(batches[Position.FRONT]) == 0 and len(batches[Position.BACK]) == 0:
+		save_seen()
+		return
+	taskfile.lock_disk()
+	try:
+		if len(batches[Position.BACK]) > 0:
+			taskfile.create_tasks(batches[Position.BACK])
+		if len(batches[Position.FRONT]) > 0:
+			taskfile.create_tasks(batches[Position.FRONT], 0)
+	finally:
+		taskfile.unlock_disk()
+	save_seen()
+	M.bgd_thread.notify_thread()
+
+def settle_thread_func():
+	with mutex:
+		while settle_continue:
+			ingest_settled()
+			# Wake up again when the earliest pending file could have settled, or when new files arrive
+			timeout = None
+			if len(pending) > 0:
+				earliest = min(changed for folder, stat, changed in pending.values())
+				timeout = max(0.1, earliest + settle_time - time.monotonic())
+			settle_cv.wait(timeout)
+
+
+def start_folder(folder : WatchFolder):
+	folder.watcher = fsnotify.Watcher(folder.path, on_events, folder.recursive, poll_interval)
+	folder.watcher.start()
+	# Files that arrived while we were not watching
+	with mutex:
+		for path in folder.watcher.snapshot():
+			consider(folder, path)
+		settle_cv.notify_all()
+
+def stop_folder(folder : WatchFolder):
+	if folder.watcher is not None:
+		folder.watcher.stop()
+		folder.watcher = None
+	with mutex:
+		for path in [p for p, v in pending.items() if v[0] is folder]:
+			del pending[path]
+
+
+# Starts watching all saved folders
+def start():
+	global settle_thread
+	global settle_continue
+	load()
+	settle_continue = True
+	settle_thread = threading.Thread(target=settle_thread_func, name='WatchFolderThread', daemon=True)
+	settle_thread.start()
+	for folder in folders:
+		start_folder(folder)
+
+def stop():
+	global settle_thread
+	global settle_continue
+	for folder in folders:
+		stop_folder(folder)
+	if settle_thread is not None:
+		with mutex:
+			settle_continue = False
+			settle_cv.notify_all()
+		settle_thread.join()
+		settle_thread = None
+
+
+# Adds (and starts watching) a folder. If the folder is already watched, its settings are replaced
+def add_folder(folder : WatchFolder):
+	remove_folder(folder.path)
+	folders.append(folder)
+	save_folders()
+	if settle_thread is not None:
+		start_folder(folder)
+
+# Returns whether the folder was being watched
+def remove_folder(path):
+	path = os.path.abspath(path)
+	for folder in folders:
+		if folder.path == path:
+			stop_folder(folder)
+			folders.remove(folder)
+			save_folders()
+			return True
+	return False